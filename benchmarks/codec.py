@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Times each available JSON codec encoding publishes and decoding event pages
+shaped like the ones Spire returns to a busy subscription.
+
+    python benchmarks/codec.py [--messages 100] [--rounds 200]
+"""
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from spire.codec import available_codecs, JSONCodec
+
+def event_page(count):
+    messages = []
+    for i in range(count):
+        messages.append(dict(
+                timestamp=1330000000000 + i,
+                content=dict(
+                    type='deploy',
+                    node='web-%02i.example.com' % (i % 40),
+                    version='6f1c3a9b2d4e5f60718293a4b5c6d7e8f9012345',
+                    message=u'Deployed revision %i \u2713' % i,
+                    tags=['production', 'web', 'us-east-1'],
+                    metrics=dict(duration=12.5 + i, files=i * 3, ok=True),
+                    ),
+                ))
+    return dict(messages=messages, last=messages[-1]['timestamp'])
+
+def timed(rounds, func, arg):
+    start = time.time()
+    for i in range(rounds):
+        func(arg)
+    return (time.time() - start) / rounds
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--messages', type='int', default=100)
+    parser.add_option('--rounds', type='int', default=200)
+    opts, args = parser.parse_args()
+
+    page = event_page(opts.messages)
+    body = JSONCodec().encode(page)
+    print "event page: %i messages, %i bytes" % (opts.messages, len(body))
+
+    for codec in available_codecs():
+        assert codec.decode(body) == JSONCodec().decode(body)
+        decode = timed(opts.rounds, codec.decode, body)
+        encode = timed(opts.rounds * 10, codec.encode, page['messages'][0])
+        print "%-12s decode page %8.3fms (%6.1f MB/s)   encode message %7.2fus" % (
+            codec.name,
+            decode * 1000,
+            len(body) / decode / 1e6,
+            encode * 1e6,
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Compares `Channel.publish_many`, with and without pipelining, with a loop of
+`Channel.publish` against the in-process fake Spire server, so the numbers
+measure the client rather than the network. `--latency` delays each response to show the effect of a round trip.
+
+    python benchmarks/publish_many.py [--messages 2000] [--window 50] [--latency 0]
+"""
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import spire
+from spire.fakeserver import FakeSpireServer
+
+def bench_channel(server, secret, **kwargs):
+    client = spire.Client(server.url, secret=secret, **kwargs)
+    return client.session().channel('bench')
+
+def timed(label, count, func):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    print "%-28s %6i messages in %6.3fs  %9.1f msg/s" % (label, count, elapsed, count / elapsed)
+    return result
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--messages', type='int', default=2000)
+    parser.add_option('--window', type='int', default=spire.core.PUBLISH_PIPELINE_WINDOW)
+    parser.add_option('--latency', type='float', default=0, help="seconds per response")
+    opts, args = parser.parse_args()
+
+    server = FakeSpireServer(latency=opts.latency).start()
+    secret = server.create_account()
+
+    messages = ['message %i' % i for i in range(opts.messages)]
+
+    channel = bench_channel(server, secret)
+    timed('publish loop', opts.messages, lambda: [channel.publish(m) for m in messages])
+    print "  connections: %(connections_opened)i opened, %(connections_reused)i reused" % channel.client.connection_stats()
+    channel.client.close()
+
+    channel = bench_channel(server, secret)
+    timed('publish_many', opts.messages, lambda: channel.publish_many(messages))
+    print "  connections: %(connections_opened)i opened, %(connections_reused)i reused" % channel.client.connection_stats()
+    channel.client.close()
+
+    channel = bench_channel(server, secret, pipelining=True)
+    published = timed(
+        'publish_many (window=%i)' % opts.window,
+        opts.messages,
+        lambda: channel.publish_many(messages, window=opts.window),
+        )
+    print "  connections: %(connections_opened)i opened, %(connections_reused)i reused" % channel.client.connection_stats()
+    assert [x['content'] for x in published] == messages
+    channel.client.close()
+
+    server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Compares the memory held by a session caching many Channel objects, and the
+cost of building publish headers, with typed resources against the nested
+dict lookups Channel used to do.
+
+    python benchmarks/resources.py [--channels 100000]
+
+Memory is what the Channel objects add on top of the channel collection,
+whose dicts both versions share.
+"""
+import gc
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from spire.core import Channel
+
+SCHEMA = dict(message='application/vnd.spire-io.message+json;version=1.0')
+
+class DictChannel(object):
+    """Channel as it was: the resource dict and nothing else"""
+    def __init__(self, client, session, channel_resource):
+        self.client = client
+        self.session = session
+        self.channel_resource = channel_resource
+        self.last_timestamp = None
+
+    def _publish_headers(self):
+        content_type = self.client.schema['message']
+        return {
+            'Accept': content_type,
+            'Content-type': content_type,
+            'Authorization': "Capability %s" % self.channel_resource['capabilities'].get('publish', None),
+            }
+
+def channel_resource(i):
+    url = 'https://api.spire.io/account/Ac-1234/channel/Ch-%i' % i
+    return dict(
+        url=url,
+        name='channel-%i' % i,
+        capabilities=dict(publish='p%032i' % i, delete='d%032i' % i),
+        resources=dict(subscriptions=dict(
+                url='%s/subscriptions' % url,
+                capabilities=dict(get_subscriptions='s%032i' % i),
+                )),
+        )
+
+def rss():
+    """Resident set size in bytes (Linux only)"""
+    fp = open('/proc/self/statm')
+    try:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        fp.close()
+
+def measure(make, resources, publish):
+    gc.collect()
+    before = rss()
+    channels = [make(resource) for resource in resources]
+    if publish:
+        for channel in channels:
+            channel._publish_headers()
+    gc.collect()
+    return channels, rss() - before
+
+class Client(object):
+    schema = SCHEMA
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--channels', type='int', default=100000)
+    opts, args = parser.parse_args()
+
+    resources = [channel_resource(i) for i in range(opts.channels)]
+    print "%i channels" % opts.channels
+    for label, channel_class in (('dict', DictChannel), ('typed', Channel)):
+        # measure each in a child so freed memory isn't reused by the next
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            continue
+        client = Client()
+        make = lambda resource: channel_class(client, None, resource)
+        channels, cached = measure(make, resources, False)
+        channels = None
+        channels, published = measure(make, resources, True)
+
+        channel = channels[0]
+        start = time.time()
+        for i in range(100000):
+            channel._publish_headers()
+        per_call = (time.time() - start) / 100000
+
+        print "%-6s %7.1f bytes/channel cached, %7.1f after publishing, headers %5.2fus" % (
+            label,
+            float(cached) / opts.channels,
+            float(published) / opts.channels,
+            per_call * 1e6,
+            )
+        os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -16,42 +16,31 @@ def report_version():
         stdout=subprocess.PIPE,
         ).stdout.read()
 
-def run(client, node, dots=True, last_message_timestamp=None):
+def run(client, node, dots=True):
     channel = client.session().channel('myService.versionNotifier')
-    # set last message
-    # oh python you crazy
-    class MessageProcessor(object):
-        def __init__(self, last_message_timestamp):
-            if last_message_timestamp is None:
-                last_message_timestamp = 0
-            self.last_message_timestamp = last_message_timestamp
-        def process(self, messages):
-            for message in messages:
-                last_message_timestamp = message['timestamp']
-                if last_message_timestamp > self.last_message_timestamp:
-                    self.last_message_timestamp = last_message_timestamp
-                if message['content'].startswith('report:'):
-                    sys.stdout.write(message['content'] + '\n')
-                    sys.stdout.flush()
-            fp = file('.last-message', 'w')
-            fp.write(str(last_message_timestamp))
-            fp.close()
+    subscription = channel.subscription()
+    # resume from where the last run left off
+    subscription.checkpoint_to(spire.FileCheckpointStore('.last-message.json'))
 
-            if 'getVersion' in [x['content'] for x in messages]:
-                print "getting version"
-                channel.publish('report: %s: %s' % (node, report_version()))
-    mp = MessageProcessor(last_message_timestamp)
-    while True:
-        messages = channel.subscribe(
-            last_message_timestamp=mp.last_message_timestamp,
-            callback=mp.process,
-            )
-        if messages:
-            mp.process(messages)
+    # messages are routed on the text before the first ':', so "report: ..."
+    # and "getVersion" each go straight to their handler
+    dispatcher = spire.Dispatcher(key=spire.dispatch.content_prefix(':'))
+
+    @dispatcher.on('report')
+    def print_report(message):
+        sys.stdout.write(message['content'] + '\n')
+        sys.stdout.flush()
+
+    @dispatcher.on('getVersion')
+    def send_version(message):
+        print "getting version"
+        channel.publish('report: %s: %s' % (node, report_version()))
+
+    for message in subscription.events():
+        dispatcher.dispatch(message)
         if dots:
             sys.stdout.write('.')
             sys.stdout.flush()
-        # TODO filter support
 
 
 def ask(client):
@@ -59,13 +48,6 @@ def ask(client):
     client.session().channel('myService.versionNotifier').publish('getVersion')
     
 if __name__ == '__main__':
-    last_message_timestamp = None
-    try:
-        fp = file('.last-message')
-        last_message_timestamp = long(fp.read().strip())
-        fp.close()
-    except IOError:
-        pass
     parser = optparse.OptionParser(usage="%prog wait|ask host key [nodename]")
     parser.add_option('--dots', action="store_true", default=False, dest="dots")
     opts, args = parser.parse_args()
@@ -78,7 +60,7 @@ if __name__ == '__main__':
     client = spire.Client(args[1], key=args[2], async=True)
 
     if args[0] == 'wait':
-        run(client, nodename, opts.dots, last_message_timestamp)
+        run(client, nodename, opts.dots)
     elif args[0] == 'ask':
         ask(client)
     else:
@@ -1 +1,22 @@
 from core import SpireClientException, Client, Session, Channel, Subscription
+from errors import CircuitOpenError, PayloadTooLarge
+from transport import Transport, PooledTransport, TransportError
+from pipeline import RequestPipeline, RetryPolicy, CircuitBreaker
+from manager import SubscriptionManager
+from dispatch import Dispatcher
+from consumer import QueueConsumer
+from polling import FixedPolling, AdaptivePolling
+from discovery import DiscoveryCache
+from codec import JSONCodec, SimpleJSONCodec, UJSONCodec
+from compression import Compression
+from pool import SessionPool
+from singleflight import SingleFlight
+from publisher import Publisher, PublishFuture, PublishDropped
+from metrics import MetricsCollector
+from checkpoint import CheckpointStore, MemoryCheckpointStore, FileCheckpointStore, SQLiteCheckpointStore
+
+try:
+    from evented import AsyncClient, AsyncSession, AsyncChannel, AsyncSubscription, GeventTransport
+    from evented import EventedSubscriptionManager, EventedQueueConsumer
+except ImportError:
+    pass # gevent is not installed
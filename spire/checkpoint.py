@@ -0,0 +1,156 @@
+"""
+Durable storage for subscription positions.
+
+A checkpoint store maps a key (by default the subscription's URL) to the
+timestamp of the last event that was processed, so a consumer that restarts
+can pick up where it left off. See `Subscription.checkpoint_to`.
+"""
+import os
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+CHECKPOINT_INTERVAL = 1.0
+
+class CheckpointStore(object):
+    """Base class for checkpoint stores, which also serves as the in-memory
+    store.
+
+    Positions are written out by `_write`, which subclasses implement. If
+    `sync_interval` is set, saves arriving less than that many seconds after
+    the last write are only recorded in memory, and written together with the
+    next write (or by `flush`). That bounds the number of fsyncs no matter how
+    many subscriptions share the store.
+    """
+    def __init__(self, sync_interval=0):
+        self.sync_interval = sync_interval
+        self._positions = {}
+        self._dirty = {}
+        self._last_sync = 0
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            return self._positions.get(key, None)
+
+    def save(self, key, timestamp):
+        with self._lock:
+            self._positions[key] = timestamp
+            self._dirty[key] = timestamp
+            if time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self.flush()
+
+    def _sync(self):
+        if self._dirty:
+            self._write(self._dirty)
+            self._dirty = {}
+        self._last_sync = time.time()
+
+    def _write(self, changed):
+        pass
+
+MemoryCheckpointStore = CheckpointStore
+
+class FileCheckpointStore(CheckpointStore):
+    """Keeps positions in a JSON file. Each write goes to a temporary file
+    which is fsynced and then renamed over the old one, so the file is always
+    either the old or the new version, even if the process dies mid-write."""
+    def __init__(self, path, sync_interval=0):
+        CheckpointStore.__init__(self, sync_interval)
+        self.path = path
+        try:
+            fp = open(path)
+            try:
+                self._positions = json.load(fp)
+            finally:
+                fp.close()
+        except IOError:
+            pass # no checkpoints yet
+
+    def _write(self, changed):
+        tmp_path = "%s.tmp" % self.path
+        fp = open(tmp_path, 'w')
+        try:
+            json.dump(self._positions, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path)
+        # make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Keeps positions in a SQLite database, one row per key"""
+    def __init__(self, path, sync_interval=0, table='spire_checkpoints'):
+        CheckpointStore.__init__(self, sync_interval)
+        import sqlite3
+        self.table = table
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, timestamp INTEGER)" % table)
+        self.db.commit()
+        for key, timestamp in self.db.execute("SELECT key, timestamp FROM %s" % table):
+            self._positions[key] = timestamp
+
+    def _write(self, changed):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO %s (key, timestamp) VALUES (?, ?)" % self.table,
+            changed.items(),
+            )
+        self.db.commit()
+
+    def close(self):
+        CheckpointStore.close(self)
+        self.db.close()
+
+class Checkpointer(object):
+    """Decides when a subscription's position is saved to its store: after
+    every `every` processed events, or once `interval` seconds have passed
+    since the last save, whichever comes first."""
+    def __init__(self, store, key, every=None, interval=CHECKPOINT_INTERVAL):
+        self.store = store
+        self.key = key
+        self.every = every
+        self.interval = interval
+        self.timestamp = None
+        self.pending = 0
+        self.last_save = time.time()
+
+    def load(self):
+        return self.store.load(self.key)
+
+    def processed(self, timestamp, count=1):
+        """Record that events up to `timestamp` have been processed"""
+        self.timestamp = timestamp
+        self.pending += count
+        if self.every is not None and self.pending >= self.every:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        """Save if the interval has elapsed, even without new events"""
+        if self.interval is not None and time.time() - self.last_save >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.store.save(self.key, self.timestamp)
+            self.pending = 0
+        self.last_save = time.time()
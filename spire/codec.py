@@ -0,0 +1,99 @@
+"""
+JSON codecs. A `Client` encodes every request body and decodes every
+response body with its codec, which defaults to simplejson when it is
+installed and the standard library's json module otherwise. Both encode
+exactly what they are given.
+
+ujson is faster still, but has to be asked for with `codec='ujson'`: it
+rounds floats to 15 significant digits and can't handle integers of more
+than 64 bits, which `UJSONCodec` hands to json instead.
+"""
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from errors import SpireClientException
+
+class JSONCodec(object):
+    """The standard library's json module (simplejson on Python 2.5).
+
+    `decode` takes the response body as the byte string read off the socket,
+    without decoding it to unicode first; the JSON parsers below all handle
+    UTF-8 byte strings directly.
+    """
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+class SimpleJSONCodec(JSONCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.module = simplejson
+
+    def encode(self, obj):
+        return self.module.dumps(obj)
+
+    def decode(self, data):
+        return self.module.loads(data)
+
+class UJSONCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.module = ujson
+
+    def encode(self, obj):
+        try:
+            # as many digits as ujson will give, and URLs left alone
+            return self.module.dumps(obj, double_precision=15, escape_forward_slashes=False)
+        except OverflowError:
+            # integers too big for ujson
+            try:
+                return json.dumps(obj)
+            except (TypeError, ValueError), e:
+                raise SpireClientException("Could not encode %r: %s" % (obj, e))
+
+    def decode(self, data):
+        try:
+            return self.module.loads(data)
+        except ValueError:
+            # ujson refuses integers of more than 64 bits; json raises
+            # ValueError itself if the data really is invalid
+            return json.loads(data)
+
+# the default first; ujson only when asked for by name
+CODECS = [SimpleJSONCodec, JSONCodec, UJSONCodec]
+DEFAULT_CODECS = [SimpleJSONCodec, JSONCodec]
+
+def available_codecs():
+    """Instances of every codec whose library is installed"""
+    codecs = []
+    for codec_class in CODECS:
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            pass
+    return codecs
+
+def get_codec(codec=None):
+    """Returns a codec instance. `codec` may be an instance (returned as is),
+    the name of a codec, or None for simplejson if it is installed and json
+    otherwise."""
+    if codec is not None and not isinstance(codec, basestring):
+        return codec
+    for codec_class in (DEFAULT_CODECS if codec is None else CODECS):
+        if codec is None or codec_class.name == codec:
+            try:
+                return codec_class()
+            except ImportError:
+                if codec is not None:
+                    raise
+    raise ValueError("Unknown codec: %r" % codec)
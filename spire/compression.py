@@ -0,0 +1,98 @@
+"""
+Compressing request bodies and decoding compressed responses.
+
+Large JSON messages compress well. A client created with `compression`
+gzips (or deflates) publish bodies over a size threshold and asks for
+compressed responses with Accept-Encoding; transports decode compressed
+responses whatever was asked for.
+
+    client = spire.Client(secret=secret, compression='gzip', max_payload=1024 * 1024)
+    ...
+    client.compression.stats() # => {'compressed': 120, 'bytes_in': 913410, 'bytes_out': 104532, ...}
+"""
+import threading
+import zlib
+
+ENCODINGS = ('gzip', 'deflate')
+COMPRESS_THRESHOLD = 1024 # bytes; smaller bodies gain little from compressing
+
+def compress(data, encoding, level=6):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    raise ValueError("Unknown content encoding: %r" % encoding)
+
+def decompress(data, encoding):
+    """Decode a body sent with Content-Encoding `encoding`. Raises ValueError
+    for unknown encodings and zlib.error for corrupt data."""
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send raw deflate data without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    if encoding in ('', 'identity'):
+        return data
+    raise ValueError("Unknown content encoding: %r" % encoding)
+
+class Compression(object):
+    """Compresses request bodies of at least `threshold` bytes with
+    `encoding` ('gzip' or 'deflate') and asks for responses compressed with
+    any of `accept`. Bodies that don't get smaller are sent as they are."""
+    def __init__(self, encoding='gzip', threshold=COMPRESS_THRESHOLD, level=6, accept=ENCODINGS):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown content encoding: %r" % encoding)
+        self.encoding = encoding
+        self.threshold = threshold
+        self.level = level
+        self.accept_encoding = ', '.join(accept) or None
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0 # before compression
+        self.bytes_out = 0 # after
+
+    def compress(self, data, force=False):
+        """Returns `(body, content encoding)`, the encoding being None if
+        the body was left alone. With `force` bodies under the threshold are
+        compressed too, so that a pipelined batch shares one encoding."""
+        if not force and len(data) < self.threshold:
+            with self._lock:
+                self.skipped += 1
+            return data, None
+        compressed = compress(data, self.encoding, self.level)
+        if not force and len(compressed) >= len(data):
+            with self._lock:
+                self.skipped += 1
+            return data, None
+        with self._lock:
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+        return compressed, self.encoding
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                compressed=self.compressed,
+                skipped=self.skipped,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                ratio=float(self.bytes_out) / self.bytes_in if self.bytes_in else None,
+                )
+
+def get_compression(compression=None):
+    """Returns a `Compression` instance, or None. `compression` may be an
+    instance (returned as is), an encoding name, True for gzip, or None or
+    False for no compression."""
+    if compression is None or compression is False:
+        return None
+    if compression is True:
+        return Compression()
+    if isinstance(compression, basestring):
+        return Compression(encoding=compression)
+    return compression
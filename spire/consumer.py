@@ -0,0 +1,392 @@
+"""
+Consuming a subscription through a bounded queue.
+
+`Subscription.subscribe(callback=...)` runs the callback between polls, so a
+slow callback holds up polling, and events can't be fetched ahead of a
+consumer that is keeping up. A `QueueConsumer` decouples the two: one poller
+fetches pages into a bounded queue and worker threads (or greenlets) take
+events from it. When the queue is full the poller waits, so a slow consumer
+slows polling down instead of growing memory.
+
+Several workers can handle events at once, optionally partitioned by a key so
+events with the same key are handled one at a time and in order, and in a
+pool of processes for handlers that need more than one core. Either way the
+subscription's checkpoint only moves past events that have been handled.
+"""
+import collections
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+from manager import ERROR_BACKOFF, MAX_ERROR_BACKOFF, spawn_thread
+from resources import events_in_order
+
+QUEUE_SIZE = 1000
+PUT_TIMEOUT = 0.5 # how often a waiting poller checks whether to stop
+DRAIN_INTERVAL = 0.01
+
+_STOP = object()
+
+class AckTracker(object):
+    """Tracks events handed out in order and acknowledged in any order, to
+    find how far the position can safely move: up to the newest event that
+    has no unacknowledged events before it."""
+    def __init__(self):
+        self._events = collections.deque() # [timestamp, acknowledged]
+        self.blocked = False # an event failed; see fail()
+
+    def __len__(self):
+        return len(self._events)
+
+    def __contains__(self, entry):
+        return any(tracked is entry for tracked in self._events)
+
+    def add(self, timestamp):
+        """Track an event, returning the entry to acknowledge it with"""
+        entry = [timestamp, False]
+        if not self.blocked:
+            self._events.append(entry)
+        return entry
+
+    def discard_last(self):
+        if not self.blocked:
+            self._events.pop()
+
+    def discard(self, entries):
+        """Stop tracking `entries`, events that won't be handled, and every
+        event after the first of them, so the position can't move past it.
+        Returns the timestamp of the event before it, or None if there is
+        none."""
+        ids = set(id(entry) for entry in entries)
+        for i, entry in enumerate(self._events):
+            if id(entry) in ids:
+                before = self._events[i - 1][0] if i else None
+                while len(self._events) > i:
+                    self._events.pop()
+                return before
+        return None
+
+    def fail(self, entry):
+        """Stop tracking `entry`, an event that wasn't handled, and every
+        event after it, including the ones added from now on, so the position
+        never moves past it. Returns the timestamp of the event before it, or
+        None if there is none."""
+        self.blocked = True
+        return self.discard([entry])
+
+    def acknowledge(self, entry):
+        """Mark an event as handled. Returns the (timestamp, count) the
+        position moved forward by, or None if it didn't move."""
+        entry[1] = True
+        moved_to = None
+        count = 0
+        while self._events and self._events[0][1]:
+            moved_to = self._events.popleft()[0]
+            count += 1
+        if moved_to is None:
+            return None
+        return moved_to, count
+
+class QueueConsumer(object):
+    """Polls `subscription` into a queue of at most `maxsize` events, from
+    which `workers` workers call `handler(event)`.
+
+    Without `partition`, the workers share one queue and take events in
+    order, though with more than one worker they may finish out of order.
+    With `partition`, a function returning an event's key, each worker has a
+    queue of its own and events are spread between them by key, so events
+    with the same key are handled in the order they were published.
+
+    With `processes`, handlers run in a `multiprocessing.Pool` of that many
+    processes, each worker waiting for its event's result, so CPU-bound
+    handlers can use several cores (given at least as many workers). The
+    handler and events must then be picklable, so the handler has to be a
+    module-level function.
+
+    The subscription's checkpoint (see `Subscription.checkpoint_to`) only
+    moves up to the newest event with no unhandled events before it, so a
+    restart never skips an unhandled event (events handled after the
+    checkpoint may be handled again).
+
+    Exceptions raised while polling or by the handler are passed to
+    `on_error(exc_info)`, which prints them by default. A failed event is not
+    retried while the consumer runs, and isn't acknowledged either: the
+    checkpoint stays before it, and `stop` rewinds the subscription to it, so
+    it is delivered again after a restart (along with the events after it,
+    which are handled meanwhile). With `acknowledge_errors` a failed event
+    counts as handled instead. `spawn`, `sleep` and `queue_class` can be
+    swapped for gevent's (see `spire.evented.EventedQueueConsumer`).
+
+        consumer = QueueConsumer(subscription, handle_event, maxsize=500, workers=4)
+        consumer.start()
+        ...
+        consumer.metrics() # => {'depth': 12, 'lag': 340, 'paused': 2, ...}
+        consumer.stop()
+    """
+    def __init__(
+        self,
+        subscription,
+        handler,
+        maxsize=QUEUE_SIZE,
+        workers=1,
+        partition=None,
+        processes=None,
+        on_error=None,
+        acknowledge_errors=False,
+        spawn=spawn_thread,
+        sleep=time.sleep,
+        queue_class=Queue.Queue,
+        ):
+        self.subscription = subscription
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.partition = partition
+        self.processes = processes
+        self.pool = None
+        if on_error is not None:
+            self.on_error = on_error
+        self.acknowledge_errors = acknowledge_errors
+        self.spawn = spawn
+        self.sleep = sleep
+        if partition is None:
+            self.queues = [queue_class(maxsize)]
+        else:
+            self.queues = [queue_class(max(1, maxsize // workers)) for i in range(workers)]
+        self.running = False
+
+        self._lock = threading.Lock()
+        self._acks = AckTracker() # events queued and not yet acknowledged
+        self._pending = 0 # events queued and not yet handled
+        self._fetched_timestamp = None # of the last event queued
+        self._handled_timestamp = None # position of the last acknowledgment
+        self._started_timestamp = None # position when started
+        self._enqueuing = False # the poller is queuing a page
+        self._rewound = None # [position] to poll from after a stop
+        self._failed_before = None # [position] before the first failed event
+
+        self.polls = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.errors = 0
+        self.paused = 0 # times the poller found a queue full
+        self.paused_seconds = 0.0
+
+    @property
+    def queue(self):
+        return self.queues[0]
+
+    def on_error(self, exc_info):
+        traceback.print_exception(*exc_info, file=sys.stderr)
+
+    def start(self, last_timestamp=None):
+        if last_timestamp is not None:
+            self.subscription.last_timestamp = last_timestamp
+        self._started_timestamp = self.subscription.last_timestamp
+        self._rewound = None
+        self._acks = AckTracker()
+        self._handled_timestamp = None
+        self._failed_before = None
+        if self.processes is not None and self.pool is None:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(self.processes)
+        self.running = True
+        for i in range(self.workers):
+            self.spawn(self._work, self.queues[i % len(self.queues)])
+        self.spawn(self._poll_loop)
+        return self
+
+    def stop(self, drain=True, timeout=None):
+        """Stop polling. With `drain`, wait (for up to `timeout` seconds) for
+        the workers to handle the events already queued; either way the
+        workers then exit and the subscription's checkpoint is saved."""
+        with self._lock:
+            self.running = False
+        # a poll in flight now won't queue its page, but the poller may be
+        # part way through queuing one
+        while self._enqueuing:
+            self.sleep(DRAIN_INTERVAL)
+        if drain:
+            self.drain(timeout)
+        else:
+            self._discard_queued()
+        with self._lock:
+            if self._failed_before is not None:
+                # deliver the failed event again after a restart
+                self._rewind(self._failed_before[0])
+        for i in range(self.workers):
+            self.queues[i % len(self.queues)].put(_STOP)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.subscription.checkpoint()
+
+    def _discard_queued(self):
+        # the position stays before discarded events, so they are fetched
+        # again after a restart
+        discarded = []
+        for queue in self.queues:
+            while True:
+                try:
+                    discarded.append(queue.get_nowait()[0])
+                except Queue.Empty:
+                    break
+        if not discarded:
+            return
+        with self._lock:
+            self._pending -= len(discarded)
+            before = self._acks.discard(discarded)
+            if before is None:
+                before = self._handled_timestamp
+            if before is None:
+                before = self._started_timestamp
+            self._fetched_timestamp = before
+            self._rewind(before)
+
+    def _rewind(self, timestamp):
+        # Poll from `timestamp` after a restart, unless the poller or stop()
+        # already rewound to an earlier event. Called with the lock held.
+        if self._rewound is not None:
+            timestamp = min(timestamp, self._rewound[0])
+        self._rewound = [timestamp]
+        self.subscription.last_timestamp = timestamp
+
+    def drain(self, timeout=None):
+        """Wait until every event fetched so far has been handled. Returns
+        False if `timeout` seconds pass first."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self._pending:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            self.sleep(DRAIN_INTERVAL)
+        return True
+
+    def _queue_for(self, event):
+        if self.partition is None:
+            return self.queues[0]
+        return self.queues[hash(self.partition(event)) % len(self.queues)]
+
+    def _put(self, item):
+        queue = self._queue_for(item[1])
+        if not self.running:
+            return False
+        if queue.full():
+            self.paused += 1
+            started = time.time()
+            while self.running:
+                try:
+                    queue.put(item, timeout=PUT_TIMEOUT)
+                    break
+                except Queue.Full:
+                    pass
+            self.paused_seconds += time.time() - started
+            return self.running
+        queue.put(item)
+        return True
+
+    def _poll_loop(self):
+        consecutive_errors = 0
+        while self.running:
+            resume = self.subscription.last_timestamp
+            try:
+                page = self.subscription.poll()
+            except Exception:
+                self.errors += 1
+                consecutive_errors += 1
+                self.on_error(sys.exc_info())
+                self.sleep(min(ERROR_BACKOFF * 2 ** (consecutive_errors - 1), MAX_ERROR_BACKOFF))
+                continue
+            consecutive_errors = 0
+            self.polls += 1
+            with self._lock:
+                if not self.running:
+                    # stopped while polling; poll for this page again next time
+                    self._rewind(resume)
+                    return
+                self._enqueuing = True
+            try:
+                for event in events_in_order(page):
+                    with self._lock:
+                        self._pending += 1
+                        entry = self._acks.add(event['timestamp'])
+                        fetched, self._fetched_timestamp = self._fetched_timestamp, event['timestamp']
+                    if not self._put((entry, event)):
+                        # stopped; poll from this event next time
+                        with self._lock:
+                            self._pending -= 1
+                            self._acks.discard_last()
+                            self._fetched_timestamp = fetched
+                            self._rewind(resume)
+                        return
+                    resume = event['timestamp']
+                    self.enqueued += 1
+            finally:
+                self._enqueuing = False
+
+    def _handle(self, event):
+        if self.pool is not None:
+            return self.pool.apply(self.handler, (event,))
+        return self.handler(event)
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            entry, event = item
+            try:
+                self._handle(event)
+            except Exception:
+                self.errors += 1
+                self.on_error(sys.exc_info())
+                self._handled(entry, failed=not self.acknowledge_errors)
+            else:
+                self._handled(entry)
+
+    def _handled(self, entry, failed=False):
+        with self._lock:
+            self.processed += 1
+            self._pending -= 1
+            if failed:
+                if entry in self._acks:
+                    # otherwise it is after an earlier failure already
+                    before = self._acks.fail(entry)
+                    if before is None:
+                        before = self._handled_timestamp
+                    if before is None:
+                        before = self._started_timestamp
+                    self._failed_before = [before]
+                return
+            moved = self._acks.acknowledge(entry)
+            if moved is not None:
+                self._handled_timestamp = moved[0]
+                self.subscription._processed(*moved)
+
+    def metrics(self):
+        """Queue depth and how far behind the consumer is. `lag` is the number
+        of milliseconds between the newest event fetched and the position the
+        checkpoint can move to (None until then); `pending` counts events
+        fetched but not handled yet."""
+        with self._lock:
+            lag = None
+            if self._handled_timestamp is not None and self._fetched_timestamp is not None:
+                lag = self._fetched_timestamp - self._handled_timestamp
+            return dict(
+                depth=sum(queue.qsize() for queue in self.queues),
+                maxsize=self.maxsize,
+                pending=self._pending,
+                unacknowledged=len(self._acks),
+                lag=lag,
+                last_timestamp=self.subscription.last_timestamp,
+                polls=self.polls,
+                enqueued=self.enqueued,
+                processed=self.processed,
+                errors=self.errors,
+                paused=self.paused,
+                paused_seconds=self.paused_seconds,
+                )
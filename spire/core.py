@@ -1,28 +1,52 @@
+import collections
+import hashlib
 import os
+import Queue
 import sys
+import threading
+import time
+
+from checkpoint import CHECKPOINT_INTERVAL, Checkpointer
+from codec import get_codec
+from compression import get_compression
+import discovery
+from errors import PayloadTooLarge, SpireClientException
+from manager import spawn_thread
+from pipeline import RequestPipeline
+from polling import FixedPolling
+from singleflight import SingleFlight
+from resources import ChannelResource, ResourceCollection, SessionResource, SubscriptionResource, events_in_order
+from transport import PooledTransport, TransportError
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
-
-import requests
-
-try:
-    from requests import async as r_async
-except ImportError:
-    pass
-
-SUBSCRIBE_MAX_TIMEOUT = 30
 MAX_CHANNEL_CREATE_RETRIES = 3
+PUBLISH_PIPELINE_WINDOW = 50
+CHANNEL_CACHE_SIZE = 1024
+SUBSCRIPTION_CACHE_SIZE = 1024
+CHANNEL_CREATE_CONCURRENCY = 8
 
-my_config = {}
+transport_config = {}
 if os.environ.get('REQUESTS_VERBOSE_LOGGING'):
-    my_config['verbose'] = sys.stderr
+    transport_config['verbose'] = sys.stderr
 
-class SpireClientException(Exception):
-    """Base class for spire client exceptions"""
+def _concurrently(spawn, *funcs):
+    """Call each of `funcs` in a thread (or greenlet) of its own started with
+    `spawn`, and return their results once all have returned. If any raised,
+    the first exception is raised again."""
+    results = [None] * len(funcs)
+    errors = []
 
+    def _run(i, func):
+        try:
+            results[i] = func()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    workers = [spawn(_run, i, func) for i, func in enumerate(funcs)]
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
 
 def require_discovery(func):
     """Does what it sounds like it does. A decorator that can be applied to
@@ -32,12 +56,25 @@ def require_discovery(func):
         # in instance methods, arg[0] will always be self
         zelf = args[0]
         if not zelf.resources or not zelf.schema:
-            zelf._discover() # synchronous!
+            # threads arriving together share one discovery request
+            zelf.single_flight.do((zelf, 'discover'), zelf._discover_once) # synchronous!
         return func(*args, **kwargs)
     return decorated_instance_method
 
 class Client(object):
-    def __init__(self, base_url='http://api.spire.io', secret=None, async=True):
+    def __init__(
+        self,
+        base_url='http://api.spire.io',
+        secret=None,
+        async=True,
+        transport=None,
+        discovery_cache=None,
+        retry_policy=None,
+        codec=None,
+        compression=None,
+        max_payload=None,
+        pipelining=False,
+        ):
         self.base_url = base_url
         self.secret = secret
         self.resources = None
@@ -46,21 +83,200 @@ class Client(object):
         self.async = async
         self.capability = None
         self._unused_sessions = []
+        self._lock = threading.Lock()
+        # collapses concurrent discovery, collection fetches and creation of
+        # the same channel or subscription by this client and its sessions
+        self.single_flight = SingleFlight()
+        self.session_pool = None
+        self.publisher = None
+        # All requests made on behalf of this client, its sessions, channels
+        # and subscriptions go through the transport, so they share its pool
+        # of keep-alive connections
+        if transport is None:
+            transport = PooledTransport(**transport_config)
+        self.transport = transport
+        # ...by way of the pipeline, which retries failed requests and stops
+        # sending them to a host that keeps failing
+        self.pipeline = RequestPipeline(transport, retry_policy)
+        # encodes request bodies and decodes responses; the fastest JSON
+        # library available unless told otherwise
+        self.codec = get_codec(codec)
+        # compresses large publish bodies and asks for compressed responses
+        # when set; see spire.compression
+        self.compression = get_compression(compression)
+        # the largest encoded message, in bytes, publish will send
+        self.max_payload = max_payload
+        # whether publish_many may pipeline its POSTs; off by default, since
+        # a POST pipelined behind one that fails may or may not have been
+        # handled (RFC 7230, section 6.3.2)
+        self.pipelining = pipelining
+        if discovery_cache is None:
+            discovery_cache = discovery.shared_cache
+        self.discovery_cache = discovery_cache
+        # called before and after every API call, see add_hook
+        self.hooks = []
+        self.metrics = None
+
+    def create_session_pool(self, **kwargs):
+        """Create a thread-safe `SessionPool` of sessions for this client and
+        keep it as `self.session_pool`. See spire.pool for the options."""
+        from pool import SessionPool
+        self.session_pool = SessionPool(self, **kwargs)
+        return self.session_pool
+
+    def create_publisher(self, **kwargs):
+        """Create and start a `spire.publisher.Publisher`, which publishes
+        messages from background workers, and keep it as `self.publisher`.
+        See spire.publisher for the options."""
+        from publisher import Publisher
+        self.publisher = Publisher(self, **kwargs).start()
+        return self.publisher
+
+    def add_hook(self, hook):
+        """Call `hook(call)` before and after every API call made for this
+        client. `call` is a dict with the `operation` (e.g. 'publish' or
+        'subscribe'), `method`, `url`, `phase` ('before' or 'after'),
+        `started` time and `bytes_sent` (of the request body as sent). After the call it also has
+        `elapsed` seconds, `status_code` (None if there was no response),
+        `error`, `bytes_received` (of the response body as received, before
+        decompressing) and `retries`.
+        The same dict is passed to both calls of a hook, so hooks can keep
+        state in it."""
+        self.hooks.append(hook)
+        return hook
+
+    def enable_metrics(self, **kwargs):
+        """Aggregate calls in a `spire.metrics.MetricsCollector`, kept as
+        `self.metrics`, which can export them for Prometheus"""
+        with self._lock:
+            if self.metrics is None:
+                from metrics import MetricsCollector
+                self.metrics = self.add_hook(MetricsCollector(**kwargs))
+        return self.metrics
+
+    def _fire(self, phase, call):
+        call['phase'] = phase
+        for hook in self.hooks:
+            hook(call)
+
+    def _call_started(self, operation, method, url, bytes_sent):
+        if not self.hooks:
+            return None
+        call = dict(
+            operation=operation,
+            method=method,
+            url=url,
+            bytes_sent=bytes_sent,
+            started=time.time(),
+            )
+        self._fire('before', call)
+        return call
 
-    def _discover(self):
-        response = requests.get(
-            self.base_url,
-            headers={'Accept':'application/json'},
-            config=my_config,
+    def _call_finished(self, call, responses, error):
+        if responses:
+            retries = sum(response.attempts - 1 for response in responses)
+        else:
+            retries = getattr(error, 'attempts', 1) - 1
+        call.update(
+            elapsed=time.time() - call['started'],
+            status_code=responses[-1].status_code if responses else None,
+            error=error,
+            bytes_received=sum(response.wire_size for response in responses),
+            retries=retries,
             )
+        self._fire('after', call)
+
+    def connection_stats(self):
+        """Counters for connections opened and reused by the transport"""
+        return self.transport.stats()
+
+    def close(self):
+        """Close idle connections held by the transport"""
+        self.transport.close()
+
+    def _request(self, method, url, operation=None, **kwargs):
+        """Send a request through the pipeline, returning the response.
+        `operation` names the API call for hooks."""
+        if not self.hooks:
+            return self.pipeline.request(method, url, **kwargs)
+        call = self._call_started(operation, method, url, len(kwargs.get('data', None) or ''))
+        try:
+            response = self.pipeline.request(method, url, **kwargs)
+        except SpireClientException, e:
+            self._call_finished(call, [], e)
+            raise
+        self._call_finished(call, [response], None)
+        return response
+
+    def _pipeline(self, method, url, bodies, operation=None, **kwargs):
+        """Send pipelined requests (see `RequestPipeline.pipeline`), as one
+        call as far as hooks are concerned"""
+        if not self.hooks:
+            return self.pipeline.pipeline(method, url, bodies, **kwargs)
+        call = self._call_started(operation, method, url, sum(len(body) for body in bodies))
+        try:
+            responses = self.pipeline.pipeline(method, url, bodies, **kwargs)
+        except SpireClientException, e:
+            self._call_finished(call, [], e)
+            raise
+        self._call_finished(call, responses, None)
+        return responses
+
+    def _encode_message(self, document):
+        """Encode a publish body, raising PayloadTooLarge if it is over
+        `max_payload` bytes"""
+        data = self.codec.encode(document)
+        if self.max_payload is not None and len(data) > self.max_payload:
+            raise PayloadTooLarge("Message is %i bytes encoded, over the limit of %i" % (
+                    len(data), self.max_payload))
+        return data
+
+    def _encoding_headers(self, headers, content_encoding=None):
+        """`headers` plus Accept-Encoding (and Content-Encoding) if
+        compression is on. Returns `headers` itself, which may be shared, when
+        there is nothing to add."""
+        if self.compression is None or self.compression.accept_encoding is None:
+            if content_encoding is None:
+                return headers
+            return dict(headers, **{'Content-Encoding': content_encoding})
+        headers = dict(headers, **{'Accept-Encoding': self.compression.accept_encoding})
+        if content_encoding is not None:
+            headers['Content-Encoding'] = content_encoding
+        return headers
+
+    def _parse(self, response, error):
+        """The parsed JSON body of `response`. If the response is a 4xx or 5xx
+        raises SpireClientException with `error` and the status code."""
+        if response.status_code == 413:
+            raise PayloadTooLarge("%s: 413, Spire rejected the request as too large" % error)
+        if not response: # XXX response is also falsy for 4xx
+            raise SpireClientException("%s: %i" % (error, response.status_code))
+        try:
+            return self.codec.decode(response.content)
+        except ValueError:
+            raise SpireClientException("Spire endpoint returned invalid JSON")
+
+    def _request_json(self, error, method, url, **kwargs):
+        return self._parse(self._request(method, url, **kwargs), error)
+
+    def _discover(self):
+        cached = self.discovery_cache.get(self.base_url)
+        if self.discovery_cache.is_fresh(cached):
+            return self._use_discovery(cached.document)
+
+        headers = {'Accept':'application/json'}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        response = self._request('GET', self.base_url, operation='discover', headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            self.discovery_cache.revalidated(self.base_url)
+            return self._use_discovery(cached.document)
 
         if not response:
             raise SpireClientException("Spire discovery failed")
         try:
-            discovery_result = json.loads(response.content)
-            #YYY
-
-
+            discovery_result = self.codec.decode(response.content)
         except ValueError:
             raise SpireClientException("Spire endpoint returned invalid JSON")
 
@@ -70,36 +286,46 @@ class Client(object):
         if not _check_schema(discovery_result):
             raise SpireClientException("Spire endpoint returned invalid JSON")
 
-        self.resources = discovery_result['resources']
+        self.discovery_cache.put(
+            self.base_url,
+            discovery_result,
+            response.headers.get('etag', None),
+            )
+        return self._use_discovery(discovery_result)
+
+    def _discover_once(self):
+        if not self.resources or not self.schema:
+            self._discover()
 
-        self.schema = {}
+    def _use_discovery(self, discovery_result):
+        # other threads may be reading these, so build the schema before
+        # setting it rather than filling it in place
+        schema = {}
         for key, value in discovery_result['schema']['1.0'].iteritems():
-            self.schema[key] = value['mediaType']
+            schema[key] = value['mediaType']
+        self.resources = discovery_result['resources']
+        self.schema = schema
 
         return self.resources
 
     @require_discovery
     def session(self):
         """Start a session and set self.notifications."""
-        if self._unused_sessions:
-            return self._unused_sessions.pop()
+        with self._lock:
+            if self._unused_sessions:
+                return self._unused_sessions.pop()
         # synchronous!
-        response = requests.post(
+        parsed = self._request_json(
+            "Could not create session",
+            'POST',
             self.resources['sessions']['url'],
+            operation='create_session',
             headers={
                 'Accept': self.schema['session'],
                 'Content-type': self.schema['account'],
                 },
-            data=json.dumps(dict(secret=self.secret)),
-            config=my_config,
+            data=self.codec.encode(dict(secret=self.secret)),
             )
-        # TODO: DRY this up
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not create session: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
 
         # This interface to Session is based on earlier versions of the session
         # schema. It might make more sense to initialize Session with
@@ -114,34 +340,65 @@ class Client(object):
 
         return Session(self, parsed)
 
+    def bootstrap(self, channels=(), subscriptions=False, spawn=spawn_thread):
+        """Get a session ready to publish and subscribe, overlapping the
+        requests that don't depend on each other, and return it.
+
+        Discovery has to come first, unless a discovery document is cached:
+        if it is stale, the session is created with its URLs while it is
+        revalidated. Then the channels called `channels` are got or created
+        (all at once) while, with `subscriptions`, the subscription collection
+        is fetched. `spawn` starts the concurrent steps; see AsyncClient for
+        the gevent version.
+        """
+        if not self.resources or not self.schema:
+            cached = self.discovery_cache.get(self.base_url)
+            if cached is None:
+                self._discover()
+            elif self.discovery_cache.is_fresh(cached):
+                self._use_discovery(cached.document)
+            else:
+                stale = self._use_discovery(cached.document)
+                session, resources = _concurrently(spawn, self.session, self._discover)
+                if resources != stale:
+                    # the API moved since the document was cached
+                    session = self.session()
+                return self._bootstrap_session(session, channels, subscriptions, spawn)
+        return self._bootstrap_session(self.session(), channels, subscriptions, spawn)
+
+    def _bootstrap_session(self, session, channels, subscriptions, spawn):
+        steps = []
+        if channels:
+            steps.append(lambda: session.channels(channels, spawn=spawn))
+        else:
+            steps.append(session._get_channel_collection)
+        if subscriptions:
+            steps.append(session._get_subscription_collection)
+        _concurrently(spawn, *steps)
+        return session
+
     def _discover_async(self):
         pass
 
     @require_discovery
     def create_account(self, email, password):
-        response = requests.post(
+        parsed = self._request_json(
+            "Could not create account",
+            'POST',
             self.resources['accounts']['url'],
+            operation='create_account',
             headers={
                 'Accept': self.schema['session'],
                 'Content-type': self.schema['account'],
                 },
-            data=json.dumps(dict(email=email, password=password)),
-            config=my_config,
+            data=self.codec.encode(dict(email=email, password=password)),
             )
-
-        # TODO: DRY this up
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not create account")
-        try:
-            parsed = json.loads(response.content)
-
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
         self.secret = parsed['resources']['account']['secret']
         capabilities = dict(session=parsed['capabilities'])
         for key, value in parsed['resources'].iteritems():
             capabilities[key] = value['capabilities']
-        self._unused_sessions.append(Session(self, parsed))
+        with self._lock:
+            self._unused_sessions.append(Session(self, parsed))
 
         return True
 
@@ -150,8 +407,8 @@ def require_channnel_collection(func):
     def decorated_instance_method(*args, **kwargs):
         # in instance methods, arg[0] will always be self
         zelf = args[0]
-        if not zelf.channel_collection:
-            zelf._get_channel_collection() # synchronous!
+        if zelf.channel_collection is None:
+            zelf.client.single_flight.do((zelf, 'load_channels'), zelf._load_channel_collection) # synchronous!
         return func(*args, **kwargs)
     return decorated_instance_method
 
@@ -162,205 +419,327 @@ class Session(object):
         # from it, like the other libraries
         self.client = client # has the schema and notification urls on it
 
-        self.session_resource = session_resource
+        self.resource = SessionResource(session_resource)
         self._channel_retries = {}
         self.channel_collection = None
-        self.subscription_collection = None
+        # Subscription objects by name, built when first asked for; only
+        # fetched from Spire when a subscription can't be created because it
+        # exists already, see _create_subscription
+        self.subscription_collection = ResourceCollection(
+            self._subscription, cache_size=SUBSCRIPTION_CACHE_SIZE, evictable=Subscription._stateless)
+        # Channel objects by name, least recently used first, so that getting
+        # a channel twice returns the same object
+        self.channel_cache_size = CHANNEL_CACHE_SIZE
+        self._channel_cache = collections.OrderedDict()
+        self._channel_lock = threading.RLock()
+
+    @property
+    def session_resource(self):
+        return self.resource.raw
+
+    @session_resource.setter
+    def session_resource(self, session_resource):
+        self.resource = SessionResource(session_resource)
 
     def _get_channel_collection(self):
-        response = requests.get(
-            self.session_resource['resources']['channels']['url'],
-            headers={
-                'Accept': self.client.schema['channels'],
-                'Authorization': "Capability %s" % self.get_capability('channels', 'all'),
-                },
+        parsed = self.client._request_json(
+            "Could not get channels",
+            'GET',
+            self.resource.channels_url,
+            operation='get_channels',
+            headers=self.resource.headers('channels', self.client.schema),
             )
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not refresh session: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
 
-        self.channel_collection = parsed
+        with self._channel_lock:
+            self.channel_collection = parsed
+            # keep cached objects, but with the server's current resources
+            for name, channel in self._channel_cache.items():
+                resource = parsed.get(name, None)
+                if resource is None:
+                    del self._channel_cache[name]
+                else:
+                    channel.channel_resource = resource
         return parsed
 
-    def _get_subscription_collection(self):
-        response = requests.get(
-            self.session_resource['resources']['subscriptions']['url'],
-            headers={
-                'Accept': self.client.schema['subscriptions'],
-                'Authorization': "Capability %s" % self.get_capability('subscriptions', 'all'),
-                },
-            )
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not refresh session: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
+    def _load_channel_collection(self):
+        if self.channel_collection is None:
+            self._get_channel_collection()
+
+    def _refresh_channel_collection(self):
+        # threads refreshing at once share one request
+        return self.client.single_flight.do((self, 'channels'), self._get_channel_collection)
 
-        self.subscription_collection = {}
-        for key, resource in parsed.iteritems():
-            self.subscription_collection[key] = Subscription(self.client, resource)
+    def _subscription(self, resource):
+        return Subscription(self.client, resource)
 
+    def _get_subscription_collection(self):
+        parsed = self.client._request_json(
+            "Could not get subscriptions",
+            'GET',
+            self.resource.subscriptions_url,
+            operation='get_subscriptions',
+            headers=self.resource.headers('subscriptions', self.client.schema),
+            )
+        self.subscription_collection.update(parsed)
         return parsed
 
     def _refresh(self):
         # If another session creates a channel after we get our session, and we
         # try to create the same channel, it will return 409 Conflict. This
         # method fetches the session and updates the ivars
-        #
-        # This is copypasta from above. TODO: refactor requests and parsing
-        response = requests.get(
-            self.session_resource['url'],
-            headers={
-                'Accept': self.client.schema['session'],
-                'Authorization': "Capability %s" % self.get_capability('session', 'get'),
-                },
+        parsed = self.client._request_json(
+            "Could not refresh session",
+            'GET',
+            self.resource.url,
+            operation='refresh_session',
+            headers=self.resource.headers('session', self.client.schema),
             )
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not refresh session: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
         self.session_resource = parsed
-        self._channel_retries = {}
+        with self._channel_lock:
+            self._channel_retries = {}
         return True
 
     def get_capability(self, key, method):
-        if key == 'session':
-            return self.session_resource['capabilities'].get(method, None)
-        else:
-            # TODO raise and handle exceptions here instead of returning None
-            resource = self.session_resource['resources'].get(key, None)
-            if resource:
-                return resource['capabilities'].get(method, None)
-            else:
-                return None
+        # TODO raise and handle exceptions here instead of returning None
+        return self.resource.capability(key, method)
+
+    def _cache_channel(self, name, channel):
+        with self._channel_lock:
+            self._channel_cache[name] = channel
+            while len(self._channel_cache) > self.channel_cache_size:
+                self._channel_cache.popitem(last=False)
+
+    def invalidate_channel(self, name):
+        """Forget the cached channel called `name`"""
+        with self._channel_lock:
+            self._channel_cache.pop(name, None)
+            if self.channel_collection is not None:
+                self.channel_collection.pop(name, None)
 
     @require_channnel_collection
     def set_channel(self, name, channel):
-        self.channel_collection[name] = channel
+        with self._channel_lock:
+            self.channel_collection[name] = channel.channel_resource
+            self._cache_channel(name, channel)
         return channel
 
     @require_channnel_collection
     def get_channel(self, name):
-        resource = self.channel_collection.get(name, None)
-        if resource is not None:
-            return Channel(self.client, self, resource) # cache objects
-        else:
-            return None
+        with self._channel_lock:
+            channel = self._channel_cache.pop(name, None)
+            if channel is None:
+                resource = self.channel_collection.get(name, None)
+                if resource is None:
+                    return None
+                channel = Channel(self.client, self, resource)
+            # (re)insert as the most recently used
+            self._cache_channel(name, channel)
+        return channel
 
     def channel(self, name=None, description=None): # None is the root channel
+        # The below is a workaround for a bug in Spire, and should be rendered
+        # unnecessary before the next beta release
+        if name is None:
+            name = 'everyone'
+
         # Short circuit alert!
         channel = self.get_channel(name)
         if channel is not None:
             return channel
+        # threads asking for the same new channel share one creation
+        return self.client.single_flight.do(
+            (self, 'channel', name), self._get_or_create_channel, name, description)
+
+    def _get_or_create_channel(self, name, description=None):
+        # another thread may have created it since we looked
+        channel = self.get_channel(name)
+        if channel is not None:
+            return channel
+        return self._create_channel(name, description)
 
+    def _create_channel(self, name, description=None):
         # TODO move this into the channel class to avoid repetition
         data = {}
-
-        # The below is a workaround for a bug in Spire, and should be rendered
-        # unnecessary before the next beta release
-        if name is None:
-            name = 'everyone'
-
         data['name'] = name
         if description is not None:
             data['description'] = description
 
-        response = requests.post(
-            self.session_resource['resources']['channels']['url'],
-            headers={
-                'Accept': self.client.schema['channel'],
-                'Content-type': self.client.schema['channel'],
-                'Authorization': "Capability %s" % self.get_capability('channels', 'create'),
-                },
-            data=json.dumps(data),
-            config=my_config,
+        response = self.client._request(
+            'POST',
+            self.resource.channels_url,
+            operation='create_channel',
+            headers=self.resource.headers('create_channel', self.client.schema),
+            data=self.client.codec.encode(data),
             )
 
-        # TODO: DRY this up
-        if not response: # XXX response is also falsy for 4xx
-            retries = self._channel_retries.get(name, 0)
-            if response.status_code == 409 and retries < MAX_CHANNEL_CREATE_RETRIES:
-                self._refresh()
+        if response.status_code == 409:
+            with self._channel_lock:
+                retries = self._channel_retries.get(name, 0)
                 self._channel_retries[name] = retries + 1
-                return self.channel(name, description)
-            else:
-                raise SpireClientException("Could not create channel")
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
-
+            if retries < MAX_CHANNEL_CREATE_RETRIES:
+                # Someone else created the channel since we last fetched the
+                # collection. Fetching the collection again is enough to find
+                # it; the session itself hasn't changed.
+                self.invalidate_channel(name)
+                self._refresh_channel_collection()
+                return self._get_or_create_channel(name, description)
+        parsed = self.client._parse(response, "Could not create channel")
+
+        with self._channel_lock:
+            self._channel_retries.pop(name, None)
         channel = Channel(self.client, self, parsed)
         self.set_channel(name, channel)
         return channel
 
-def require_subscription_collection(func):
-    """A decorator to fetch the parent session's subscription collection if
-    necessary. I do not like having this decorator walk up to self.session to
-    do this work. It could use a minor redesign but this library needs to work
-    when the next version of the API is deployed :)"""
-    def decorated_instance_method(*args, **kwargs):
-        # in instance methods, arg[0] will always be self
-        zelf = args[0]
-        if not zelf.session.subscription_collection:
-            zelf.session._get_subscription_collection() # synchronous!
-        return func(*args, **kwargs)
-    return decorated_instance_method
+    def channels(self, names, concurrency=CHANNEL_CREATE_CONCURRENCY, spawn=spawn_thread):
+        """Get or create the channels called `names`, returning them in the
+        same order. The channel collection is fetched once, and the channels
+        missing from it are created by up to `concurrency` threads (or
+        greenlets, given gevent's `spawn`) at once.
+        """
+        names = [name or 'everyone' for name in names]
+        self._refresh_channel_collection()
+
+        found = {}
+        missing = []
+        for name in names:
+            channel = self.get_channel(name)
+            if channel is None:
+                if name not in missing:
+                    missing.append(name)
+            else:
+                found[name] = channel
+
+        if missing:
+            queue = Queue.Queue()
+            for name in missing:
+                queue.put(name)
+            errors = []
+
+            def _worker():
+                while True:
+                    try:
+                        name = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        found[name] = self.channel(name)
+                    except Exception, e:
+                        errors.append(e)
+
+            workers = [spawn(_worker) for i in range(min(concurrency, len(missing)))]
+            for worker in workers:
+                worker.join()
+            if errors:
+                raise errors[0]
+
+        return [found[name] for name in names]
+
+    def _create_subscription(self, channel_urls, name, expiration=None):
+        response = self.client._request(
+            'POST',
+            self.resource.subscriptions_url,
+            operation='create_subscription',
+            headers=self.resource.headers('create_subscription', self.client.schema),
+            data=self.client.codec.encode(dict(
+                    channels=channel_urls,
+                    name=name,
+                    expiration=expiration
+                    )),
+            )
+
+        if response.status_code == 409:
+            # It exists already, so it must be in the collection, which is
+            # only fetched now rather than before every first subscribe
+            self.client.single_flight.do((self, 'subscriptions'), self._get_subscription_collection)
+            subscription = self.subscription_collection.get(name, None)
+            if subscription is not None:
+                return subscription
+        parsed = self.client._parse(response, "Could not subscribe")
+
+        subscription = Subscription(self.client, parsed) # boooo
+        self.subscription_collection[name] = subscription
+        return subscription
+
+    def subscription(self, name, channel_urls, expiration=None):
+        """Get the subscription called `name`, creating it for the channels
+        at `channel_urls` if it doesn't exist yet"""
+        subscription = self.subscription_collection.get(name, None)
+        if subscription is None:
+            # threads asking for the same new subscription share one creation
+            subscription = self.client.single_flight.do(
+                (self, 'subscription', name),
+                self._get_or_create_subscription, name, channel_urls, expiration)
+        return subscription
+
+    def _get_or_create_subscription(self, name, channel_urls, expiration=None):
+        subscription = self.subscription_collection.get(name, None)
+        if subscription is None:
+            subscription = self._create_subscription(channel_urls, name, expiration)
+        return subscription
+
+    def subscribe_many(self, channels, name=None, expiration=None):
+        """Get or create one subscription, called `name`, to all of
+        `channels` (Channel objects, or names of channels to get or create),
+        so they can be watched with a single long-poll instead of one each.
+
+        Each event says which channel it came from in `channel_name`; a
+        Dispatcher keyed on it hands events to per-channel handlers:
+
+            subscription = session.subscribe_many(['deploys', 'alerts'], name='ops')
+            dispatcher = spire.Dispatcher(key=spire.dispatch.channel_name)
+            dispatcher.on('deploys', handle_deploy)
+            dispatcher.on('alerts', handle_alert)
+            subscription.subscribe(callback=dispatcher)
+
+        Without `name`, the name is derived from the channels, so asking for
+        the same channels again returns the same subscription.
+        """
+        names = [c for c in channels if not isinstance(c, Channel)]
+        if names:
+            by_name = dict(zip(names, self.channels(names)))
+            channels = [c if isinstance(c, Channel) else by_name[c] for c in channels]
+        urls = []
+        for channel in channels:
+            if channel.resource.url not in urls:
+                urls.append(channel.resource.url)
+        if name is None:
+            name = "default-%s" % hashlib.sha1(" ".join(sorted(urls))).hexdigest()[:16]
+
+        return self.subscription(name, urls, expiration)
 
 class Channel(object):
+    # sessions cache up to CHANNEL_CACHE_SIZE of these
+    __slots__ = ('client', 'session', 'resource', 'last_timestamp')
+
     def __init__(self, client, session, channel_resource):
         self.client = client
         self.session = session
-        self.channel_resource = channel_resource
+        self.resource = ChannelResource(channel_resource)
         self.last_timestamp = None
 
-    @require_subscription_collection
+    @property
+    def channel_resource(self):
+        return self.resource.raw
+
+    @channel_resource.setter
+    def channel_resource(self, channel_resource):
+        self.resource = ChannelResource(channel_resource)
+
     def _create_subscription(self, name=None, expiration=None):
         if name is None:
             name = 'default'
-        response = requests.post(
-            self.session.session_resource['resources']['subscriptions']['url'],
-            headers={
-                'Accept': self.client.schema['subscription'],
-                'Content-type': self.client.schema['subscription'],
-                'Authorization': "Capability %s" % self.session.get_capability('subscriptions', 'create'),
-                },
-            data=json.dumps(dict(
-                    channels=[self.channel_resource['url']],
-                    name=name,
-                    expiration=expiration
-                    )),
-            config=my_config,
-            )
-        if not response: # XXX response is also falsy for 4xx
-            # if response.status_code == 409:
-            #     pass
-            # else:
-            raise SpireClientException("Could not subscribe: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire subscription endpoint returned invalid JSON")
-
-        subscription = Subscription(self.client, parsed) # boooo
-        self.session.subscription_collection[name] = subscription
-        return subscription
+        return self.session._create_subscription([self.resource.url], name, expiration)
 
-    @require_subscription_collection
-    def subscribe(self, name=None, last_timestamp=None, callback=None, timeout=None):
+    def subscription(self, name=None):
+        """Get the subscription to this channel called `name`, creating it
+        if it doesn't exist yet"""
         if name is None:
-            print self.channel_resource
-            name = "default-%s" % self.channel_resource['name']
-        subscription = self.session.subscription_collection.get(name, None)
-        if subscription is None:
-            subscription = self._create_subscription(name=name, timeout=timeout)
+            name = "default-%s" % self.resource.name
+        return self.session.subscription(name, [self.resource.url])
 
+    def subscribe(self, name=None, last_timestamp=None, callback=None, timeout=None):
+        subscription = self.subscription(name)
         return self._on(
             subscription,
             last_timestamp=last_timestamp,
@@ -376,7 +755,7 @@ class Channel(object):
         """
         If `callback` is not present, this is synchronous with long timeouts,
         and connections that are reopened when they die. If `callback` *is*
-        present, we attempt to use requests' gevent support.
+        present, it is called with the parsed events once they arrive.
 
         This method is a proxy for the Subscription class'
         `subscribe` method.
@@ -387,124 +766,332 @@ class Channel(object):
             )
 
     def delete(self):
-        response = requests.delete(
-            self.channel_resource['url'],
-            headers={
-                'Authorization': "Capability %s" % self.channel_resource['capabilities'].get('delete', None),
-                },
+        response = self.client._request(
+            'DELETE',
+            self.resource.url,
+            operation='delete_channel',
+            headers=self.resource.headers('delete', self.client.schema),
             )
         if not response: # XXX response is also falsy for 4xx
             raise SpireClientException("Failed to delete channel: %i" % response.status_code)
 
 
-    def publish(self, message):
-        content_type = self.client.schema['message']
+    def _publish_headers(self):
+        return self.resource.headers('publish', self.client.schema)
 
-        response = requests.post(
-            self.channel_resource['url'],
-            headers={
-                'Accept': content_type,
-                'Content-type': content_type,
-                'Authorization': "Capability %s" % self.channel_resource['capabilities'].get('publish', None),
-                },
-            data=json.dumps(dict(content=message)),
-            config=my_config,
+    def publish(self, message):
+        data = self.client._encode_message(dict(content=message))
+        encoding = None
+        if self.client.compression is not None:
+            data, encoding = self.client.compression.compress(data)
+        return self.client._request_json(
+            "Could not publish",
+            'POST',
+            self.resource.url,
+            operation='publish',
+            headers=self.client._encoding_headers(self._publish_headers(), encoding),
+            data=data,
             )
 
-        # TODO: DRY this up
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not publish: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire channel endpoint returned invalid JSON")
+    def publish_many(self, messages, window=PUBLISH_PIPELINE_WINDOW):
+        """Publish every message in the iterable `messages`, in order, and
+        return the list of parsed message resources in the same order.
+
+        The messages are sent one after the other over a keep-alive
+        connection. If the client was created with `pipelining=True`, up to
+        `window` requests at a time are pipelined over one connection instead
+        of waiting for the reply to each; the server handles the requests on
+        a connection in turn, so the messages are still published in order.
+
+        Publishing stops after the first message (or pipelined window) with a
+        failure, and a SpireClientException for the first failure is raised.
+        Its `results` is a list of `(resource, error)` pairs, one of them
+        None, for each message up to the last one tried, in order; later
+        messages were not sent. A message sent without an answer is reported
+        with the transport error, and may have been published.
+
+        With compression on, a pipelined window is compressed if any of its
+        messages is over the compression threshold, since the requests share
+        headers.
+        """
+        client = self.client
+        url = self.resource.url
+        compression = client.compression
+        headers = client._encoding_headers(self._publish_headers())
+        compressed_headers = None
+        if compression is not None:
+            compressed_headers = client._encoding_headers(
+                self._publish_headers(), compression.encoding)
+        if not client.pipelining:
+            window = 1
+        results = []
+
+        def _result(response):
+            try:
+                return client._parse(response, "Could not publish"), None
+            except SpireClientException, e:
+                return None, e
+
+        def _send(body):
+            headers_sent = headers
+            if compression is not None:
+                body, encoding = compression.compress(body)
+                if encoding is not None:
+                    headers_sent = compressed_headers
+            try:
+                response = client._request(
+                    'POST', url, operation='publish_many', headers=headers_sent, data=body)
+            except SpireClientException, e:
+                results.append((None, e))
+            else:
+                results.append(_result(response))
+
+        def _send_pipelined(bodies):
+            headers_sent = headers
+            if compression is not None and max(len(body) for body in bodies) >= compression.threshold:
+                bodies = [compression.compress(body, force=True)[0] for body in bodies]
+                headers_sent = compressed_headers
+            while bodies:
+                try:
+                    responses = client._pipeline(
+                        'POST', url, bodies, operation='publish_many', headers=headers_sent)
+                except SpireClientException, e:
+                    # the messages answered before the connection failed
+                    # have their own outcome; the rest are unknown
+                    responses = getattr(e, 'responses', ())
+                    results.extend(_result(response) for response in responses)
+                    results.extend((None, e) for body in bodies[len(responses):])
+                    return
+                if not responses:
+                    e = SpireClientException("Could not publish: connection closed")
+                    results.extend((None, e) for body in bodies)
+                    return
+                results.extend(_result(response) for response in responses)
+                # the server may close the connection part way through a
+                # window, in which case the rest is sent again
+                bodies = bodies[len(responses):]
+
+        def _flush(bodies):
+            """Send `bodies`, returning the first error among their results"""
+            start = len(results)
+            if window == 1:
+                for body in bodies:
+                    _send(body)
+            elif bodies:
+                _send_pipelined(bodies)
+            for resource, error in results[start:]:
+                if error is not None:
+                    return error
+
+        error = None
+        bodies = []
+        for message in messages:
+            try:
+                bodies.append(client._encode_message(dict(content=message)))
+            except SpireClientException, e:
+                # send the messages before it, then report it as failed
+                error = _flush(bodies) or e
+                results.append((None, e))
+                break
+            if len(bodies) >= window:
+                error = _flush(bodies)
+                bodies = []
+                if error is not None:
+                    break
+        else:
+            error = _flush(bodies)
 
-        return parsed
+        if error is not None:
+            error.results = results
+            raise error
+        return [resource for resource, error in results]
 
     def subscriptions(self):
-        response = requests.get(
-            self.channel_resource['resources']['subscriptions']['url'],
-            headers={
-                'Accept': self.client.schema['subscriptions'],
-                'Authorization': "Capability %s" % self.channel_resource['resources']['subscriptions']['capabilities']['get_subscriptions']
-                },
+        parsed = self.client._request_json(
+            "Could not get subscriptions for channel",
+            'GET',
+            self.resource.subscriptions_url,
+            operation='get_channel_subscriptions',
+            headers=self.resource.headers('subscriptions', self.client.schema),
             )
-        if not response: # XXX response is also falsy for 4xx
-            raise SpireClientException("Could not get subscripions for channel: %i" % response.status_code)
-        try:
-            parsed = json.loads(response.content)
-        except (ValueError, KeyError):
-            raise SpireClientException("Spire endpoint returned invalid JSON")
-
-        subscriptions= {}
-        for key, resource in parsed.iteritems():
-            subscriptions[key] = Subscription(self.client, resource)
 
-        return subscriptions
+        # built into Subscription objects as they are asked for
+        return ResourceCollection(
+            lambda resource: Subscription(self.client, resource),
+            parsed,
+            evictable=Subscription._stateless,
+            )
 
 class Subscription(object):
     def __init__(self, client, subscription_resource):
         self.client = client
-        self.subscription_resource = subscription_resource
+        self.resource = SubscriptionResource(subscription_resource)
         self.last_timestamp = None
+        self.checkpointer = None
+        # decides the timeout, page size and spacing of long-polls; see
+        # spire.polling.AdaptivePolling
+        self.polling = self._default_polling = FixedPolling()
+        self._handed_out = None # (last, event count) of the last page returned
+
+    def _stateless(self):
+        """True until the subscription has polled or been given a checkpoint
+        or polling strategy, i.e. while a new object for it would be no
+        different. Collections only let go of stateless subscriptions."""
+        return (
+            self.last_timestamp is None
+            and self._handed_out is None
+            and self.checkpointer is None
+            and self.polling is self._default_polling
+            )
 
-    def subscribe(
-        self,
-        last_timestamp=None,
-        callback=None,
-        ):
-        response = None
-        tries = 0
-        params = {
-            "timeout": SUBSCRIBE_MAX_TIMEOUT,
-            "order-by": "asc",
-            }
-
-        request_kwargs = dict(
-            headers={
-                'Accept': self.client.schema['events'],
-                'Authorization': "Capability %s" % self.subscription_resource['capabilities'].get('events', None),
-                },
-            timeout=SUBSCRIBE_MAX_TIMEOUT+1,
+    @property
+    def subscription_resource(self):
+        return self.resource.raw
+
+    @subscription_resource.setter
+    def subscription_resource(self, subscription_resource):
+        self.resource = SubscriptionResource(subscription_resource)
+
+    def checkpoint_to(self, store, key=None, every=None, interval=CHECKPOINT_INTERVAL):
+        """Save this subscription's position to the checkpoint `store` (see
+        spire.checkpoint) after every `every` processed events or every
+        `interval` seconds. If the store already has a position for `key`
+        (the subscription URL by default) polling resumes from it.
+
+        With `subscribe`, a page counts as processed once the callback
+        returns, or once `subscribe` is called again. With `events`, an event
+        counts as processed when the consumer asks for the next one.
+        """
+        if key is None:
+            key = self.resource.url
+        self.checkpointer = Checkpointer(store, key, every=every, interval=interval)
+        stored = self.checkpointer.load()
+        if stored is not None and not self.last_timestamp:
+            self.last_timestamp = stored
+        return self.checkpointer
+
+    def poll_with(self, polling):
+        """Use the `polling` strategy (see spire.polling) to choose the
+        timeout, page size and spacing of this subscription's long-polls"""
+        self.polling = polling
+        return polling
+
+    def checkpoint(self):
+        """Save the position of the last processed event right away, e.g.
+        before shutting down"""
+        if self.checkpointer is not None:
+            self.checkpointer.flush()
+            self.checkpointer.store.flush()
+
+    def _discard_page(self):
+        """Forget the page `subscribe` handed out last without counting it
+        as processed, for callers that drop it"""
+        self._handed_out = None
+
+    def _processed(self, timestamp, count):
+        if self.checkpointer is not None:
+            self.checkpointer.processed(timestamp, count)
+
+    def _events_request(self):
+        """The arguments for a long-poll request, minus the `last` param"""
+        params = self.polling.params()
+        params["order-by"] = "asc"
+        return dict(
+            headers=self.client._encoding_headers(
+                self.resource.headers('events', self.client.schema)),
+            timeout=params["timeout"]+1,
             params=params,
-            config=my_config,
             )
 
+    def _poll(self, last_timestamp):
+        started = time.time()
+        delay = self.polling.delay()
+        if delay:
+            # let events accumulate so they arrive in one page
+            self.client.pipeline.sleep(delay)
+        request_kwargs = self._events_request()
+        request_kwargs['params']['last'] = last_timestamp
+        # failed polls are retried, with backoff, by the client's pipeline
+        # TODO: 409 handling here
+        parsed = self.client._request_json(
+            "Could not subscribe",
+            'GET',
+            self.resource.url,
+            operation='subscribe',
+            **request_kwargs
+            )
+        messages = parsed.get('messages')
+        if messages:
+            # the newest event, whatever order the page is in
+            parsed['last'] = max(parsed.get('last', 0), max(m['timestamp'] for m in messages))
+        self.polling.observe(len(parsed.get('messages', ())), time.time() - started)
+        return parsed
+
+    def poll(self, last_timestamp=None):
+        """Long-poll for the page of events after `last_timestamp` (or after
+        the last page fetched) and return it. Unlike `subscribe`, this never
+        counts anything as processed for checkpoints; callers that checkpoint
+        report progress themselves."""
         if last_timestamp is None:
             if not self.last_timestamp:
                 self.last_timestamp = 0
         else:
             self.last_timestamp = last_timestamp
 
-        params['last'] = self.last_timestamp
+        parsed = self._poll(self.last_timestamp)
+        self.last_timestamp = parsed['last']
+        return parsed
+
+    def subscribe(
+        self,
+        last_timestamp=None,
+        callback=None,
+        ):
+        if self._handed_out is not None:
+            # asking for more means the page handed out last was processed
+            self._processed(*self._handed_out)
+            self._handed_out = None
+        elif self.checkpointer is not None:
+            self.checkpointer.tick()
+
+        parsed = self.poll(last_timestamp)
+        count = len(parsed.get('messages', []))
 
         if callback is not None:
-            assert self.client.async
-            def wrapped_callback(response):
-                try:
-                    parsed = json.loads(response.content)
-                except (ValueError, KeyError):
-                    raise SpireClientException("Spire subscribe endpoint returned invalid JSON")
-                return callback(parsed)
-
-            request_kwargs['hooks'] = dict(response=wrapped_callback)
-            request = r_async.get(self.subscription_resource['url'], **request_kwargs)
-            r_async.map([request])
+            callback(parsed)
+            if count:
+                self._processed(parsed['last'], count)
             return True
-        else:
-            while not response and tries < 5: # TODO remove tries
-                tries = tries + 1
-                # todo throttle fast reconnects
-                response = requests.get(self.subscription_resource['url'], **request_kwargs)
-
-            # TODO: DRY this up
-            # TODO: 409 handling here
-            if not response: # XXX response is also falsy for 4xx
-                raise SpireClientException("Could not subscribe: %i" % response.status_code)
-            try:
-                parsed = json.loads(response.content)
-            except (ValueError, KeyError):
-                raise SpireClientException("Spire subscribe endpoint returned invalid JSON")
-            self.last_timestamp = parsed['last']
+        if count:
+            self._handed_out = (parsed['last'], count)
+        return parsed
 
-            return parsed
+    def events(self, last_timestamp=None):
+        """A generator yielding events (messages) one at a time, forever.
+
+        Each long-poll is issued as soon as the previous page has been
+        consumed, picking up after the last event yielded. Only one page of
+        events is held at a time. `self.last_timestamp` is the timestamp of the
+        last event yielded, so a consumer that stops part way through a page
+        can resume later without losing the rest of it. When the generator is
+        closed, pending checkpoints are saved (see `checkpoint_to`).
+        """
+        if last_timestamp is not None:
+            self.last_timestamp = last_timestamp
+        elif not self.last_timestamp:
+            self.last_timestamp = 0
+
+        try:
+            while True:
+                page = self._poll(self.last_timestamp)
+                for message in events_in_order(page):
+                    self.last_timestamp = message['timestamp']
+                    yield message
+                    self._processed(message['timestamp'], 1)
+                if page['last'] > self.last_timestamp:
+                    self.last_timestamp = page['last']
+                page = None # don't keep it alive during the next long-poll
+                if self.checkpointer is not None:
+                    self.checkpointer.tick()
+        finally:
+            self.checkpoint()
@@ -0,0 +1,110 @@
+"""
+Caching of the discovery document (resources and schema) that every client
+fetches from its base URL before doing anything else.
+"""
+import os
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DISCOVERY_TTL = 300
+
+class DiscoveryEntry(object):
+    def __init__(self, document, etag=None, fetched_at=None):
+        self.document = document
+        self.etag = etag
+        if fetched_at is None:
+            fetched_at = time.time()
+        self.fetched_at = fetched_at
+
+    def to_dict(self):
+        return dict(document=self.document, etag=self.etag, fetched_at=self.fetched_at)
+
+class DiscoveryCache(object):
+    """Discovery documents keyed by base URL.
+
+    Entries younger than `ttl` seconds are used without asking the server.
+    Older entries are revalidated with `If-None-Match`, so an unchanged
+    document costs a 304 rather than a full download. If `path` is given the
+    cache is also kept in that JSON file, which lets short-lived processes skip
+    discovery entirely when a recent process already did it.
+    """
+    def __init__(self, ttl=DISCOVERY_TTL, path=None):
+        self.ttl = ttl
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            self._read()
+
+    def _read(self):
+        try:
+            fp = open(self.path)
+            try:
+                stored = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return # missing or unreadable cache files are ignored
+        for base_url, entry in stored.items():
+            self._entries[base_url] = DiscoveryEntry(**dict(
+                    (str(key), value) for key, value in entry.items()))
+
+    def _write(self):
+        stored = dict(
+            (base_url, entry.to_dict()) for base_url, entry in self._entries.items())
+        tmp_path = "%s.%i.tmp" % (self.path, os.getpid())
+        try:
+            fp = open(tmp_path, 'w')
+            try:
+                json.dump(stored, fp)
+            finally:
+                fp.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass # the cache is only an optimisation
+
+    def get(self, base_url):
+        """The entry for `base_url`, fresh or not, or None"""
+        with self._lock:
+            return self._entries.get(base_url, None)
+
+    def is_fresh(self, entry):
+        return entry is not None and time.time() - entry.fetched_at < self.ttl
+
+    def put(self, base_url, document, etag=None):
+        with self._lock:
+            self._entries[base_url] = DiscoveryEntry(document, etag)
+            if self.path is not None:
+                self._write()
+
+    def preload(self, base_url, document, etag=None):
+        """Seed the cache with a discovery document, e.g. one shipped with an
+        application's configuration, so clients don't fetch it at start up"""
+        self.put(base_url, document, etag)
+
+    def revalidated(self, base_url):
+        """Mark the entry for `base_url` as fresh again after a 304"""
+        with self._lock:
+            entry = self._entries.get(base_url, None)
+            if entry is not None:
+                entry.fetched_at = time.time()
+                if self.path is not None:
+                    self._write()
+
+    def invalidate(self, base_url=None):
+        with self._lock:
+            if base_url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(base_url, None)
+            if self.path is not None:
+                self._write()
+
+# Shared by every Client that isn't given a cache of its own. Set
+# SPIRE_DISCOVERY_CACHE to a file path to persist it across processes.
+shared_cache = DiscoveryCache(path=os.environ.get('SPIRE_DISCOVERY_CACHE', None))
@@ -0,0 +1,125 @@
+"""
+Routing events to handlers on the client side.
+
+A `Dispatcher` sends each event to the handlers registered for it, looking at
+every event once however many handlers there are. Handlers can be registered
+for a routing key, which is computed once per event and looked up in a dict,
+or for a predicate. Spire has no server-side filtering, so every event on the
+subscription is still downloaded.
+
+    dispatcher = spire.Dispatcher(key=spire.dispatch.content_prefix(':'))
+    dispatcher.on('report', print_report)
+    dispatcher.route(lambda event: event['content'] == 'getVersion', report_version)
+
+    subscription.subscribe(callback=dispatcher) # a page at a time
+    for event in subscription.events():         # or an event at a time
+        dispatcher.dispatch(event)
+"""
+from resources import events_in_order
+
+def content_prefix(separator=':'):
+    """A routing key function returning the part of an event's (string)
+    content before `separator`, or the whole content if there is none"""
+    def _key(event):
+        content = event.get('content', None)
+        if not isinstance(content, basestring):
+            return None
+        return content.split(separator, 1)[0]
+    return _key
+
+def channel_name(event):
+    """A routing key function returning the name of the channel an event was
+    published on, for subscriptions to several channels (see
+    `Session.subscribe_many`)"""
+    return event.get('channel_name', None)
+
+def content_field(name):
+    """A routing key function returning the field `name` of an event whose
+    content is a dict"""
+    def _key(event):
+        content = event.get('content', None)
+        if not isinstance(content, dict):
+            return None
+        return content.get(name, None)
+    return _key
+
+class Route(object):
+    def __init__(self, predicate, handler):
+        self.predicate = predicate
+        self.handler = handler
+        self.matched = 0
+
+class Dispatcher(object):
+    """Calls, for each event, the handlers registered for its routing key
+    (see `on`) and then those whose predicate it satisfies (see `route`), in
+    the order they were registered. Events no handler wanted go to the
+    `default` handler, if any.
+
+    A dispatcher is also a callback for `Subscription.subscribe` and
+    `SubscriptionManager.add`, dispatching each event of the page it is given.
+    """
+    def __init__(self, key=None, default=None):
+        self.key = key
+        self.default = default
+        self.keyed = {} # routing key -> [Route]
+        self.routes = []
+        self.events = 0
+        self.unmatched = 0
+
+    def on(self, key, handler=None):
+        """Call `handler(event)` for events whose routing key is `key`.
+        Without `handler`, returns a decorator registering the function it
+        decorates."""
+        if self.key is None:
+            raise ValueError("Dispatcher needs a key function for routing keys")
+        if handler is None:
+            return lambda handler: self.on(key, handler)
+        self.keyed.setdefault(key, []).append(Route(None, handler))
+        return handler
+
+    def route(self, predicate, handler=None):
+        """Call `handler(event)` for events for which `predicate(event)` is
+        true. Like `on`, can be used as a decorator."""
+        if handler is None:
+            return lambda handler: self.route(predicate, handler)
+        self.routes.append(Route(predicate, handler))
+        return handler
+
+    def dispatch(self, event):
+        """Dispatch one event, returning the number of handlers called"""
+        self.events += 1
+        called = 0
+        if self.keyed:
+            for route in self.keyed.get(self.key(event), ()):
+                route.matched += 1
+                route.handler(event)
+                called += 1
+        for route in self.routes:
+            if route.predicate(event):
+                route.matched += 1
+                route.handler(event)
+                called += 1
+        if not called:
+            self.unmatched += 1
+            if self.default is not None:
+                self.default(event)
+        return called
+
+    def dispatch_page(self, page):
+        """Dispatch every event of a page returned by
+        `Subscription.subscribe`, oldest first"""
+        for event in events_in_order(page):
+            self.dispatch(event)
+
+    __call__ = dispatch_page
+
+    def stats(self):
+        return dict(
+            events=self.events,
+            unmatched=self.unmatched,
+            keys=dict(
+                (key, sum(route.matched for route in routes))
+                for key, routes in self.keyed.items()
+                ),
+            routes=[route.matched for route in self.routes],
+            )
@@ -0,0 +1,12 @@
+class SpireClientException(Exception):
+    """Base class for spire client exceptions"""
+
+
+class CircuitOpenError(SpireClientException):
+    """Raised instead of sending a request to a host whose circuit breaker is
+    open because recent requests to it kept failing"""
+
+
+class PayloadTooLarge(SpireClientException):
+    """Raised instead of publishing a message whose encoded size is over the
+    client's `max_payload`, or when Spire rejects a request as too large"""
@@ -0,0 +1,230 @@
+"""
+Evented versions of the client classes, built on gevent.
+
+`AsyncClient`, `AsyncSession`, `AsyncChannel` and `AsyncSubscription` mirror
+the blocking classes in spire.core, but every method that talks to Spire
+spawns a greenlet and returns it immediately. Call `.get()` on the greenlet to
+wait for (and return) its result, or pass a list of them to `gevent.joinall`.
+Because the underlying sockets are gevent sockets, thousands of long-polls can
+be in flight at once in a single process:
+
+    client = AsyncClient(secret=secret)
+    session = client.session().get()
+    channels = [g.get() for g in [session.channel(name) for name in names]]
+    polls = [c.subscribe(callback=handle_events) for c in channels]
+    gevent.joinall(polls)
+
+Requires gevent; `import spire` works without it, but these classes are then
+not available.
+"""
+import httplib
+
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.socket
+try:
+    import gevent.ssl as gevent_ssl
+    from gevent.ssl import create_default_context
+except ImportError:
+    gevent_ssl = None # no SSL support, so no https
+
+from consumer import QUEUE_SIZE, QueueConsumer
+from core import Client, Subscription
+from manager import SubscriptionManager
+from singleflight import SingleFlight
+from transport import PooledTransport
+
+class GeventHTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        self.sock = gevent.socket.create_connection((self.host, self.port), self.timeout)
+
+_connection_classes = {'http': GeventHTTPConnection}
+
+if gevent_ssl is not None:
+    class GeventHTTPSConnection(httplib.HTTPSConnection):
+        """Like httplib's, verifies the server's certificate and hostname
+        (sending it with SNI) unless given a `context` that doesn't"""
+        def __init__(self, host, port=None, key_file=None, cert_file=None, context=None, **kwargs):
+            if context is None:
+                context = create_default_context()
+            httplib.HTTPSConnection.__init__(
+                self, host, port, key_file, cert_file, context=context, **kwargs)
+
+        def connect(self):
+            sock = gevent.socket.create_connection((self.host, self.port), self.timeout)
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+    _connection_classes['https'] = GeventHTTPSConnection
+
+class GeventTransport(PooledTransport):
+    """A `PooledTransport` whose connections use gevent sockets, so waiting
+    on the network yields to other greenlets instead of blocking the process"""
+    connection_classes = _connection_classes
+
+class AsyncClient(object):
+    """Wraps a `Client` using a `GeventTransport`. Attributes not defined here
+    (`resources`, `schema`, `secret`...) are those of the wrapped client."""
+    def __init__(self, base_url='http://api.spire.io', secret=None, transport=None):
+        if transport is None:
+            transport = GeventTransport()
+        self.client = Client(base_url, secret=secret, async=True, transport=transport)
+        self.client.pipeline.sleep = gevent.sleep # back off without blocking the hub
+        # greenlets waiting for a shared fetch must yield to the hub
+        self.client.single_flight = SingleFlight(event_class=gevent.event.Event)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def discover(self):
+        return gevent.spawn(self.client._discover)
+
+    def _session(self):
+        return AsyncSession(self, self.client.session())
+
+    def session(self):
+        """Spawns a greenlet returning an `AsyncSession`"""
+        return gevent.spawn(self._session)
+
+    def _bootstrap(self, channels, subscriptions):
+        session = self.client.bootstrap(channels, subscriptions, spawn=gevent.spawn)
+        return AsyncSession(self, session)
+
+    def bootstrap(self, channels=(), subscriptions=False):
+        """Spawns a greenlet running `Client.bootstrap`, with its concurrent
+        steps in greenlets, and returning an `AsyncSession`"""
+        return gevent.spawn(self._bootstrap, channels, subscriptions)
+
+    def create_account(self, email, password):
+        return gevent.spawn(self.client.create_account, email, password)
+
+class AsyncSession(object):
+    def __init__(self, client, session):
+        self.client = client
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def _channel(self, name, description):
+        return AsyncChannel(self.client, self.session.channel(name, description))
+
+    def channel(self, name=None, description=None):
+        """Spawns a greenlet returning an `AsyncChannel`"""
+        return gevent.spawn(self._channel, name, description)
+
+class AsyncChannel(object):
+    def __init__(self, client, channel):
+        self.client = client
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def publish(self, message):
+        return gevent.spawn(self.channel.publish, message)
+
+    def publish_many(self, messages, **kwargs):
+        return gevent.spawn(self.channel.publish_many, messages, **kwargs)
+
+    def _subscription(self, name):
+        return AsyncSubscription(self.client, self.channel.subscription(name))
+
+    def subscription(self, name=None):
+        """Spawns a greenlet returning an `AsyncSubscription`"""
+        return gevent.spawn(self._subscription, name)
+
+    def subscribe(self, name=None, last_timestamp=None, callback=None):
+        return gevent.spawn(
+            self.channel.subscribe,
+            name=name,
+            last_timestamp=last_timestamp,
+            callback=callback,
+            )
+
+    def delete(self):
+        return gevent.spawn(self.channel.delete)
+
+class AsyncSubscription(object):
+    def __init__(self, client, subscription):
+        self.client = client
+        if not isinstance(subscription, Subscription):
+            # a subscription resource, e.g. from another process
+            subscription = Subscription(client.client, subscription)
+        self.subscription = subscription
+
+    def __getattr__(self, name):
+        return getattr(self.subscription, name)
+
+    def subscribe(self, last_timestamp=None, callback=None):
+        """Spawns a greenlet that long-polls for events and returns them (or
+        calls `callback` with them and returns True)"""
+        return gevent.spawn(
+            self.subscription.subscribe,
+            last_timestamp=last_timestamp,
+            callback=callback,
+            )
+
+    def events(self, last_timestamp=None):
+        """The generator from `Subscription.events`. Iterating it only blocks
+        the current greenlet."""
+        return self.subscription.events(last_timestamp=last_timestamp)
+
+    def _listen(self, callback, last_timestamp):
+        for event in self.subscription.events(last_timestamp=last_timestamp):
+            callback(event)
+
+    def listen(self, callback, last_timestamp=None):
+        """Spawns a greenlet that calls `callback` with each event as it
+        arrives, until the greenlet is killed"""
+        return gevent.spawn(self._listen, callback, last_timestamp)
+
+class EventedSubscriptionManager(SubscriptionManager):
+    """A `SubscriptionManager` that polls from greenlets rather than threads.
+    `add` also accepts `AsyncSubscription` objects."""
+    def __init__(self, on_error=None):
+        SubscriptionManager.__init__(
+            self,
+            spawn=gevent.spawn,
+            sleep=gevent.sleep,
+            on_error=on_error,
+            )
+
+    def add(self, subscription, callback, last_timestamp=None):
+        if isinstance(subscription, AsyncSubscription):
+            subscription = subscription.subscription
+        return SubscriptionManager.add(self, subscription, callback, last_timestamp)
+
+    def remove(self, subscription):
+        if isinstance(subscription, AsyncSubscription):
+            subscription = subscription.subscription
+        return SubscriptionManager.remove(self, subscription)
+
+class EventedQueueConsumer(QueueConsumer):
+    """A `QueueConsumer` whose poller and workers are greenlets. Accepts
+    `AsyncSubscription` objects too."""
+    def __init__(
+        self,
+        subscription,
+        handler,
+        maxsize=QUEUE_SIZE,
+        workers=1,
+        partition=None,
+        on_error=None,
+        acknowledge_errors=False,
+        ):
+        if isinstance(subscription, AsyncSubscription):
+            subscription = subscription.subscription
+        QueueConsumer.__init__(
+            self,
+            subscription,
+            handler,
+            maxsize=maxsize,
+            workers=workers,
+            partition=partition,
+            on_error=on_error,
+            acknowledge_errors=acknowledge_errors,
+            spawn=gevent.spawn,
+            sleep=gevent.sleep,
+            queue_class=gevent.queue.Queue,
+            )
@@ -0,0 +1,593 @@
+"""
+An in-process fake of the Spire API, for running the client without a network.
+
+`FakeSpireServer` serves discovery, accounts, sessions, channels,
+subscriptions, publishing and long-polled events from memory, on a local port
+in a background thread. Capabilities are checked like the real service checks
+them, and every response can be delayed to simulate a remote server:
+
+    server = FakeSpireServer(latency=0.02, jitter=0.01).start()
+    client = spire.Client(server.url, secret=server.create_account())
+    client.session().channel('foo').publish('bar')
+    server.stop()
+"""
+import BaseHTTPServer
+import cgi
+import itertools
+import random
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from compression import COMPRESS_THRESHOLD, ENCODINGS, compress, decompress
+
+MAX_TIMEOUT = 30
+
+MEDIA_TYPES = dict(
+    (name, 'application/vnd.spire-io.%s+json;version=1.0' % name)
+    for name in (
+        'account', 'accounts', 'session', 'sessions', 'channel', 'channels',
+        'subscription', 'subscriptions', 'events', 'message',
+        )
+    )
+
+def _capability():
+    return uuid.uuid4().hex
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class _Account(object):
+    def __init__(self, id, email=None, password=None):
+        self.id = id
+        self.secret = _capability()
+        self.email = email
+        self.password = password
+        self.channels = {} # by name
+        self.subscriptions = {} # by name
+
+class _Channel(object):
+    def __init__(self, account, id, name, description=None):
+        self.account = account
+        self.id = id
+        self.name = name
+        self.description = description
+        self.messages = [] # ascending by timestamp
+        self.capabilities = dict(
+            get=_capability(),
+            publish=_capability(),
+            delete=_capability(),
+            get_subscriptions=_capability(),
+            )
+
+class _Subscription(object):
+    def __init__(self, account, id, name, channels, expiration=None):
+        self.account = account
+        self.id = id
+        self.name = name
+        self.channels = channels
+        self.expiration = expiration
+        self.capabilities = dict(
+            get=_capability(),
+            events=_capability(),
+            delete=_capability(),
+            )
+
+class _Session(object):
+    def __init__(self, account, id):
+        self.account = account
+        self.id = id
+        self.capabilities = dict(
+            get=_capability(),
+            channels_all=_capability(),
+            channels_create=_capability(),
+            subscriptions_all=_capability(),
+            subscriptions_create=_capability(),
+            )
+
+class FakeSpireServer(object):
+    """A fake Spire service listening on `host`:`port` (by default a free
+    port, see `url`).
+
+    Each response is delayed by `latency` seconds plus a uniformly random
+    amount up to `jitter`. Long-polls wait for at most `max_timeout` seconds,
+    whatever the client asks for, so tests needn't wait 30 seconds for an
+    empty page. `request_counts` counts requests by (method, route).
+
+    Compressed request bodies are accepted, and responses of at least
+    COMPRESS_THRESHOLD bytes are compressed for clients that send
+    Accept-Encoding. Request bodies over `max_body` bytes (after
+    decompressing) are rejected with a 413. `bytes_received` and `bytes_sent`
+    count body bytes as they went over the wire.
+
+    A page of events holds the (up to `limit`) events after `last`, in the
+    order `order-by` asks for. With `newest_first` they come back newest first
+    whatever it asks for, as the live service returned them to the
+    integration tests in test_spire.py.
+    """
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        latency=0,
+        jitter=0,
+        max_timeout=MAX_TIMEOUT,
+        max_body=None,
+        newest_first=False,
+        ):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_timeout = max_timeout
+        self.max_body = max_body
+        self.newest_first = newest_first
+        self.request_counts = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        self._ids = itertools.count(1)
+        self._last_timestamp = 0
+        self._accounts = {}
+        self._sessions = {}
+        self._channels = {}
+        self._subscriptions = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.spire = self
+        self.host, self.port = self.httpd.server_address[:2]
+        self.url = 'http://%s:%i' % (self.host, self.port)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all() # end waiting long-polls
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd.close_connections()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def create_account(self, email=None, password=None):
+        """Create an account directly, returning its secret"""
+        with self._condition:
+            return self._new_account(email, password).secret
+
+    def _new_account(self, email=None, password=None):
+        account = _Account(self._ids.next(), email, password)
+        self._accounts[account.secret] = account
+        return account
+
+    def _timestamp(self):
+        # milliseconds, like Spire, but never repeated
+        self._last_timestamp = max(int(time.time() * 1000), self._last_timestamp + 1)
+        return self._last_timestamp
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    # URLs and representations
+
+    def account_url(self, account):
+        return '%s/account/%i' % (self.url, account.id)
+
+    def channel_url(self, channel):
+        return '%s/channel/%i' % (self.account_url(channel.account), channel.id)
+
+    def subscription_url(self, subscription):
+        return '%s/subscription/%i' % (self.account_url(subscription.account), subscription.id)
+
+    def discovery(self):
+        return dict(
+            resources=dict(
+                accounts=dict(url='%s/accounts' % self.url),
+                sessions=dict(url='%s/sessions' % self.url),
+                ),
+            schema={'1.0': dict(
+                    (name, dict(mediaType=media_type))
+                    for name, media_type in MEDIA_TYPES.items()
+                    )},
+            )
+
+    def session_resource(self, session):
+        account_url = self.account_url(session.account)
+        capabilities = session.capabilities
+        return dict(
+            url='%s/session/%i' % (self.url, session.id),
+            capabilities=dict(get=capabilities['get']),
+            resources=dict(
+                account=dict(
+                    url=account_url,
+                    secret=session.account.secret,
+                    capabilities={},
+                    ),
+                channels=dict(
+                    url='%s/channels' % account_url,
+                    capabilities=dict(
+                        all=capabilities['channels_all'],
+                        create=capabilities['channels_create'],
+                        ),
+                    ),
+                subscriptions=dict(
+                    url='%s/subscriptions' % account_url,
+                    capabilities=dict(
+                        all=capabilities['subscriptions_all'],
+                        create=capabilities['subscriptions_create'],
+                        ),
+                    ),
+                ),
+            )
+
+    def channel_resource(self, channel):
+        url = self.channel_url(channel)
+        return dict(
+            url=url,
+            name=channel.name,
+            description=channel.description,
+            capabilities=dict(
+                get=channel.capabilities['get'],
+                publish=channel.capabilities['publish'],
+                delete=channel.capabilities['delete'],
+                ),
+            resources=dict(subscriptions=dict(
+                    url='%s/subscriptions' % url,
+                    capabilities=dict(
+                        get_subscriptions=channel.capabilities['get_subscriptions'],
+                        ),
+                    )),
+            )
+
+    def subscription_resource(self, subscription):
+        return dict(
+            url=self.subscription_url(subscription),
+            name=subscription.name,
+            channels=[self.channel_url(channel) for channel in subscription.channels],
+            expiration=subscription.expiration,
+            capabilities=subscription.capabilities,
+            )
+
+    def message_resource(self, channel, message):
+        timestamp, content = message
+        return dict(
+            url='%s/message/%i' % (self.channel_url(channel), timestamp),
+            channel_name=channel.name,
+            content=content,
+            timestamp=timestamp,
+            )
+
+    # request handling; all of it happens with self._condition held, except
+    # for waiting on long-polls, which releases it
+
+    def handle(self, method, path, query, capability, body):
+        """Returns (status, media type name, parsed body) for a request"""
+        for pattern, methods in ROUTES:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            handler = methods.get(method, None)
+            if handler is None:
+                raise FakeError(405, "Method not allowed")
+            key = (method, handler.__name__.lstrip('_'))
+            with self._condition:
+                self.request_counts[key] = self.request_counts.get(key, 0) + 1
+                return handler(self, capability, query, body, *[int(x) for x in match.groups()])
+        raise FakeError(404, "Not found")
+
+    def _check(self, capability, expected):
+        if capability != expected:
+            raise FakeError(401, "Unauthorized")
+
+    def _get_discovery(self, capability, query, body):
+        return 200, None, self.discovery()
+
+    def _create_account(self, capability, query, body):
+        if not body.get('email') or not body.get('password'):
+            raise FakeError(400, "email and password are required")
+        for account in self._accounts.values():
+            if account.email == body['email']:
+                raise FakeError(409, "An account with that email exists")
+        account = self._new_account(body['email'], body['password'])
+        return 201, 'session', self.session_resource(self._new_session(account))
+
+    def _new_session(self, account):
+        session = _Session(account, self._ids.next())
+        self._sessions[session.id] = session
+        return session
+
+    def _create_session(self, capability, query, body):
+        account = self._accounts.get(body.get('secret', None), None)
+        if account is None:
+            raise FakeError(401, "Unknown secret")
+        return 201, 'session', self.session_resource(self._new_session(account))
+
+    def _get_session(self, capability, query, body, session_id):
+        session = self._sessions.get(session_id, None)
+        if session is None:
+            raise FakeError(404, "Not found")
+        self._check(capability, session.capabilities['get'])
+        return 200, 'session', self.session_resource(session)
+
+    def _session_capability(self, account_id, capability, name):
+        for session in self._sessions.values():
+            if session.account.id == account_id and session.capabilities[name] == capability:
+                return session.account
+        raise FakeError(401, "Unauthorized")
+
+    def _get_channels(self, capability, query, body, account_id):
+        account = self._session_capability(account_id, capability, 'channels_all')
+        return 200, 'channels', dict(
+            (name, self.channel_resource(channel))
+            for name, channel in account.channels.items()
+            )
+
+    def _create_channel(self, capability, query, body, account_id):
+        account = self._session_capability(account_id, capability, 'channels_create')
+        name = body.get('name', None)
+        if not name:
+            raise FakeError(400, "name is required")
+        if name in account.channels:
+            raise FakeError(409, "Conflict")
+        channel = _Channel(account, self._ids.next(), name, body.get('description', None))
+        account.channels[name] = channel
+        self._channels[channel.id] = channel
+        return 201, 'channel', self.channel_resource(channel)
+
+    def _channel(self, account_id, channel_id):
+        channel = self._channels.get(channel_id, None)
+        if channel is None or channel.account.id != account_id:
+            raise FakeError(404, "Not found")
+        return channel
+
+    def _get_channel(self, capability, query, body, account_id, channel_id):
+        channel = self._channel(account_id, channel_id)
+        self._check(capability, channel.capabilities['get'])
+        return 200, 'channel', self.channel_resource(channel)
+
+    def _publish(self, capability, query, body, account_id, channel_id):
+        channel = self._channel(account_id, channel_id)
+        self._check(capability, channel.capabilities['publish'])
+        message = (self._timestamp(), body.get('content', None))
+        channel.messages.append(message)
+        self._condition.notify_all()
+        return 201, 'message', self.message_resource(channel, message)
+
+    def _delete_channel(self, capability, query, body, account_id, channel_id):
+        channel = self._channel(account_id, channel_id)
+        self._check(capability, channel.capabilities['delete'])
+        del self._channels[channel_id]
+        del channel.account.channels[channel.name]
+        return 204, None, None
+
+    def _get_channel_subscriptions(self, capability, query, body, account_id, channel_id):
+        channel = self._channel(account_id, channel_id)
+        self._check(capability, channel.capabilities['get_subscriptions'])
+        return 200, 'subscriptions', dict(
+            (name, self.subscription_resource(subscription))
+            for name, subscription in channel.account.subscriptions.items()
+            if channel in subscription.channels
+            )
+
+    def _get_subscriptions(self, capability, query, body, account_id):
+        account = self._session_capability(account_id, capability, 'subscriptions_all')
+        return 200, 'subscriptions', dict(
+            (name, self.subscription_resource(subscription))
+            for name, subscription in account.subscriptions.items()
+            )
+
+    def _create_subscription(self, capability, query, body, account_id):
+        account = self._session_capability(account_id, capability, 'subscriptions_create')
+        name = body.get('name', None) or 'subscription-%i' % self._ids.next()
+        if name in account.subscriptions:
+            raise FakeError(409, "Conflict")
+        channels = []
+        for url in body.get('channels', []):
+            match = CHANNEL_URL.match(urlparse.urlsplit(url).path)
+            if match is None:
+                raise FakeError(400, "Unknown channel %s" % url)
+            channels.append(self._channel(*[int(x) for x in match.groups()]))
+        subscription = _Subscription(
+            account, self._ids.next(), name, channels, body.get('expiration', None))
+        account.subscriptions[name] = subscription
+        self._subscriptions[subscription.id] = subscription
+        return 201, 'subscription', self.subscription_resource(subscription)
+
+    def _subscription(self, account_id, subscription_id):
+        subscription = self._subscriptions.get(subscription_id, None)
+        if subscription is None or subscription.account.id != account_id:
+            raise FakeError(404, "Not found")
+        return subscription
+
+    def _events_since(self, subscription, last):
+        events = []
+        for channel in subscription.channels:
+            for message in channel.messages:
+                if message[0] > last:
+                    events.append((message, channel))
+        events.sort()
+        return events
+
+    def _get_events(self, capability, query, body, account_id, subscription_id):
+        subscription = self._subscription(account_id, subscription_id)
+        self._check(capability, subscription.capabilities['events'])
+        last = int(query.get('last', 0) or 0)
+        timeout = min(float(query.get('timeout', 0) or 0), self.max_timeout)
+        deadline = time.time() + timeout
+
+        events = self._events_since(subscription, last)
+        while not events and not self._stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+            events = self._events_since(subscription, last)
+
+        # a page is the events right after `last`, whichever order it is in
+        if query.get('limit'):
+            events = events[:int(query['limit'])]
+        if self.newest_first or query.get('order-by', 'desc') == 'desc':
+            events.reverse()
+        messages = [self.message_resource(channel, message) for message, channel in events]
+        timestamps = [message['timestamp'] for message in messages]
+        return 200, 'events', dict(
+            messages=messages,
+            first=min(timestamps) if timestamps else last,
+            last=max(timestamps) if timestamps else last,
+            )
+
+    def _delete_subscription(self, capability, query, body, account_id, subscription_id):
+        subscription = self._subscription(account_id, subscription_id)
+        self._check(capability, subscription.capabilities['delete'])
+        del self._subscriptions[subscription_id]
+        del subscription.account.subscriptions[subscription.name]
+        return 204, None, None
+
+CHANNEL_URL = re.compile(r'^/account/(\d+)/channel/(\d+)$')
+
+ROUTES = [
+    (re.compile(r'^/?$'), dict(GET=FakeSpireServer._get_discovery)),
+    (re.compile(r'^/accounts$'), dict(POST=FakeSpireServer._create_account)),
+    (re.compile(r'^/sessions$'), dict(POST=FakeSpireServer._create_session)),
+    (re.compile(r'^/session/(\d+)$'), dict(GET=FakeSpireServer._get_session)),
+    (re.compile(r'^/account/(\d+)/channels$'), dict(
+            GET=FakeSpireServer._get_channels,
+            POST=FakeSpireServer._create_channel,
+            )),
+    (CHANNEL_URL, dict(
+            GET=FakeSpireServer._get_channel,
+            POST=FakeSpireServer._publish,
+            DELETE=FakeSpireServer._delete_channel,
+            )),
+    (re.compile(r'^/account/(\d+)/channel/(\d+)/subscriptions$'), dict(
+            GET=FakeSpireServer._get_channel_subscriptions,
+            )),
+    (re.compile(r'^/account/(\d+)/subscriptions$'), dict(
+            GET=FakeSpireServer._get_subscriptions,
+            POST=FakeSpireServer._create_subscription,
+            )),
+    (re.compile(r'^/account/(\d+)/subscription/(\d+)$'), dict(
+            GET=FakeSpireServer._get_events,
+            DELETE=FakeSpireServer._delete_subscription,
+            )),
+    ]
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive and pipelining
+    wbufsize = -1 # one send per response, or Nagle's algorithm adds 40ms
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def _handle(self):
+        spire = self.server.spire
+        split = urlparse.urlsplit(self.path)
+        query = dict((key, values[-1]) for key, values in cgi.parse_qs(split.query).items())
+        capability = None
+        authorization = self.headers.get('authorization', '')
+        if authorization.startswith('Capability '):
+            capability = authorization[len('Capability '):]
+        length = int(self.headers.get('content-length', 0) or 0)
+        data = self.rfile.read(length) if length else ''
+
+        spire.delay()
+        try:
+            body = self._body(data)
+            status, media_type, result = spire.handle(self.command, split.path, query, capability, body)
+        except FakeError, e:
+            status, media_type, result = e.status, None, dict(error=str(e))
+
+        content = '' if result is None else json.dumps(result)
+        encoding = self._response_encoding()
+        if encoding is not None and len(content) >= COMPRESS_THRESHOLD:
+            content = compress(content, encoding)
+        else:
+            encoding = None
+        with spire._condition:
+            spire.bytes_received += len(data)
+            spire.bytes_sent += len(content)
+        self.send_response(status)
+        self.send_header('Content-Type', MEDIA_TYPES.get(media_type, 'application/json'))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _body(self, data):
+        if not data:
+            return {}
+        encoding = self.headers.get('content-encoding', None)
+        if encoding:
+            try:
+                data = decompress(data, encoding)
+            except Exception:
+                raise FakeError(400, "Could not decode %s body" % encoding)
+        max_body = self.server.spire.max_body
+        if max_body is not None and len(data) > max_body:
+            raise FakeError(413, "Request body too large")
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise FakeError(400, "Invalid JSON")
+
+    def _response_encoding(self):
+        accepted = [e.strip() for e in self.headers.get('accept-encoding', '').split(',')]
+        for encoding in ENCODINGS:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.connections = set() # open keep-alive connections
+
+    def close_connections(self):
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        if not self.spire._stopped:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
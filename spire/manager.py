@@ -0,0 +1,201 @@
+"""
+Long-polling many subscriptions at once.
+"""
+import collections
+import sys
+import threading
+import time
+import traceback
+
+ERROR_BACKOFF = 1.0
+MAX_ERROR_BACKOFF = 30.0
+LATENCY_SAMPLES = 1000
+
+def spawn_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class ManagedSubscription(object):
+    """A subscription owned by a `SubscriptionManager`, along with its own
+    position in the event stream and its counters"""
+    def __init__(self, subscription, callback, last_timestamp=None):
+        self.subscription = subscription
+        self.callback = callback
+        self.last_timestamp = last_timestamp or 0
+        self.active = True
+        self.polls = 0
+        self.events = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def stats(self):
+        return dict(
+            last_timestamp=self.last_timestamp,
+            polls=self.polls,
+            events=self.events,
+            errors=self.errors,
+            )
+
+class SubscriptionManager(object):
+    """Keeps one long-poll in flight for each of many subscriptions and calls
+    each subscription's callback with the events it receives.
+
+    By default each subscription is polled from its own daemon thread; pass
+    `spawn=gevent.spawn, sleep=gevent.sleep` (or use
+    `spire.evented.EventedSubscriptionManager`) to poll them all from
+    greenlets on one event loop instead. Subscriptions created from the same
+    `Client` share its pool of connections.
+
+    Exceptions raised while polling or by a callback are passed to
+    `on_error(subscription, exc_info)`, which prints them by default. Polling
+    backs off after an error rather than retrying straight away.
+    """
+    def __init__(self, spawn=spawn_thread, sleep=time.sleep, on_error=None):
+        self.spawn = spawn
+        self.sleep = sleep
+        if on_error is not None:
+            self.on_error = on_error
+        self.running = False
+        self.started_at = None
+        self._managed = {}
+        # subscriptions with a poll loop, which there is at most one of per
+        # subscription, even across a restart or a remove and add
+        self._looping = set()
+        self._lock = threading.Lock()
+
+    def on_error(self, subscription, exc_info):
+        traceback.print_exception(*exc_info, file=sys.stderr)
+
+    def add(self, subscription, callback, last_timestamp=None):
+        """Start watching `subscription`, calling `callback` with each
+        non-empty page of events. Polling starts from `last_timestamp` if
+        given, or from the subscription's own last timestamp."""
+        if last_timestamp is None:
+            last_timestamp = subscription.last_timestamp
+        managed = ManagedSubscription(subscription, callback, last_timestamp)
+        with self._lock:
+            if subscription in self._managed:
+                raise ValueError("Subscription is already managed")
+            self._managed[subscription] = managed
+            spawn = self.running and subscription not in self._looping
+            if spawn:
+                self._looping.add(subscription)
+        if spawn:
+            self.spawn(self._poll_loop, subscription)
+        return managed
+
+    def remove(self, subscription):
+        """Stop watching `subscription`. A poll already in flight finishes
+        but its events are not dispatched."""
+        with self._lock:
+            managed = self._managed.pop(subscription)
+        managed.active = False
+        return managed
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+            self.started_at = time.time()
+            # a loop still waiting for a poll from before a stop carries on
+            # once it returns, rather than polling alongside a new one
+            idle = [s for s in self._managed if s not in self._looping]
+            self._looping.update(idle)
+        for subscription in idle:
+            self.spawn(self._poll_loop, subscription)
+
+    def stop(self):
+        """Stop polling. A poll in flight finishes, but its events are not
+        dispatched unless the manager has been started again by then."""
+        with self._lock:
+            self.running = False
+
+    def _current(self, subscription):
+        """The subscription's ManagedSubscription if it should be polled,
+        else None"""
+        if not self.running:
+            return None
+        return self._managed.get(subscription, None)
+
+    def _poll_loop(self, subscription):
+        while True:
+            with self._lock:
+                managed = self._current(subscription)
+                if managed is None:
+                    self._looping.discard(subscription)
+                    return
+            started = time.time()
+            try:
+                events = subscription.subscribe(last_timestamp=managed.last_timestamp)
+            except Exception:
+                managed.errors += 1
+                managed.consecutive_errors += 1
+                self.on_error(subscription, sys.exc_info())
+                self.sleep(min(
+                        ERROR_BACKOFF * 2 ** (managed.consecutive_errors - 1),
+                        MAX_ERROR_BACKOFF,
+                        ))
+                continue
+            managed.consecutive_errors = 0
+            managed.latencies.append(time.time() - started)
+            managed.polls += 1
+            with self._lock:
+                current = self._current(subscription) is managed
+            if not current:
+                # stopped or removed while polling: the page is dropped, and
+                # polled for again if polling goes on
+                discard = getattr(subscription, '_discard_page', None)
+                if discard is not None:
+                    discard()
+                continue
+            managed.last_timestamp = events['last']
+            messages = events.get('messages', [])
+            managed.events += len(messages)
+            if messages:
+                try:
+                    managed.callback(events)
+                except Exception:
+                    managed.errors += 1
+                    self.on_error(subscription, sys.exc_info())
+
+    def metrics(self):
+        """Poll latency and event rates across all subscriptions, plus the
+        counters of each one (keyed by subscription URL)"""
+        with self._lock:
+            managed = self._managed.values()
+        latencies = []
+        polls = events = errors = 0
+        subscriptions = {}
+        for m in managed:
+            latencies.extend(m.latencies)
+            polls += m.polls
+            events += m.events
+            errors += m.errors
+            subscriptions[m.subscription.subscription_resource['url']] = m.stats()
+        latencies.sort()
+
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = time.time() - self.started_at
+        return dict(
+            subscriptions=subscriptions,
+            polls=polls,
+            events=events,
+            errors=errors,
+            events_per_second=events / elapsed if elapsed else 0.0,
+            poll_latency=dict(
+                mean=sum(latencies) / len(latencies) if latencies else None,
+                p50=_percentile(latencies, 0.5),
+                p95=_percentile(latencies, 0.95),
+                max=latencies[-1] if latencies else None,
+                ),
+            )
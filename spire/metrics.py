@@ -0,0 +1,154 @@
+"""
+Per-operation metrics for everything a client sends to Spire.
+
+A `Client` calls its hooks (see `Client.add_hook`) before and after each API
+call with a dict describing it. `MetricsCollector` is such a hook: it keeps
+counters and latency histograms per operation, which can be read with
+`snapshot` or exported in the Prometheus text format with `prometheus`.
+
+    metrics = client.enable_metrics()
+    ...
+    print metrics.prometheus()
+"""
+import bisect
+import threading
+
+# upper bounds in seconds; long-polls can take up to SUBSCRIBE_MAX_TIMEOUT
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, count of observations <= it) pairs, ending with
+        ('+Inf', count)"""
+        total = 0
+        pairs = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class OperationMetrics(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.calls = 0
+        self.in_flight = 0
+        self.errors = 0 # calls that got no response, or a 4xx or 5xx one
+        self.statuses = {} # count by status code, 'error' for no response
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram(buckets)
+
+    def to_dict(self):
+        return dict(
+            calls=self.calls,
+            in_flight=self.in_flight,
+            errors=self.errors,
+            statuses=dict(self.statuses),
+            retries=self.retries,
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            latency=dict(
+                count=self.latency.count,
+                sum=self.latency.sum,
+                buckets=self.latency.cumulative(),
+                ),
+            )
+
+class MetricsCollector(object):
+    """A client hook aggregating calls by operation ('publish', 'subscribe',
+    'create_channel' and so on). Thread-safe."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def _metrics(self, operation):
+        metrics = self.operations.get(operation, None)
+        if metrics is None:
+            metrics = self.operations[operation] = OperationMetrics(self.buckets)
+        return metrics
+
+    def __call__(self, call):
+        with self._lock:
+            metrics = self._metrics(call['operation'])
+            if call['phase'] == 'before':
+                metrics.in_flight += 1
+                return
+            metrics.in_flight -= 1
+            metrics.calls += 1
+            status = call['status_code']
+            if status is None:
+                status = 'error'
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            if call['error'] is not None or status == 'error' or status >= 400:
+                metrics.errors += 1
+            metrics.retries += call['retries']
+            metrics.bytes_sent += call['bytes_sent']
+            metrics.bytes_received += call['bytes_received']
+            metrics.latency.observe(call['elapsed'])
+
+    def snapshot(self):
+        """The metrics of each operation as plain dicts"""
+        with self._lock:
+            return dict(
+                (operation, metrics.to_dict())
+                for operation, metrics in self.operations.items()
+                )
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+
+    def prometheus(self, prefix='spire_client'):
+        """The metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def _family(name, kind, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def _sample(name, labels, value):
+            label_text = ','.join('%s="%s"' % pair for pair in labels)
+            lines.append('%s_%s{%s} %s' % (prefix, name, label_text, _number(value)))
+
+        operations = sorted(snapshot.items())
+        _family('calls_total', 'counter', "API calls by operation and response status.")
+        for operation, metrics in operations:
+            for status, count in sorted(metrics['statuses'].items()):
+                _sample('calls_total', [('operation', operation), ('status', status)], count)
+        for name, key, kind, help in (
+            ('errors_total', 'errors', 'counter', "API calls that failed."),
+            ('retries_total', 'retries', 'counter', "Requests retried by the client."),
+            ('sent_bytes_total', 'bytes_sent', 'counter', "Request body bytes sent."),
+            ('received_bytes_total', 'bytes_received', 'counter', "Response body bytes received."),
+            ('in_flight', 'in_flight', 'gauge', "API calls in progress."),
+            ):
+            _family(name, kind, help)
+            for operation, metrics in operations:
+                _sample(name, [('operation', operation)], metrics[key])
+
+        _family('latency_seconds', 'histogram', "API call latency, including retries.")
+        for operation, metrics in operations:
+            latency = metrics['latency']
+            for bound, count in latency['buckets']:
+                _sample('latency_seconds_bucket', [('operation', operation), ('le', _number(bound))], count)
+            _sample('latency_seconds_sum', [('operation', operation)], latency['sum'])
+            _sample('latency_seconds_count', [('operation', operation)], latency['count'])
+        return '\n'.join(lines) + '\n'
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,236 @@
+"""
+The path every request takes on its way to the transport: circuit breaking,
+retries with backoff, and hooks that see each attempt.
+"""
+import random
+import threading
+import time
+import urlparse
+
+from errors import CircuitOpenError
+from transport import TransportError, IDEMPOTENT_METHODS
+
+class RetryPolicy(object):
+    """Decides whether a failed attempt is retried, and how long to wait.
+
+    Idempotent requests are retried after transport errors and on
+    `retry_statuses`. Any request, idempotent or not, is retried on
+    `rejected_statuses`, which mean the server turned the request away without
+    acting on it. The wait before attempt n+1 is drawn uniformly from
+    [0, min(max_backoff, backoff * 2 ** (n - 1))] ("full jitter"), so clients
+    that failed together don't all come back at the same moment.
+    """
+    def __init__(
+        self,
+        max_attempts=3,
+        backoff=0.1,
+        max_backoff=10.0,
+        jitter=True,
+        retry_statuses=(500, 502, 503, 504),
+        rejected_statuses=(429, 503),
+        ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.rejected_statuses = rejected_statuses
+
+    def should_retry(self, attempt, idempotent, response=None, error=None):
+        if attempt >= self.max_attempts:
+            return False
+        if response is not None and response.status_code in self.rejected_statuses:
+            return True
+        if not idempotent:
+            return False
+        if error is not None:
+            return True
+        return response is not None and response.status_code in self.retry_statuses
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+NO_RETRIES = RetryPolicy(max_attempts=1)
+
+class CircuitBreaker(object):
+    """Stops sending requests to a host after `failure_threshold` failures in
+    a row. After `reset_timeout` seconds one request is let through; if it
+    succeeds the circuit closes again, otherwise it stays open for another
+    `reset_timeout`."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN # this request is the trial
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+class RequestPipeline(object):
+    """Sends requests through `transport`, with a `CircuitBreaker` per host
+    and retries according to `retry_policy`.
+
+    Callables added with `add_hook` are called after every attempt with a dict
+    describing it: method, url, attempt (from 1), elapsed seconds,
+    status_code (None if the request failed), error (the exception, if any)
+    and whether it will be retried.
+    """
+    def __init__(
+        self,
+        transport,
+        retry_policy=None,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        sleep=time.sleep,
+        ):
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.hooks = []
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def breaker(self, url):
+        host = urlparse.urlsplit(url).netloc
+        breaker = self._breakers.get(host, None)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    host, CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return breaker
+
+    def _fire(self, **attempt):
+        for hook in self.hooks:
+            hook(attempt)
+
+    def request(
+        self,
+        method,
+        url,
+        headers=None,
+        data=None,
+        params=None,
+        timeout=None,
+        idempotent=None,
+        retry_policy=None,
+        ):
+        """Returns the transport's `Response`, which like before may be a 4xx
+        or 5xx response. Raises `CircuitOpenError` without sending anything if
+        the host's circuit is open, and `TransportError` if the last attempt
+        couldn't get a response at all."""
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if retry_policy is None:
+            retry_policy = self.retry_policy
+        breaker = self.breaker(url)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                raise CircuitOpenError("Not sending %s %s: too many recent failures" % (method, url))
+
+            response = error = None
+            started = time.time()
+            try:
+                response = self.transport.request(
+                    method,
+                    url,
+                    headers=headers,
+                    data=data,
+                    params=params,
+                    timeout=timeout,
+                    )
+            except TransportError, e:
+                error = e
+            elapsed = time.time() - started
+
+            if error is not None or response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            retry = retry_policy.should_retry(attempt, idempotent, response, error)
+            self._fire(
+                method=method,
+                url=url,
+                attempt=attempt,
+                elapsed=elapsed,
+                status_code=response.status_code if response is not None else None,
+                error=error,
+                will_retry=retry,
+                )
+            if not retry:
+                if error is not None:
+                    error.attempts = attempt
+                    raise error
+                response.attempts = attempt
+                return response
+            self.sleep(retry_policy.delay(attempt))
+
+    def pipeline(self, method, url, bodies, headers=None, timeout=None):
+        """Pipelined requests (see `Transport.pipeline`). These are not
+        retried, since some of them may have been processed. If the batch
+        fails part way through, the TransportError's `responses` are those
+        read before it failed."""
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError("Not sending %s %s: too many recent failures" % (method, url))
+        started = time.time()
+        responses = error = None
+        try:
+            responses = self.transport.pipeline(method, url, bodies, headers=headers, timeout=timeout)
+        except TransportError, e:
+            error = e
+
+        if error is not None or [r for r in responses if r.status_code >= 500]:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        self._fire(
+            method=method,
+            url=url,
+            attempt=1,
+            elapsed=time.time() - started,
+            status_code=responses[-1].status_code if responses else None,
+            error=error,
+            will_retry=False,
+            )
+        if error is not None:
+            raise error
+        return responses
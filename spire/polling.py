@@ -0,0 +1,134 @@
+"""
+Strategies deciding how a subscription long-polls for events.
+
+Each `Subscription` has a `polling` strategy, which chooses the server-side
+`timeout` and page size (`limit`) of each poll, and how long to wait before
+sending it. `FixedPolling`, the default, always asks for the same thing.
+`AdaptivePolling` follows the rate events arrive at:
+
+    subscription.poll_with(spire.AdaptivePolling(max_wait=0.5))
+    ...
+    subscription.polling.stats() # => {'events_per_poll': 48.2, 'polls_per_second': 2.1, ...}
+"""
+import time
+
+SUBSCRIBE_MAX_TIMEOUT = 30
+RATE_SMOOTHING = 0.3 # weight of the latest poll in the moving average
+
+class FixedPolling(object):
+    """Polls with the same `timeout` (seconds the server may hold a poll
+    open), `limit` (events per page, None for the server's default) and
+    `wait` (seconds between polls) every time"""
+    def __init__(self, timeout=SUBSCRIBE_MAX_TIMEOUT, limit=None, wait=0):
+        self.timeout = timeout
+        self.limit = limit
+        self.wait = wait
+        self.polls = 0
+        self.events = 0
+        self.full_pages = 0
+        self.started_at = None
+
+    def params(self):
+        """The query parameters for the next poll"""
+        params = {"timeout": self.timeout}
+        if self.limit is not None:
+            params["limit"] = self.limit
+        return params
+
+    def delay(self):
+        """Seconds to wait before the next poll"""
+        return self.wait
+
+    def observe(self, count, elapsed):
+        """Record that a poll returned `count` events, `elapsed` seconds after
+        it started (counting the delay before it)"""
+        if self.started_at is None:
+            self.started_at = time.time() - elapsed
+        self.polls += 1
+        self.events += count
+        if self.limit is not None and count >= self.limit:
+            self.full_pages += 1
+
+    def stats(self):
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = time.time() - self.started_at
+        return dict(
+            polls=self.polls,
+            events=self.events,
+            full_pages=self.full_pages,
+            events_per_poll=float(self.events) / self.polls if self.polls else None,
+            polls_per_second=self.polls / elapsed if elapsed else None,
+            timeout=self.timeout,
+            limit=self.limit,
+            wait=self.delay(),
+            )
+
+class AdaptivePolling(FixedPolling):
+    """Tunes each poll to the rate events have been arriving at, kept as a
+    moving average of events per second.
+
+    When events are rare, polls are held open for up to `max_timeout`
+    seconds so idle subscriptions cost one request per timeout. When they are
+    frequent, a poll returns as soon as the first event arrives, so pages
+    would be tiny; instead the next poll is delayed long enough for about
+    `target_events` to accumulate (but at most `max_wait` seconds), and the
+    page size is raised to fit what is expected to arrive. A full page means
+    there is a backlog, so the next poll is sent straight away.
+    """
+    def __init__(
+        self,
+        min_timeout=1,
+        max_timeout=SUBSCRIBE_MAX_TIMEOUT,
+        max_wait=1.0,
+        target_events=100,
+        min_limit=10,
+        max_limit=1000,
+        ):
+        FixedPolling.__init__(self, timeout=max_timeout, limit=max_limit)
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_wait = max_wait
+        self.target_events = target_events
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.rate = None # events per second
+        self._backlog = False
+
+    def observe(self, count, elapsed):
+        FixedPolling.observe(self, count, elapsed)
+        if elapsed > 0:
+            rate = count / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += RATE_SMOOTHING * (rate - self.rate)
+        self._backlog = count >= self.limit
+        self._tune()
+
+    def _tune(self):
+        rate = self.rate or 0.0
+        if rate * self.max_timeout < 1:
+            # expect nothing within a full timeout: hold polls open
+            self.timeout = self.max_timeout
+        else:
+            # an event is expected within 1/rate seconds; a timeout a few
+            # times that still catches quiet spells without idling for long
+            self.timeout = int(min(self.max_timeout, max(self.min_timeout, 4 / rate)))
+        if rate * self.max_wait < 2:
+            # waiting wouldn't gather events into bigger pages, only delay them
+            self.wait = 0
+        else:
+            self.wait = min(self.max_wait, self.target_events / rate)
+        expected = rate * (self.wait + 1)
+        self.limit = int(min(self.max_limit, max(self.min_limit, 2 * expected)))
+
+    def delay(self):
+        if self._backlog:
+            return 0
+        return self.wait
+
+    def stats(self):
+        stats = FixedPolling.stats(self)
+        stats['rate'] = self.rate
+        return stats
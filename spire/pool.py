@@ -0,0 +1,166 @@
+"""
+A pool of sessions that threads can lease and return, so request handlers
+don't each pay for creating a session.
+"""
+import collections
+import threading
+import time
+
+from core import SpireClientException
+
+HEALTH_CHECK_INTERVAL = 60.0
+
+class SessionPool(object):
+    """Thread-safe pool of `Session` objects created by `client`.
+
+    At most `max_size` sessions exist at once; `lease` blocks (for up to
+    `timeout` seconds) when all of them are leased out. With `prewarm` a
+    background thread creates `min_size` sessions straight away. A session
+    that sat idle for longer than `health_check_interval` seconds is refreshed
+    before being leased out again, and dropped if that fails.
+
+        pool = client.create_session_pool(min_size=2, max_size=10)
+        with pool.session() as session:
+            session.channel('foo').publish('bar')
+    """
+    def __init__(
+        self,
+        client,
+        min_size=1,
+        max_size=10,
+        prewarm=True,
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+        ):
+        if min_size > max_size:
+            raise ValueError("min_size must not be larger than max_size")
+        self.client = client
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+
+        self._idle = collections.deque() # (session, released_at)
+        self._size = 0 # idle, leased and being created
+        self._condition = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.created = 0
+        self.discarded = 0
+
+        if prewarm:
+            self.prewarm()
+
+    def _create(self):
+        try:
+            session = self.client.session()
+        except:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.created += 1
+        return session
+
+    def _healthy(self, session, released_at):
+        if self.health_check_interval is None:
+            return True
+        if time.time() - released_at < self.health_check_interval:
+            return True
+        try:
+            session._refresh()
+        except SpireClientException:
+            return False
+        return True
+
+    def lease(self, timeout=None):
+        """Take a session out of the pool, creating one if none is idle"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    self.waits += 1
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise SpireClientException("Timed out waiting for a session")
+                    self._condition.wait(remaining)
+                if self._idle:
+                    session, released_at = self._idle.pop()
+                    self.hits += 1
+                else:
+                    session = None
+                    self._size += 1
+                    self.misses += 1
+
+            if session is None:
+                return self._create()
+            if self._healthy(session, released_at):
+                return session
+            self.release(session, discard=True)
+
+    def release(self, session, discard=False):
+        """Return a leased session. Pass `discard=True` for a session that
+        shouldn't be reused, e.g. after it failed in an unexpected way."""
+        with self._condition:
+            if discard:
+                self._size -= 1
+                self.discarded += 1
+            else:
+                self._idle.append((session, time.time()))
+            self._condition.notify()
+
+    def session(self):
+        """A context manager leasing a session for the duration of a `with`
+        block"""
+        return _Lease(self)
+
+    def _prewarm(self):
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                session = self._create()
+            except SpireClientException:
+                return # lease will try again, and raise where someone sees it
+            self.release(session)
+
+    def prewarm(self):
+        """Start creating sessions up to `min_size` in a background thread"""
+        thread = threading.Thread(target=self._prewarm)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                size=self._size,
+                idle=len(self._idle),
+                hits=self.hits,
+                misses=self.misses,
+                waits=self.waits,
+                created=self.created,
+                discarded=self.discarded,
+                )
+
+class _Lease(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.session = None
+
+    def __enter__(self):
+        self.session = self.pool.lease()
+        return self.session
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # sessions are reused even if the block raised; a broken one is
+        # caught by the health check
+        self.pool.release(self.session)
+        self.session = None
@@ -0,0 +1,262 @@
+"""
+Publishing without waiting for Spire.
+
+A `Publisher` takes messages into a bounded in-memory buffer and returns
+straight away; background workers publish them with `Channel.publish_many`
+over the client's pooled connections, pipelined if the client was created
+with `pipelining=True`. Each message gets a `PublishFuture` for its parsed
+message resource.
+
+    publisher = client.create_publisher(workers=2, capacity=10000)
+    future = publisher.publish(channel, 'hello')
+    ...
+    future.result(timeout=5) # => {'content': 'hello', 'timestamp': ...}
+    publisher.metrics()      # => {'depth': 3, 'dropped': 0, 'latency': {...}, ...}
+    publisher.close(timeout=10) # publishes what is buffered, then stops
+"""
+import collections
+import sys
+import threading
+import time
+import traceback
+
+from errors import SpireClientException
+from manager import spawn_thread
+from metrics import Histogram
+
+CAPACITY = 10000
+BATCH_SIZE = 50 # the most messages a worker takes at once
+
+class PublishDropped(SpireClientException):
+    """The message was dropped from a full buffer before being published"""
+
+class PublishFuture(object):
+    """The eventual result of publishing one message: its parsed message
+    resource, or the exception publishing it raised"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for up to `timeout` seconds for the message to be published
+        and return its resource, raising the exception if it failed"""
+        if not self._done.wait(timeout):
+            raise SpireClientException("Timed out waiting for publish")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise SpireClientException("Timed out waiting for publish")
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call `callback(future)` once the message is published or has
+        failed, from the worker that published it (or straight away if it
+        already has)"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _resolve(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class Publisher(object):
+    """Publishes messages from `workers` background threads.
+
+    Messages for the same channel always go to the same worker, which
+    publishes them in the order they were given. Up to `capacity` messages
+    can wait in total; when a worker's share is full, its oldest message is
+    dropped, like in a ring buffer, and its future fails with
+    `PublishDropped`.
+
+    A failed publish is reported to its future and to `on_error(exc_info)`,
+    which prints it by default. When a batch for a channel fails part way,
+    each message's future gets its own outcome: the messages Spire accepted
+    get their resources, even after one it turned away, and the rest fail.
+    """
+    def __init__(
+        self,
+        client,
+        workers=2,
+        capacity=CAPACITY,
+        batch_size=BATCH_SIZE,
+        on_error=None,
+        spawn=spawn_thread,
+        ):
+        self.client = client
+        self.workers = workers
+        self.capacity = capacity
+        self.batch_size = batch_size
+        if on_error is not None:
+            self.on_error = on_error
+        self.spawn = spawn
+
+        self._buffers = [collections.deque() for i in range(workers)]
+        self._buffer_size = max(1, capacity // workers)
+        self._condition = threading.Condition()
+        self._pending = 0 # buffered or being published
+        self.running = False
+
+        self.enqueued = 0
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = Histogram() # from publish() to the message's future resolving
+
+    def on_error(self, exc_info):
+        traceback.print_exception(*exc_info, file=sys.stderr)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            for buffer in self._buffers:
+                self.spawn(self._work, buffer)
+        return self
+
+    def publish(self, channel, message):
+        """Buffer `message` to be published on `channel` and return a
+        `PublishFuture` for it"""
+        if not self.running:
+            raise SpireClientException("Publisher is not running")
+        future = PublishFuture()
+        item = (channel, message, future, time.time())
+        dropped = None
+        with self._condition:
+            buffer = self._buffers[hash(channel.resource.url) % len(self._buffers)]
+            if len(buffer) >= self._buffer_size:
+                dropped = buffer.popleft()
+                self.dropped += 1
+            else:
+                self._pending += 1
+            buffer.append(item)
+            self.enqueued += 1
+            self._condition.notify_all()
+        if dropped is not None:
+            dropped[2]._resolve(exception=PublishDropped("Publish buffer full"))
+        return future
+
+    def flush(self, timeout=None):
+        """Wait until every message buffered so far has been published (or
+        has failed). Returns False if `timeout` seconds pass first."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            while self._pending:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Flush (for up to `timeout` seconds), then stop the workers.
+        Returns False if messages were still buffered; their futures fail."""
+        flushed = self.flush(timeout)
+        with self._condition:
+            self.running = False
+            abandoned = []
+            for buffer in self._buffers:
+                abandoned.extend(buffer)
+                buffer.clear()
+            self._pending -= len(abandoned)
+            self._condition.notify_all()
+        for item in abandoned:
+            item[2]._resolve(exception=SpireClientException("Publisher closed"))
+        return flushed
+
+    def _take(self, buffer):
+        with self._condition:
+            while not buffer:
+                if not self.running:
+                    return None
+                self._condition.wait()
+            batch = []
+            while buffer and len(batch) < self.batch_size:
+                batch.append(buffer.popleft())
+            return batch
+
+    def _work(self, buffer):
+        while True:
+            batch = self._take(buffer)
+            if batch is None:
+                return
+            # group by channel, keeping each channel's messages in order
+            by_channel = collections.OrderedDict()
+            for item in batch:
+                by_channel.setdefault(item[0].resource.url, []).append(item)
+            for items in by_channel.values():
+                self._publish(items)
+            with self._condition:
+                self._pending -= len(batch)
+                self._condition.notify_all()
+
+    def _publish(self, items):
+        try:
+            if len(items) == 1:
+                resources = [items[0][0].publish(items[0][1])]
+            else:
+                resources = items[0][0].publish_many([item[1] for item in items])
+        except Exception, e:
+            self.on_error(sys.exc_info())
+            # see Channel.publish_many; the messages it did not get to fail
+            # with the exception too
+            results = list(getattr(e, 'results', ()))[:len(items)]
+            results.extend((None, e) for item in items[len(results):])
+            self._resolved(items, results)
+            return
+        self._resolved(items, [(resource, None) for resource in resources])
+
+    def _resolved(self, items, results):
+        """Resolve the future of each item with its `(resource, error)`"""
+        now = time.time()
+        with self._condition:
+            for item, (resource, error) in zip(items, results):
+                if error is None:
+                    self.published += 1
+                else:
+                    self.failed += 1
+                self.latency.observe(now - item[3])
+        for item, (resource, error) in zip(items, results):
+            item[2]._resolve(resource, error)
+
+    def metrics(self):
+        """`depth` is the number of messages buffered and not yet taken by a
+        worker; `latency` is the time from `publish` to the message being
+        published (or failing)."""
+        with self._condition:
+            depth = sum(len(buffer) for buffer in self._buffers)
+            pending = self._pending
+        return dict(
+            depth=depth,
+            capacity=self.capacity,
+            pending=pending,
+            enqueued=self.enqueued,
+            published=self.published,
+            failed=self.failed,
+            dropped=self.dropped,
+            latency=dict(
+                count=self.latency.count,
+                sum=self.latency.sum,
+                buckets=self.latency.cumulative(),
+                ),
+            )
@@ -0,0 +1,256 @@
+"""
+Typed views of the resources Spire returns.
+
+Sessions, channels and subscriptions used to dig URLs and capabilities out of
+the nested resource dicts by hand, with a headers dict written out for each
+request. These classes wrap the resource dict, `raw`, which is the only copy
+kept: URLs and capabilities are looked up in it when asked for, and
+`headers` builds the headers for an operation each time, so a resource object
+costs one small slotted object on top of the dict.
+
+A `ResourceCollection` holds the resources of a collection response and only
+builds objects for the ones that are used.
+"""
+import collections
+import operator
+import threading
+
+COLLECTION_CACHE_SIZE = 1024
+
+def _authorization(capability):
+    return "Capability %s" % capability
+
+def events_in_order(page):
+    """The messages of an events page, oldest first. The live service has
+    returned pages newest first whatever `order-by` asked for, so anything
+    that depends on the order of events sorts them."""
+    return sorted(page.get('messages', ()), key=operator.itemgetter('timestamp'))
+
+class Resource(object):
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def url(self):
+        return self.raw.get('url', None)
+
+    def headers(self, operation, schema):
+        """The request headers for `operation`, using the media types in the
+        client's `schema`"""
+        raise KeyError(operation)
+
+class SessionResource(Resource):
+    __slots__ = ()
+
+    def _resource(self, key):
+        return self.raw.get('resources', {}).get(key, {})
+
+    @property
+    def channels_url(self):
+        return self._resource('channels').get('url', None)
+
+    @property
+    def subscriptions_url(self):
+        return self._resource('subscriptions').get('url', None)
+
+    def capability(self, key, method):
+        """The capability for `method` on the resource `key`, the session's
+        own being under 'session'"""
+        if key == 'session':
+            capabilities = self.raw.get('capabilities', {})
+        else:
+            capabilities = self._resource(key).get('capabilities', {})
+        return capabilities.get(method, None)
+
+    def headers(self, operation, schema):
+        if operation == 'session':
+            return {
+                'Accept': schema['session'],
+                'Authorization': _authorization(self.capability('session', 'get')),
+                }
+        if operation == 'channels':
+            return {
+                'Accept': schema['channels'],
+                'Authorization': _authorization(self.capability('channels', 'all')),
+                }
+        if operation == 'create_channel':
+            return {
+                'Accept': schema['channel'],
+                'Content-type': schema['channel'],
+                'Authorization': _authorization(self.capability('channels', 'create')),
+                }
+        if operation == 'subscriptions':
+            return {
+                'Accept': schema['subscriptions'],
+                'Authorization': _authorization(self.capability('subscriptions', 'all')),
+                }
+        if operation == 'create_subscription':
+            return {
+                'Accept': schema['subscription'],
+                'Content-type': schema['subscription'],
+                'Authorization': _authorization(self.capability('subscriptions', 'create')),
+                }
+        raise KeyError(operation)
+
+class ChannelResource(Resource):
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.raw.get('name', None)
+
+    @property
+    def capabilities(self):
+        return self.raw.get('capabilities', {})
+
+    def _subscriptions(self):
+        return self.raw.get('resources', {}).get('subscriptions', {})
+
+    @property
+    def subscriptions_url(self):
+        return self._subscriptions().get('url', None)
+
+    @property
+    def subscriptions_capabilities(self):
+        return self._subscriptions().get('capabilities', {})
+
+    def headers(self, operation, schema):
+        if operation == 'publish':
+            return {
+                'Accept': schema['message'],
+                'Content-type': schema['message'],
+                'Authorization': _authorization(self.capabilities.get('publish', None)),
+                }
+        if operation == 'delete':
+            return {
+                'Authorization': _authorization(self.capabilities.get('delete', None)),
+                }
+        if operation == 'subscriptions':
+            return {
+                'Accept': schema['subscriptions'],
+                'Authorization': _authorization(self.subscriptions_capabilities['get_subscriptions']),
+                }
+        raise KeyError(operation)
+
+class SubscriptionResource(Resource):
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.raw.get('name', None)
+
+    @property
+    def capabilities(self):
+        return self.raw.get('capabilities', {})
+
+    def headers(self, operation, schema):
+        if operation == 'events':
+            return {
+                'Accept': schema['events'],
+                'Authorization': _authorization(self.capabilities.get('events', None)),
+                }
+        raise KeyError(operation)
+
+class ResourceCollection(object):
+    """The resources of a collection response by name, built into objects
+    with `build(resource)` the first time each is asked for, so a collection
+    of thousands of subscriptions costs one dict per subscription until they
+    are used. Up to `cache_size` built objects are kept, the least recently
+    used dropped first; asking for a dropped one again builds a new object.
+    If `evictable(obj)` is given and returns False, e.g. for a subscription
+    that remembers where it is up to, the object is kept however many others
+    are used, since a new one would have lost that state.
+
+    `loaded` is False until the collection has been fetched from Spire; the
+    collection may hold objects created since then, or before.
+    """
+    def __init__(self, build, raw=None, cache_size=COLLECTION_CACHE_SIZE, evictable=None):
+        self.build = build
+        self.raw = {} if raw is None else raw
+        self.loaded = raw is not None
+        self.cache_size = cache_size
+        self.evictable = evictable
+        self._built = collections.OrderedDict()
+        self._kept = {} # objects that would have been evicted, but can't be
+        self._lock = threading.RLock()
+
+    def update(self, raw):
+        """Replace the resources with a newly fetched collection, keeping
+        built objects that are still in it"""
+        with self._lock:
+            for built in (self._built, self._kept):
+                for name in built.keys():
+                    if name not in raw:
+                        del built[name]
+            self.raw = raw
+            self.loaded = True
+
+    def _cache(self, name, obj):
+        self._built[name] = obj
+        while len(self._built) > self.cache_size:
+            name, obj = self._built.popitem(last=False)
+            if self.evictable is not None and not self.evictable(obj):
+                self._kept[name] = obj
+
+    def get(self, name, default=None):
+        with self._lock:
+            obj = self._built.pop(name, None)
+            if obj is None:
+                obj = self._kept.pop(name, None)
+            if obj is None:
+                resource = self.raw.get(name, None)
+                if resource is None:
+                    return default
+                obj = self.build(resource)
+            # (re)insert as the most recently used
+            self._cache(name, obj)
+            return obj
+
+    def __getitem__(self, name):
+        obj = self.get(name)
+        if obj is None:
+            raise KeyError(name)
+        return obj
+
+    def __setitem__(self, name, obj):
+        """Add an object (with a `resource`) created since the collection
+        was fetched"""
+        with self._lock:
+            self.raw[name] = obj.resource.raw
+            self._built.pop(name, None)
+            self._kept.pop(name, None)
+            self._cache(name, obj)
+
+    def pop(self, name, default=None):
+        with self._lock:
+            obj = self._built.pop(name, None)
+            if obj is None:
+                obj = self._kept.pop(name, None)
+            resource = self.raw.pop(name, None)
+            if obj is None and resource is not None:
+                obj = self.build(resource)
+            return default if obj is None else obj
+
+    def __contains__(self, name):
+        return name in self.raw
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.raw.keys()
+
+    def iteritems(self):
+        """(name, object) pairs, building every object"""
+        for name in self.keys():
+            obj = self.get(name)
+            if obj is not None:
+                yield name, obj
+
+    def items(self):
+        return list(self.iteritems())
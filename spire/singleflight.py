@@ -0,0 +1,62 @@
+"""
+Collapsing concurrent calls that would fetch the same thing.
+
+When many threads reach a cold client at once, each would otherwise do the
+discovery request (or fetch the same collection, or create the same channel)
+itself. A `SingleFlight` lets the first caller for a key make the call while
+the others wait for it and share its result.
+"""
+import sys
+import threading
+
+class _Call(object):
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time. `event_class` is what
+    waiting callers block on: `threading.Event`, or `gevent.event.Event` when
+    the callers are greenlets."""
+    def __init__(self, event_class=threading.Event):
+        self.event_class = event_class
+        self._lock = threading.Lock() # never held while calling out
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0 # callers that waited for another's call
+
+    def do(self, key, func, *args):
+        """Call `func(*args)` and return its result, unless a call for `key`
+        is already in flight, in which case wait for it and return its result
+        (or raise its exception) instead"""
+        with self._lock:
+            call = self._calls.get(key, None)
+            if call is None:
+                call = self._calls[key] = _Call(self.event_class())
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return dict(calls=self.calls, shared=self.shared, in_flight=len(self._calls))
@@ -0,0 +1,487 @@
+"""
+HTTP transports for the Spire client.
+
+Every request the client makes goes through the transport owned by its
+`Client`. The default `PooledTransport` keeps persistent (keep-alive)
+connections in a small pool per host so that publishing a stream of messages
+doesn't pay for a new TCP (and TLS) handshake each time.
+"""
+import collections
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+from compression import decompress
+from errors import SpireClientException
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+# safe to send again when it is not known whether the server acted on them
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+class TransportError(SpireClientException, IOError):
+    """Raised when a request could not be sent or its response read. When a
+    pipelined batch fails part way through, `responses` holds the responses
+    read before it failed."""
+    responses = ()
+
+
+class Response(object):
+    """The parts of an HTTP response the client cares about. Like requests'
+    responses, instances are falsy for 4xx and 5xx statuses."""
+    def __init__(self, status_code, headers, content, url=None, wire_size=None):
+        self.status_code = status_code
+        self.headers = headers # header names are lowercase
+        self.content = content # decompressed
+        self.url = url
+        if wire_size is None:
+            wire_size = len(content or '')
+        self.wire_size = wire_size # bytes of body received, before decompressing
+        self.attempts = 1 # set by RequestPipeline when requests are retried
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    def __nonzero__(self):
+        return self.ok
+
+    def __repr__(self):
+        return '<Response [%i]>' % self.status_code
+
+
+def _response(status, headers, content, url):
+    """A `Response`, with its body decoded if it was sent compressed"""
+    encoding = headers.get('content-encoding', None)
+    if not encoding or not content:
+        return Response(status, headers, content, url)
+    try:
+        decoded = decompress(content, encoding.strip().lower())
+    except (ValueError, zlib.error), e:
+        raise TransportError("Could not decode %s response from %s: %s" % (encoding, url, e), e)
+    return Response(status, headers, decoded, url, wire_size=len(content))
+
+
+class _SendFailed(httplib.HTTPException):
+    """The connection failed while the request was being sent, so the server
+    can't have acted on it"""
+    def __init__(self, error):
+        httplib.HTTPException.__init__(self, str(error))
+        self.error = error
+
+def _dropped(connection):
+    """Whether the server has closed an idle connection, which makes the
+    socket readable (at EOF) before we have sent anything"""
+    if connection.sock is None:
+        return False
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class _UnclosableFile(object):
+    """Wraps a socket file so several pipelined HTTPResponses can read from
+    the same buffer; HTTPResponse closes its file once the body is read."""
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def close(self):
+        pass
+
+    def makefile(self, *args, **kwargs):
+        # HTTPResponse expects a socket and calls makefile on it
+        return self
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to a single (scheme, host, port).
+
+    The pool never blocks: if no idle connection is available a new one is
+    opened, and when a connection is handed back to a full pool it is closed
+    instead of being kept. Connections that sat idle for longer than
+    `idle_timeout` seconds are evicted rather than reused, since the server has
+    most likely dropped them already.
+    """
+    def __init__(
+        self,
+        scheme,
+        host,
+        port,
+        maxsize=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        connection_class=None,
+        ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        if connection_class is None:
+            if scheme == 'https':
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+        self.connection_class = connection_class
+
+        self._idle = collections.deque() # (connection, released_at), newest last
+        self._lock = threading.Lock()
+
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+        self.discarded = 0
+
+    def new_connection(self, timeout=None):
+        with self._lock:
+            self.opened += 1
+        return self.connection_class(self.host, self.port, timeout=timeout)
+
+    def get(self, timeout=None):
+        """Returns a `(connection, reused)` tuple"""
+        connection = None
+        stale = self._take_stale()
+        with self._lock:
+            if self._idle:
+                # LIFO: the most recently used connection is the least likely
+                # to have been closed by the server
+                connection = self._idle.pop()[0]
+        if connection is not None and _dropped(connection):
+            # closed by the server while it sat in the pool
+            stale.append(connection)
+            connection = None
+            with self._lock:
+                self.evicted += 1
+        for conn in stale:
+            conn.close()
+
+        if connection is None:
+            return self.new_connection(timeout), False
+        with self._lock:
+            self.reused += 1
+
+        connection.timeout = timeout
+        if connection.sock is not None:
+            try:
+                connection.sock.settimeout(timeout)
+            except socket.error:
+                connection.close()
+                return self.new_connection(timeout), False
+        return connection, True
+
+    def put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((connection, time.time()))
+                return
+            self.discarded += 1
+        connection.close()
+
+    def _take_stale(self):
+        stale = []
+        if self.idle_timeout is None:
+            return stale
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            while self._idle and self._idle[0][1] < cutoff:
+                stale.append(self._idle.popleft()[0])
+                self.evicted += 1
+        return stale
+
+    def evict_idle(self):
+        """Close connections that have been idle for too long. This happens
+        lazily on `get`, but long-running processes may call it periodically
+        to release sockets held for hosts they no longer talk to."""
+        stale = self._take_stale()
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, released_at in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                connections_opened=self.opened,
+                connections_reused=self.reused,
+                connections_evicted=self.evicted,
+                connections_discarded=self.discarded,
+                idle=len(self._idle),
+                )
+
+
+class Transport(object):
+    """Interface for the object a `Client` sends its HTTP requests through.
+    Subclasses implement `request`, returning a `Response`."""
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        raise NotImplementedError
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def pipeline(self, method, url, bodies, headers=None, timeout=None):
+        """Send one `method` request to `url` per item of `bodies` and return
+        the responses in order. Transports that can't pipeline send them one
+        at a time. Fewer responses than bodies may be returned, in which case
+        the remaining requests were not processed and should be resent."""
+        return [
+            self.request(method, url, headers=headers, data=body, timeout=timeout)
+            for body in bodies
+            ]
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class PooledTransport(Transport):
+    """A transport that reuses keep-alive connections.
+
+    `pool_size` is the number of idle connections kept per host,
+    `idle_timeout` how many seconds an idle connection may be kept before it is
+    evicted, and `timeout` the default socket timeout. With `keep_alive=False`
+    every request gets its own connection, as with plain `requests.get`. If
+    `verbose` is a file-like object each request is logged to it.
+    """
+    pool_class = ConnectionPool
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+        }
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        keep_alive=True,
+        timeout=None,
+        verbose=None,
+        ):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.verbose = verbose
+        self.requests = 0
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self._pools.get(key, None)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key, None)
+                if pool is None:
+                    pool = self.pool_class(
+                        scheme,
+                        host,
+                        port,
+                        maxsize=self.pool_size,
+                        idle_timeout=self.idle_timeout,
+                        connection_class=self.connection_classes.get(scheme, None),
+                        )
+                    self._pools[key] = pool
+        return pool
+
+    def _send(self, connection, method, path, data, headers):
+        try:
+            connection.request(method, path, data, headers)
+        except socket.timeout:
+            raise
+        except socket.error, e:
+            # the server can't act on a request it didn't get all of
+            raise _SendFailed(e)
+        response = connection.getresponse()
+        content = response.read()
+        return response, content
+
+    def _send_pipelined(self, connection, method, url, requests, responses):
+        # responses are appended as they are read, so the caller has those
+        # read before a failure
+        if connection.sock is None:
+            connection.connect()
+        connection.sock.sendall(''.join(requests))
+
+        fp = _UnclosableFile(connection.sock.makefile('rb'))
+        for i in range(len(requests)):
+            response = httplib.HTTPResponse(fp, method=method)
+            response.begin()
+            content = response.read()
+            responses.append(_response(response.status, dict(response.getheaders()), content, url))
+            if response.will_close:
+                # the server won't answer the rest of the requests we sent
+                break
+
+    def pipeline(self, method, url, bodies, headers=None, timeout=None):
+        """Send all the requests over one keep-alive connection before
+        reading any response (HTTP pipelining), so a batch costs roughly one
+        round-trip instead of one per request. The server handles pipelined
+        requests on a connection in order."""
+        split = urlparse.urlsplit(url)
+        scheme = split.scheme or 'http'
+        port = split.port or (443 if scheme == 'https' else 80)
+        path = split.path or '/'
+        if split.query:
+            path = "%s?%s" % (path, split.query)
+        if timeout is None:
+            timeout = self.timeout
+
+        head = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % split.netloc]
+        for key, value in (headers or {}).items():
+            head.append("%s: %s" % (key, value))
+        head = str('\r\n'.join(head)) # see request
+        requests = []
+        for body in bodies:
+            body = body or ''
+            requests.append("%s\r\nContent-Length: %i\r\n\r\n%s" % (head, len(body), body))
+        if not requests:
+            return []
+
+        if self.verbose is not None:
+            self.verbose.write("%s %s %s (pipelined x%i)\n" % (
+                    time.strftime('%Y-%m-%dT%H:%M:%S'), method, url, len(requests)))
+
+        pool = self._get_pool(scheme, split.hostname, port)
+        with self._lock:
+            self.requests += len(requests)
+
+        connection, reused = pool.get(timeout)
+        responses = []
+        try:
+            self._send_pipelined(connection, method, url, requests, responses)
+        except socket.timeout, e:
+            connection.close()
+            raise self._pipeline_error("Request to %s timed out" % url, e, responses)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            # Once any request has been answered the server was acting on the
+            # batch, so none of it is sent again. Nor is a batch of
+            # non-idempotent requests: sendall may have written some of them
+            # in full before failing.
+            if responses or not reused or method not in IDEMPOTENT_METHODS:
+                raise self._pipeline_error("Request to %s failed: %s" % (url, e), e, responses)
+            connection = pool.new_connection(timeout)
+            try:
+                self._send_pipelined(connection, method, url, requests, responses)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                raise self._pipeline_error("Request to %s failed: %s" % (url, e), e, responses)
+
+        if self.keep_alive and len(responses) == len(requests):
+            pool.put(connection)
+        else:
+            connection.close()
+        return responses
+
+    def _pipeline_error(self, message, error, responses):
+        error = TransportError(message, error)
+        error.responses = responses
+        return error
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        split = urlparse.urlsplit(url)
+        scheme = split.scheme or 'http'
+        port = split.port or (443 if scheme == 'https' else 80)
+        path = split.path or '/'
+        query = split.query
+        if params:
+            encoded = urllib.urlencode(params)
+            query = "%s&%s" % (query, encoded) if query else encoded
+        if query:
+            path = "%s?%s" % (path, query)
+        # URLs from Spire's JSON are unicode; httplib prepends the request
+        # line to the body, which fails for binary (compressed) bodies unless
+        # it is a byte string
+        path = str(path)
+
+        # callers may share header dicts between requests (see
+        # spire.resources), so copy before adding to them
+        if headers is None:
+            headers = {}
+        if not self.keep_alive:
+            headers = dict(headers, Connection='close')
+        if timeout is None:
+            timeout = self.timeout
+
+        if self.verbose is not None:
+            self.verbose.write("%s %s %s\n" % (time.strftime('%Y-%m-%dT%H:%M:%S'), method, url))
+
+        pool = self._get_pool(scheme, split.hostname, port)
+        with self._lock:
+            self.requests += 1
+
+        connection, reused = pool.get(timeout)
+        try:
+            response, content = self._send(connection, method, path, data, headers)
+        except socket.timeout, e:
+            connection.close()
+            raise TransportError("Request to %s timed out" % url, e)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            if not reused or not (method in IDEMPOTENT_METHODS or isinstance(e, _SendFailed)):
+                # A request that was written in full may have been acted on,
+                # answered or not, so whether to send it again is up to the
+                # RetryPolicy
+                raise TransportError("Request to %s failed: %s" % (url, e), e)
+            # The keep-alive connection was stale (closed by the server while
+            # it sat in the pool). Try once more on a fresh connection.
+            connection = pool.new_connection(timeout)
+            try:
+                response, content = self._send(connection, method, path, data, headers)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                raise TransportError("Request to %s failed: %s" % (url, e), e)
+
+        if self.keep_alive and not response.will_close:
+            pool.put(connection)
+        else:
+            connection.close()
+
+        return _response(response.status, dict(response.getheaders()), content, url)
+
+    def evict_idle(self):
+        return sum(pool.evict_idle() for pool in self._pools.values())
+
+    def stats(self):
+        totals = dict(
+            requests=self.requests,
+            connections_opened=0,
+            connections_reused=0,
+            connections_evicted=0,
+            connections_discarded=0,
+            )
+        hosts = {}
+        for (scheme, host, port), pool in self._pools.items():
+            pool_stats = pool.stats()
+            hosts["%s://%s:%i" % (scheme, host, port)] = pool_stats
+            for key in totals:
+                if key in pool_stats:
+                    totals[key] += pool_stats[key]
+        totals['hosts'] = hosts
+        return totals
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
@@ -0,0 +1,67 @@
+"""
+Tests for getting a client ready with overlapping requests.
+"""
+import time
+import unittest
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+import spire
+from spire.fakeserver import FakeSpireServer
+
+LATENCY = 0.2
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(latency=LATENCY).start()
+        self.secret = self.server.create_account()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, ttl=0):
+        # a stale discovery document, as a worker sharing a cache file has
+        cache = spire.DiscoveryCache(ttl=ttl)
+        cache.put(self.server.url, self.server.discovery())
+        return spire.Client(self.server.url, secret=self.secret, discovery_cache=cache)
+
+    def test_requests_overlap(self):
+        client = self.client()
+        start = time.time()
+        session = client.bootstrap(channels=['a', 'b'], subscriptions=True)
+        elapsed = time.time() - start
+        # discovery and session, channels and subscriptions, then creating
+        # both channels: three round-trips rather than six
+        assert elapsed < 5 * LATENCY, elapsed
+        assert session.subscription_collection.loaded
+        self.assertEqual(sorted(session.channel_collection), ['a', 'b'])
+        self.assertEqual(self.server.request_counts[('GET', 'get_discovery')], 1)
+        self.assertEqual(self.server.request_counts[('POST', 'create_channel')], 2)
+        session.channel('a').publish('hello')
+        client.close()
+
+    def test_fresh_discovery_is_not_fetched(self):
+        client = self.client(ttl=60)
+        session = client.bootstrap()
+        assert session.channel_collection is not None
+        assert not session.subscription_collection.loaded
+        self.assertEqual(self.server.request_counts.get(('GET', 'get_discovery'), 0), 0)
+        client.close()
+
+    def test_without_cache(self):
+        client = spire.Client(
+            self.server.url, secret=self.secret, discovery_cache=spire.DiscoveryCache())
+        session = client.bootstrap(channels=['a'])
+        self.assertEqual(session.channel('a').publish('hello')['content'], 'hello')
+        client.close()
+
+    if gevent is not None:
+        def test_evented(self):
+            client = spire.AsyncClient(self.server.url, secret=self.secret)
+            session = client.bootstrap(channels=['a', 'b'], subscriptions=True).get()
+            assert isinstance(session, spire.AsyncSession)
+            self.assertEqual(sorted(session.session.channel_collection), ['a', 'b'])
+            client.close()
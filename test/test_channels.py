@@ -0,0 +1,102 @@
+"""
+Tests for Session's channel cache and bulk lookup, using a transport that
+imitates the channels resource.
+"""
+import threading
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import spire
+from spire.transport import Response
+
+CHANNELS_URL = 'http://spire.test/session/1/channels'
+
+class ChannelsTransport(spire.Transport):
+    """Keeps a channel collection; POSTs create channels, or 409 if they exist"""
+    def __init__(self, existing=()):
+        self.channels = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        for name in existing:
+            self.add(name)
+
+    def add(self, name):
+        self.channels[name] = dict(
+            name=name,
+            url='%s/%s' % (CHANNELS_URL, name),
+            capabilities=dict(publish='publish-%s' % name),
+            )
+        return self.channels[name]
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        with self.lock:
+            self.requests.append((method, url))
+            if method == 'GET':
+                return Response(200, {}, json.dumps(self.channels), url)
+            name = json.loads(data)['name']
+            if name in self.channels:
+                return Response(409, {}, '', url)
+            return Response(201, {}, json.dumps(self.add(name)), url)
+
+def session(transport):
+    client = spire.Client('http://spire.test', transport=transport)
+    client.resources = {}
+    client.schema = dict(channels='channels', channel='channel')
+    return spire.Session(client, dict(
+            url='http://spire.test/session/1',
+            capabilities={},
+            resources=dict(channels=dict(
+                    url=CHANNELS_URL,
+                    capabilities=dict(all='all', create='create'),
+                    )),
+            ))
+
+class TestChannelCache(unittest.TestCase):
+    def test_channel_objects_are_cached(self):
+        transport = ChannelsTransport(existing=['foo'])
+        s = session(transport)
+        foo = s.channel('foo')
+        assert s.channel('foo') is foo
+        bar = s.channel('bar')
+        assert s.channel('bar') is bar
+        self.assertEqual(transport.requests, [('GET', CHANNELS_URL), ('POST', CHANNELS_URL)])
+
+    def test_least_recently_used_channels_are_evicted(self):
+        s = session(ChannelsTransport(existing=['a', 'b', 'c']))
+        s.channel_cache_size = 2
+        a = s.channel('a')
+        b = s.channel('b')
+        assert s.channel('a') is a
+        s.channel('c')
+        assert s.channel('a') is a
+        assert s.channel('b') is not b
+
+    def test_conflict_refetches_collection_only(self):
+        transport = ChannelsTransport()
+        s = session(transport)
+        s._get_channel_collection()
+        transport.add('taken') # created elsewhere after we fetched
+
+        channel = s.channel('taken')
+        self.assertEqual(channel.channel_resource['name'], 'taken')
+        self.assertEqual(
+            transport.requests,
+            [('GET', CHANNELS_URL), ('POST', CHANNELS_URL), ('GET', CHANNELS_URL)],
+            )
+
+    def test_bulk_get_or_create(self):
+        transport = ChannelsTransport(existing=['a', 'c'])
+        s = session(transport)
+        names = ['a', 'b', 'c', 'd', 'e', 'b']
+        channels = s.channels(names, concurrency=3)
+
+        self.assertEqual([c.channel_resource['name'] for c in channels], names)
+        assert channels[1] is channels[5]
+        assert s.channel('d') is channels[3]
+        methods = [method for method, url in transport.requests]
+        self.assertEqual(methods.count('GET'), 1)
+        self.assertEqual(methods.count('POST'), 3)
@@ -0,0 +1,70 @@
+"""
+Tests for the checkpoint stores.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import spire
+
+class StoreTests(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoints')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_positions_survive_reopening(self):
+        store = self.store()
+        self.assertEqual(store.load('a'), None)
+        store.save('a', 10)
+        store.save('b', 20)
+        store.save('a', 11)
+        store.close()
+
+        store = self.store()
+        self.assertEqual(store.load('a'), 11)
+        self.assertEqual(store.load('b'), 20)
+        store.close()
+
+    def test_sync_interval_batches_writes(self):
+        store = self.store(sync_interval=60)
+        writes = []
+        write = store._write
+        store._write = lambda changed: writes.append(dict(changed)) or write(changed)
+
+        store.save('a', 1) # first save is written straight away
+        store.save('a', 2)
+        store.save('b', 3)
+        self.assertEqual(writes, [dict(a=1)])
+        self.assertEqual(self.store().load('a'), 1)
+
+        store.flush()
+        self.assertEqual(writes, [dict(a=1), dict(a=2, b=3)])
+        self.assertEqual(self.store().load('a'), 2)
+
+class TestFileCheckpointStore(StoreTests, unittest.TestCase):
+    def store(self, **kwargs):
+        return spire.FileCheckpointStore(self.path, **kwargs)
+
+    def test_no_temporary_file_left_behind(self):
+        store = self.store()
+        store.save('a', 1)
+        self.assertEqual(os.listdir(self.directory), ['checkpoints'])
+
+class TestSQLiteCheckpointStore(StoreTests, unittest.TestCase):
+    def store(self, **kwargs):
+        return spire.SQLiteCheckpointStore(self.path, **kwargs)
+
+class TestCheckpointer(unittest.TestCase):
+    def test_interval(self):
+        store = spire.MemoryCheckpointStore()
+        checkpointer = spire.checkpoint.Checkpointer(store, 'a', interval=0.05)
+        checkpointer.processed(1)
+        self.assertEqual(store.load('a'), None)
+        time.sleep(0.06)
+        checkpointer.processed(2)
+        self.assertEqual(store.load('a'), 2)
@@ -0,0 +1,67 @@
+"""
+Tests for codec selection and its use by the client.
+"""
+import unittest
+
+import spire
+from spire.codec import get_codec, available_codecs
+from spire.transport import Response
+
+class RecordingCodec(spire.JSONCodec):
+    name = 'recording'
+
+    def __init__(self):
+        self.decoded = []
+        self.encoded = []
+
+    def encode(self, obj):
+        self.encoded.append(obj)
+        return spire.JSONCodec.encode(self, obj)
+
+    def decode(self, data):
+        self.decoded.append(data)
+        return spire.JSONCodec.decode(self, data)
+
+class EchoTransport(spire.Transport):
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        return Response(201, {}, data, url)
+
+class TestCodec(unittest.TestCase):
+    def test_get_codec(self):
+        assert isinstance(get_codec('json'), spire.JSONCodec)
+        codec = RecordingCodec()
+        assert get_codec(codec) is codec
+        self.assertRaises(ValueError, get_codec, 'yaml')
+        # simplejson or json by default, since ujson rounds floats
+        assert get_codec().name in ('simplejson', 'json')
+
+    def test_codecs_agree(self):
+        document = dict(messages=[dict(content=u'caf\xe9', timestamp=1)], last=1)
+        body = spire.JSONCodec().encode(document)
+        for codec in available_codecs():
+            self.assertEqual(codec.decode(codec.encode(document)), document)
+            self.assertEqual(codec.decode(body), document)
+
+    def test_values_survive_a_round_trip(self):
+        document = dict(price=0.1234567890123, big=2 ** 70, url='http://x/y')
+        for codec in available_codecs():
+            body = codec.encode(document)
+            assert '\\/' not in body, (codec.name, body)
+            self.assertEqual(codec.decode(body), document)
+            self.assertEqual(codec.decode(spire.JSONCodec().encode(document)), document)
+        # the default codec doesn't round floats at all
+        codec = get_codec()
+        self.assertEqual(codec.decode(codec.encode(0.1 + 0.2)), 0.1 + 0.2)
+
+    def test_client_uses_its_codec(self):
+        codec = RecordingCodec()
+        client = spire.Client('http://spire.test', transport=EchoTransport(), codec=codec)
+        client.resources = {}
+        client.schema = dict(message='message')
+        channel = spire.Channel(client, None, dict(
+                url='http://spire.test/channel/1',
+                capabilities=dict(publish='publish'),
+                ))
+        self.assertEqual(channel.publish('hello'), dict(content='hello'))
+        self.assertEqual(codec.encoded, [dict(content='hello')])
+        self.assertEqual(len(codec.decoded), 1)
@@ -0,0 +1,79 @@
+"""
+Tests for compressed request bodies and responses.
+"""
+import unittest
+import zlib
+
+import spire
+from spire.compression import compress, decompress
+from spire.fakeserver import FakeSpireServer
+
+def document(i):
+    # the kind of large, repetitive JSON document that compresses well
+    return dict(id=i, items=[dict(name='item %i' % n, tags=['a', 'b', 'c']) for n in range(100)])
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        data = 'spire ' * 1000
+        for encoding in ('gzip', 'deflate'):
+            self.assertEqual(decompress(compress(data, encoding), encoding), data)
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.assertEqual(decompress(raw.compress(data) + raw.flush(), 'deflate'), data)
+        self.assertRaises(ValueError, decompress, data, 'br')
+
+    def test_threshold(self):
+        compression = spire.Compression(threshold=100)
+        self.assertEqual(compression.compress('x' * 50), ('x' * 50, None))
+        body, encoding = compression.compress('x' * 500)
+        self.assertEqual(encoding, 'gzip')
+        stats = compression.stats()
+        self.assertEqual((stats['compressed'], stats['skipped']), (1, 1))
+        self.assertEqual((stats['bytes_in'], stats['bytes_out']), (500, len(body)))
+
+class TestCompressionWithServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(max_timeout=0.1, max_body=100000).start()
+        self.secret = self.server.create_account()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        return spire.Client(self.server.url, secret=self.secret, **kwargs)
+
+    def publish_and_poll(self, client, name):
+        channel = client.session().channel(name)
+        received = self.server.bytes_received
+        sent = self.server.bytes_sent
+        channel.publish(document(0))
+        channel.publish_many([document(i) for i in range(1, 4)])
+        events = channel.subscription().subscribe()
+        self.assertEqual([e['content'] for e in events['messages']], [document(i) for i in range(4)])
+        client.close()
+        return self.server.bytes_received - received, self.server.bytes_sent - sent
+
+    def test_fewer_bytes_on_the_wire(self):
+        plain_received, plain_sent = self.publish_and_poll(self.client(), 'plain')
+        client = self.client(compression='gzip')
+        calls = []
+        client.add_hook(lambda call: call['phase'] == 'after' and calls.append(call))
+        received, sent = self.publish_and_poll(client, 'gzipped')
+        assert received * 5 < plain_received, (received, plain_received)
+        assert sent * 5 < plain_sent, (sent, plain_sent)
+        self.assertEqual(client.compression.stats()['compressed'], 4)
+        subscribe = [call for call in calls if call['operation'] == 'subscribe'][0]
+        assert subscribe['bytes_received'] < len(client.codec.encode(document(0)))
+
+    def test_max_payload(self):
+        client = self.client(max_payload=1000)
+        channel = client.session().channel('docs')
+        publishes = self.server.request_counts.get(('POST', '_publish'), 0)
+        self.assertRaises(spire.PayloadTooLarge, channel.publish, document(0))
+        self.assertRaises(spire.PayloadTooLarge, channel.publish_many, ['small', document(0)])
+        self.assertEqual(self.server.request_counts.get(('POST', '_publish'), 0), publishes)
+        channel.publish('small')
+
+    def test_server_rejects_large_bodies(self):
+        channel = self.client(compression=True).session().channel('docs')
+        # compressed it is small, but the server decompresses it
+        self.assertRaises(spire.PayloadTooLarge, channel.publish, 'x' * 200000)
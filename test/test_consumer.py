@@ -0,0 +1,313 @@
+"""
+Tests for consuming subscriptions through a bounded queue.
+"""
+import threading
+import time
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+import spire
+from spire.consumer import AckTracker
+from spire.transport import Response
+
+from test_subscription import page, subscription
+
+class PagesTransport(spire.Transport):
+    """Returns the pages given, then empty pages after a short wait, like
+    long-polls that time out"""
+    def __init__(self, pages, sleep=time.sleep):
+        self.pages = list(pages)
+        self.sleep = sleep
+        self.lasts = []
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        self.lasts.append(params['last'])
+        if self.pages:
+            result = self.pages.pop(0)
+        else:
+            self.sleep(0.01)
+            result = dict(messages=[], last=params['last'])
+        return Response(200, {}, json.dumps(result), url)
+
+class HeldTransport(PagesTransport):
+    """Holds the poll after the given pages open until `release` is set"""
+    def __init__(self, pages, late_page):
+        PagesTransport.__init__(self, pages)
+        self.late_page = late_page
+        self.polling = threading.Event()
+        self.release = threading.Event()
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        if not self.pages and self.late_page is not None:
+            self.lasts.append(params['last'])
+            self.polling.set()
+            self.release.wait()
+            result, self.late_page = self.late_page, None
+            return Response(200, {}, json.dumps(result), url)
+        return PagesTransport.request(self, method, url, headers, data, params, timeout)
+
+def square(event):
+    # runs in a pool process, so it has to be picklable
+    return event['content'] ** 2
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+class TestQueueConsumer(unittest.TestCase):
+    def test_full_queue_pauses_polling(self):
+        transport = PagesTransport([page(*range(1, 11)), page(11)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+        release = threading.Event()
+        handled = []
+
+        def _handler(event):
+            release.wait()
+            handled.append(event['timestamp'])
+
+        consumer = spire.QueueConsumer(sub, _handler, maxsize=2).start()
+        wait_for(lambda: consumer.paused)
+        metrics = consumer.metrics()
+        self.assertEqual(metrics['depth'], 2)
+        self.assertEqual(metrics['polls'], 1) # not fetching more while full
+        self.assertEqual(store.load('sub'), None)
+
+        release.set()
+        wait_for(lambda: len(handled) == 11)
+        consumer.stop()
+        self.assertEqual(handled, range(1, 12))
+        self.assertEqual(store.load('sub'), 11)
+        metrics = consumer.metrics()
+        self.assertEqual(metrics['lag'], 0)
+        self.assertEqual(metrics['processed'], 11)
+        self.assertEqual(metrics['pending'], 0)
+
+    def test_checkpoint_waits_for_every_worker(self):
+        transport = PagesTransport([page(1, 2, 3)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+        slow = threading.Event()
+
+        def _handler(event):
+            if event['timestamp'] == 1:
+                slow.wait()
+
+        consumer = spire.QueueConsumer(sub, _handler, workers=3).start()
+        wait_for(lambda: consumer.processed == 2)
+        # 2 and 3 are done, but 1 isn't, so the position can't move
+        self.assertEqual(store.load('sub'), None)
+        metrics = consumer.metrics()
+        self.assertEqual(metrics['lag'], None)
+        self.assertEqual(metrics['pending'], 1)
+        self.assertEqual(metrics['unacknowledged'], 3)
+        slow.set()
+        assert consumer.drain(timeout=5)
+        self.assertEqual(store.load('sub'), 3)
+        consumer.stop()
+
+    def test_handler_errors_are_reported(self):
+        transport = PagesTransport([page(1, 2)])
+        errors = []
+
+        def _handler(event):
+            if event['timestamp'] == 1:
+                raise ValueError("bad event")
+
+        consumer = spire.QueueConsumer(
+            subscription(transport), _handler, on_error=errors.append).start()
+        wait_for(lambda: consumer.processed == 2)
+        consumer.stop()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], ValueError)
+
+    def test_failed_events_are_not_acknowledged(self):
+        transport = PagesTransport([page(1, 2, 3)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+
+        def _handler(event):
+            if event['timestamp'] == 2:
+                raise ValueError("bad event")
+
+        consumer = spire.QueueConsumer(sub, _handler, on_error=lambda exc_info: None).start()
+        wait_for(lambda: consumer.processed == 3)
+        # 3 was handled, but the position stays before 2
+        self.assertEqual(store.load('sub'), 1)
+        consumer.stop()
+        self.assertEqual(store.load('sub'), 1)
+        self.assertEqual(sub.last_timestamp, 1)
+        self.assertEqual(consumer.metrics()['errors'], 1)
+
+        # after a restart 2 is delivered again, then 3
+        handled = []
+        transport.pages.append(page(2, 3))
+        consumer = spire.QueueConsumer(sub, lambda event: handled.append(event['timestamp'])).start()
+        wait_for(lambda: len(handled) == 2)
+        consumer.stop()
+        self.assertEqual(handled, [2, 3])
+        self.assertEqual(store.load('sub'), 3)
+
+    def test_acknowledge_errors(self):
+        transport = PagesTransport([page(1, 2, 3)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+
+        def _handler(event):
+            if event['timestamp'] == 2:
+                raise ValueError("bad event")
+
+        consumer = spire.QueueConsumer(
+            sub, _handler, on_error=lambda exc_info: None, acknowledge_errors=True).start()
+        wait_for(lambda: consumer.processed == 3)
+        consumer.stop()
+        self.assertEqual(store.load('sub'), 3)
+
+    def test_stop_while_paused_resumes_at_the_unqueued_event(self):
+        transport = PagesTransport([page(1, 2, 3, 4)])
+        sub = subscription(transport)
+        handling = threading.Event()
+        release = threading.Event()
+
+        def _handler(event):
+            handling.set()
+            release.wait()
+
+        consumer = spire.QueueConsumer(sub, _handler, maxsize=1).start()
+        wait_for(lambda: handling.is_set() and consumer.enqueued == 2 and consumer.paused)
+        consumer.running = False
+        wait_for(lambda: sub.last_timestamp != 4)
+        # 1 is being handled and 2 is queued; 3 and 4 will be fetched again
+        self.assertEqual(sub.last_timestamp, 2)
+        release.set()
+        consumer.stop()
+
+    def test_poll_in_flight_when_stopped_queues_nothing(self):
+        transport = HeldTransport([page(1)], page(2))
+        sub = subscription(transport)
+        handled = []
+        consumer = spire.QueueConsumer(sub, lambda event: handled.append(event['timestamp'])).start()
+        transport.polling.wait(5)
+        consumer.stop()
+        transport.release.set()
+        wait_for(lambda: transport.late_page is None)
+        time.sleep(0.05)
+        # 2 arrived after the stop, so it is left to be fetched again
+        self.assertEqual(handled, [1])
+        self.assertEqual(sub.last_timestamp, 1)
+        metrics = consumer.metrics()
+        self.assertEqual((metrics['pending'], metrics['depth']), (0, 0))
+        assert consumer.drain(timeout=1)
+
+    def test_stop_without_draining_discards_queued_events(self):
+        transport = PagesTransport([page(1, 2, 3)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+        handling = threading.Event()
+        release = threading.Event()
+
+        def _handler(event):
+            handling.set()
+            release.wait()
+
+        consumer = spire.QueueConsumer(sub, _handler).start()
+        wait_for(lambda: handling.is_set() and consumer.enqueued == 3)
+        threading.Timer(0.1, release.set).start()
+        consumer.stop(drain=False)
+        # 1 was being handled; 2 and 3 are fetched again after a restart
+        wait_for(lambda: consumer.processed == 1)
+        metrics = consumer.metrics()
+        self.assertEqual((metrics['pending'], metrics['unacknowledged']), (0, 0))
+        self.assertEqual(sub.last_timestamp, 1)
+        self.assertEqual(store.load('sub'), 1)
+
+    def test_partitions_keep_per_key_order(self):
+        events = [dict(content=dict(key=i % 3, n=i), timestamp=i) for i in range(1, 31)]
+        transport = PagesTransport([dict(messages=events[:15], last=15), dict(messages=events[15:], last=30)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+        handled = []
+        lock = threading.Lock()
+
+        def _handler(event):
+            time.sleep(0.001 * (event['timestamp'] % 4))
+            with lock:
+                handled.append(event['content'])
+
+        consumer = spire.QueueConsumer(
+            sub, _handler, workers=3, maxsize=6, partition=lambda event: event['content']['key'])
+        consumer.start()
+        wait_for(lambda: len(handled) == 30)
+        consumer.stop()
+        for key in range(3):
+            self.assertEqual(
+                [e['n'] for e in handled if e['key'] == key],
+                [i for i in range(1, 31) if i % 3 == key],
+                )
+        self.assertEqual(store.load('sub'), 30)
+
+    def test_process_pool(self):
+        events = [dict(content=i, timestamp=i) for i in range(1, 9)]
+        transport = PagesTransport([dict(messages=events, last=8)])
+        sub = subscription(transport)
+        store = spire.MemoryCheckpointStore()
+        sub.checkpoint_to(store, key='sub', every=1)
+        consumer = spire.QueueConsumer(sub, square, workers=2, processes=2).start()
+        wait_for(lambda: consumer.processed == 8)
+        consumer.stop()
+        self.assertEqual(consumer.errors, 0)
+        self.assertEqual(store.load('sub'), 8)
+
+    def test_ack_tracker(self):
+        acks = AckTracker()
+        first, second, third = acks.add(1), acks.add(2), acks.add(3)
+        self.assertEqual(acks.acknowledge(second), None)
+        self.assertEqual(acks.acknowledge(first), (2, 2))
+        fourth = acks.add(4)
+        acks.discard_last()
+        self.assertEqual(acks.acknowledge(third), (3, 1))
+        self.assertEqual(len(acks), 0)
+
+        entries = [acks.add(t) for t in (5, 6, 7, 8)]
+        self.assertEqual(acks.discard([entries[2], entries[1]]), 5)
+        # 8 was after a discarded event, so acknowledging it moves nothing
+        self.assertEqual(acks.acknowledge(entries[3]), None)
+        self.assertEqual(acks.acknowledge(entries[0]), (5, 1))
+        self.assertEqual(len(acks), 0)
+
+        entries = [acks.add(t) for t in (9, 10)]
+        self.assertEqual(acks.fail(entries[1]), 9)
+        # nothing after a failed event moves the position
+        later = acks.add(11)
+        self.assertEqual(acks.acknowledge(later), None)
+        self.assertEqual(acks.acknowledge(entries[0]), (9, 1))
+        self.assertEqual(len(acks), 0)
+
+    if gevent is not None:
+        def test_evented(self):
+            transport = PagesTransport([page(1, 2), page(3)], sleep=gevent.sleep)
+            handled = []
+            consumer = spire.EventedQueueConsumer(
+                subscription(transport), lambda event: handled.append(event['timestamp']), workers=2)
+            consumer.start()
+            gevent.sleep(0.1)
+            consumer.stop()
+            self.assertEqual(sorted(handled), [1, 2, 3])
@@ -0,0 +1,88 @@
+"""
+Tests for discovery caching, using a transport that serves a canned
+discovery document.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import spire
+from spire.transport import Response
+
+DISCOVERY = dict(
+    resources=dict(
+        sessions=dict(url='http://spire.test/sessions'),
+        accounts=dict(url='http://spire.test/accounts'),
+        ),
+    schema={'1.0': dict(
+            session=dict(mediaType='application/vnd.spire-io.session+json;version=1.0'),
+            )},
+    )
+
+class DiscoveryTransport(spire.Transport):
+    etag = '"v1"'
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        if headers.get('If-None-Match', None) == self.etag:
+            return Response(304, {'etag': self.etag}, '', url)
+        return Response(200, {'etag': self.etag}, json.dumps(DISCOVERY), url)
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transport = DiscoveryTransport()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def client(self, cache):
+        return spire.Client('http://spire.test', transport=self.transport, discovery_cache=cache)
+
+    def test_clients_share_discovery(self):
+        cache = spire.DiscoveryCache()
+        first = self.client(cache)
+        first._discover()
+        second = self.client(cache)
+        second._discover()
+
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual(second.resources, first.resources)
+        self.assertEqual(second.schema['session'], 'application/vnd.spire-io.session+json;version=1.0')
+
+    def test_stale_entries_are_revalidated(self):
+        cache = spire.DiscoveryCache(ttl=0)
+        self.client(cache)._discover()
+        client = self.client(cache)
+        client._discover()
+
+        self.assertEqual(len(self.transport.requests), 2)
+        self.assertEqual(self.transport.requests[1]['If-None-Match'], '"v1"')
+        self.assertEqual(client.resources, DISCOVERY['resources'])
+
+    def test_cache_persists_to_disk(self):
+        path = os.path.join(self.directory, 'discovery.json')
+        self.client(spire.DiscoveryCache(path=path))._discover()
+        client = self.client(spire.DiscoveryCache(path=path))
+        client._discover()
+
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual(client.resources, DISCOVERY['resources'])
+
+    def test_preload(self):
+        cache = spire.DiscoveryCache()
+        cache.preload('http://spire.test', DISCOVERY)
+        client = self.client(cache)
+        client._discover()
+        self.assertEqual(self.transport.requests, [])
+        self.assertEqual(client.resources, DISCOVERY['resources'])
@@ -0,0 +1,68 @@
+"""
+Tests for routing events to handlers.
+"""
+import unittest
+
+import spire
+from spire.dispatch import content_field, content_prefix
+
+def event(content, timestamp=1):
+    return dict(content=content, timestamp=timestamp)
+
+class TestDispatcher(unittest.TestCase):
+    def test_routing_keys(self):
+        dispatcher = spire.Dispatcher(key=content_prefix(':'))
+        reports = []
+        dispatcher.on('report', reports.append)
+
+        @dispatcher.on('getVersion')
+        def get_version(event):
+            reports.append('asked')
+
+        dispatcher(dict(messages=[
+                    event('report: web-1: abc'),
+                    event('getVersion'),
+                    event('something else'),
+                    event(dict(not_a='string')),
+                    ]))
+        self.assertEqual(reports, [event('report: web-1: abc'), 'asked'])
+        self.assertEqual(dispatcher.stats(), dict(
+                events=4,
+                unmatched=2,
+                keys=dict(report=1, getVersion=1),
+                routes=[],
+                ))
+
+    def test_predicates_and_default(self):
+        unmatched = []
+        dispatcher = spire.Dispatcher(key=content_field('type'), default=unmatched.append)
+        deploys = []
+        big = []
+        dispatcher.on('deploy', deploys.append)
+        dispatcher.route(lambda e: e['content'].get('size', 0) > 10, big.append)
+
+        self.assertEqual(dispatcher.dispatch(event(dict(type='deploy', size=20))), 2)
+        self.assertEqual(dispatcher.dispatch(event(dict(type='alert', size=1))), 0)
+        self.assertEqual(len(deploys), 1)
+        self.assertEqual(len(big), 1)
+        self.assertEqual(unmatched, [event(dict(type='alert', size=1))])
+
+    def test_keys_need_a_key_function(self):
+        self.assertRaises(ValueError, spire.Dispatcher().on, 'report', lambda e: None)
+
+    def test_subscription_callback(self):
+        from spire.fakeserver import FakeSpireServer
+        server = FakeSpireServer(max_timeout=0.1).start()
+        try:
+            client = spire.Client(server.url, secret=server.create_account())
+            channel = client.session().channel('foo')
+            channel.publish_many(['report: a', 'getVersion', 'report: b'])
+            dispatcher = spire.Dispatcher(key=content_prefix())
+            reports = []
+            dispatcher.on('report', lambda e: reports.append(e['content']))
+
+            assert channel.subscription().subscribe(callback=dispatcher) is True
+            self.assertEqual(reports, ['report: a', 'report: b'])
+            client.close()
+        finally:
+            server.stop()
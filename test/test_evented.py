@@ -0,0 +1,165 @@
+"""
+Tests for the gevent-based client classes. Skipped when gevent isn't
+installed.
+"""
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+import spire
+
+EVENTS_TYPE = 'application/vnd.spire-io.events+json;version=1.0'
+POLL_DELAY = 0.3
+
+class SlowEventsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every GET like a long-poll that gets one event after a delay"""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        time.sleep(POLL_DELAY)
+        content = json.dumps(dict(
+                messages=[dict(content=self.path, timestamp=1)],
+                last=1,
+                ))
+        self.send_response(200)
+        self.send_header('Content-Type', EVENTS_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 100
+
+class TestAsyncSubscription(unittest.TestCase):
+    def setUp(self):
+        if gevent is None:
+            raise unittest.SkipTest("gevent is not installed")
+        self.server = ThreadedServer(('127.0.0.1', 0), SlowEventsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+        self.client = spire.AsyncClient(self.url)
+        # skip discovery, the stub server only serves events
+        self.client.client.resources = {}
+        self.client.client.schema = dict(events=EVENTS_TYPE)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subscription(self, i):
+        return spire.AsyncSubscription(self.client, dict(
+                url='%s/subscription/%i' % (self.url, i),
+                capabilities=dict(events='events-%i' % i),
+                ))
+
+    def test_long_polls_run_concurrently(self):
+        subscriptions = [self.subscription(i) for i in range(30)]
+
+        start = time.time()
+        polls = [s.subscribe() for s in subscriptions]
+        gevent.joinall(polls, raise_error=True)
+        elapsed = time.time() - start
+
+        # one poll takes POLL_DELAY; thirty in sequence would take 30 times that
+        assert elapsed < POLL_DELAY * 5, elapsed
+        for i, poll in enumerate(polls):
+            messages = poll.get()['messages']
+            assert messages[0]['content'].startswith('/subscription/%i?' % i)
+        self.assertEqual(subscriptions[0].last_timestamp, 1)
+
+    def test_subscribe_with_callback(self):
+        received = []
+        poll = self.subscription(0).subscribe(callback=received.append)
+        self.assertEqual(poll.get(), True)
+        self.assertEqual(len(received), 1)
+
+    def test_listen_calls_back_per_event(self):
+        received = []
+        listener = self.subscription(0).listen(received.append)
+        gevent.sleep(POLL_DELAY * 2.5)
+        listener.kill()
+        self.assertEqual(len(received), 2)
+
+class HelloHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write('hello')
+
+    def log_message(self, *args):
+        pass
+
+class QuietServer(ThreadedServer):
+    def handle_error(self, request, client_address):
+        pass # failed handshakes are expected
+
+class TestGeventHTTPS(unittest.TestCase):
+    def setUp(self):
+        if gevent is None or not hasattr(spire.evented, 'GeventHTTPSConnection'):
+            raise unittest.SkipTest("gevent with SSL support is not installed")
+        self.dir = tempfile.mkdtemp()
+        self.cert = os.path.join(self.dir, 'cert.pem')
+        try:
+            subprocess.check_call(
+                ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                 '-subj', '/CN=localhost', '-keyout', self.cert, '-out', self.cert],
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(self.dir)
+            raise unittest.SkipTest("openssl is not available")
+        self.server = QuietServer(('127.0.0.1', 0), HelloHandler)
+        self.server.socket = ssl.wrap_socket(
+            self.server.socket, certfile=self.cert, server_side=True)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_untrusted_certificate_is_refused(self):
+        transport = spire.GeventTransport()
+        self.assertRaises(
+            spire.TransportError, transport.get, 'https://localhost:%i/' % self.port)
+
+    def test_trusted_certificate(self):
+        import gevent.ssl
+        context = gevent.ssl.create_default_context(cafile=self.cert)
+        connection = spire.evented.GeventHTTPSConnection('localhost', self.port, context=context)
+        connection.request('GET', '/')
+        self.assertEqual(connection.getresponse().read(), 'hello')
+        # the certificate is for localhost, not 127.0.0.1
+        connection = spire.evented.GeventHTTPSConnection('127.0.0.1', self.port, context=context)
+        self.assertRaises(ssl.CertificateError, connection.request, 'GET', '/')
@@ -0,0 +1,80 @@
+"""
+Tests for the fake Spire server's behaviour where the client depends on it
+matching the real service.
+"""
+import threading
+import time
+import unittest
+
+import spire
+from spire.fakeserver import FakeSpireServer
+
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(max_timeout=2).start()
+        self.client = spire.Client(self.server.url, secret=self.server.create_account())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_unknown_secret_is_rejected(self):
+        client = spire.Client(self.server.url, secret='nope')
+        self.assertRaises(spire.SpireClientException, client.session)
+
+    def test_capabilities_are_checked(self):
+        channel = self.client.session().channel('foo')
+        resource = dict(channel.channel_resource, capabilities=dict(publish='forged'))
+        forged = spire.Channel(self.client, None, resource)
+        self.assertRaises(spire.SpireClientException, forged.publish, 'hello')
+
+    def test_channel_names_conflict(self):
+        session = self.client.session()
+        session.channel('foo')
+        response = self.client._request(
+            'POST',
+            session.resource.channels_url,
+            headers=session.resource.headers('create_channel', self.client.schema),
+            data=self.client.codec.encode(dict(name='foo')),
+            )
+        self.assertEqual(response.status_code, 409)
+
+    def test_long_poll_wakes_on_publish(self):
+        channel = self.client.session().channel('foo')
+        subscription = channel.subscription()
+
+        def _publish():
+            time.sleep(0.2)
+            channel.publish('hello')
+        thread = threading.Thread(target=_publish)
+        thread.start()
+        start = time.time()
+        events = subscription.subscribe()
+        thread.join()
+
+        self.assertEqual([x['content'] for x in events['messages']], ['hello'])
+        assert time.time() - start < 1.5
+
+    def test_newest_first_pages_follow_last(self):
+        self.server.newest_first = True
+        channel = self.client.session().channel('foo')
+        subscription = channel.subscription()
+        subscription.poll_with(spire.FixedPolling(timeout=0, limit=2))
+        for i in range(5):
+            channel.publish(i)
+
+        # the oldest two, newest first
+        page = subscription.poll(last_timestamp=0)
+        self.assertEqual([x['content'] for x in page['messages']], [1, 0])
+
+        events = subscription.events(last_timestamp=0)
+        self.assertEqual([events.next()['content'] for i in range(5)], range(5))
+
+    def test_latency_is_injected(self):
+        self.server.latency = 0.05
+        session = self.client.session()
+        start = time.time()
+        session.channel('foo')
+        # fetching the collection and creating the channel
+        assert time.time() - start >= 0.1
+        self.assertEqual(self.server.request_counts[('POST', 'create_channel')], 1)
@@ -0,0 +1,175 @@
+"""
+Tests for SubscriptionManager, using stand-in subscriptions that hand out
+canned pages of events instead of long-polling Spire.
+"""
+import time
+import unittest
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+import spire
+
+class FakeSubscription(object):
+    """Serves `pages` of events in order, then idles like an empty long-poll"""
+    def __init__(self, name, pages, sleep=time.sleep):
+        self.subscription_resource = dict(url='http://spire.test/subscription/%s' % name)
+        self.last_timestamp = None
+        self.pages = list(pages)
+        self.requested = []
+        self.sleep = sleep
+
+    def subscribe(self, last_timestamp=None, callback=None):
+        self.requested.append(last_timestamp)
+        self.sleep(0.01)
+        if not self.pages:
+            return dict(messages=[], last=last_timestamp)
+        messages = self.pages.pop(0)
+        if isinstance(messages, Exception):
+            raise messages
+        return dict(messages=messages, last=messages[-1]['timestamp'])
+
+class HeldSubscription(FakeSubscription):
+    """Returns event 1 to any poll from before it, holding the first poll
+    until `released` is set"""
+    def __init__(self, name, sleep=time.sleep):
+        FakeSubscription.__init__(self, name, [], sleep=sleep)
+        self.released = False
+        self.discarded = 0
+
+    def _discard_page(self):
+        self.discarded += 1
+
+    def subscribe(self, last_timestamp=None, callback=None):
+        self.requested.append(last_timestamp)
+        if len(self.requested) == 1:
+            while not self.released:
+                self.sleep(0.01)
+        self.sleep(0.01)
+        if last_timestamp < 1:
+            return dict(messages=page(1), last=1)
+        return dict(messages=[], last=last_timestamp)
+
+def page(*timestamps):
+    return [dict(content='event %i' % t, timestamp=t) for t in timestamps]
+
+def wait_for(condition, timeout=2.0, sleep=time.sleep):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        sleep(0.01)
+    return condition()
+
+class TestSubscriptionManager(unittest.TestCase):
+    manager_class = spire.SubscriptionManager
+    sleep = staticmethod(time.sleep)
+
+    def setUp(self):
+        self.errors = []
+        self.manager = self.manager_class(
+            on_error=lambda subscription, exc_info: self.errors.append(exc_info[1]),
+            )
+
+    def tearDown(self):
+        self.manager.stop()
+        self.sleep(0.05) # let the pollers notice
+
+    def test_dispatches_to_each_callback(self):
+        received = dict(a=[], b=[])
+        a = FakeSubscription('a', [page(1, 2), page(3)], sleep=self.sleep)
+        b = FakeSubscription('b', [page(10)], sleep=self.sleep)
+        self.manager.add(a, lambda events: received['a'].extend(events['messages']))
+        self.manager.add(b, lambda events: received['b'].extend(events['messages']))
+        self.manager.start()
+
+        assert wait_for(lambda: len(received['a']) == 3 and len(received['b']) == 1, sleep=self.sleep)
+        self.assertEqual([m['timestamp'] for m in received['a']], [1, 2, 3])
+        self.assertEqual([m['timestamp'] for m in received['b']], [10])
+
+        # each subscription resumes from its own position
+        self.assertEqual(a.requested[:3], [0, 2, 3])
+        self.assertEqual(b.requested[:2], [0, 10])
+
+        metrics = self.manager.metrics()
+        self.assertEqual(metrics['events'], 4)
+        assert metrics['polls'] >= 3
+        assert metrics['poll_latency']['p50'] >= 0.01
+        assert metrics['events_per_second'] > 0
+        self.assertEqual(metrics['subscriptions'][a.subscription_resource['url']]['events'], 3)
+
+    def test_starts_from_given_timestamp(self):
+        a = FakeSubscription('a', [], sleep=self.sleep)
+        self.manager.add(a, lambda events: None, last_timestamp=42)
+        self.manager.start()
+        assert wait_for(lambda: a.requested, sleep=self.sleep)
+        self.assertEqual(a.requested[0], 42)
+
+    def test_errors_are_reported_and_polling_continues(self):
+        received = []
+        a = FakeSubscription('a', [spire.SpireClientException("boom"), page(1)], sleep=self.sleep)
+        self.manager.add(a, received.append)
+        spire.manager.ERROR_BACKOFF, backoff = 0.01, spire.manager.ERROR_BACKOFF
+        try:
+            self.manager.start()
+            assert wait_for(lambda: received, sleep=self.sleep)
+        finally:
+            spire.manager.ERROR_BACKOFF = backoff
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(self.manager.metrics()['errors'], 1)
+
+    def test_remove_stops_dispatching(self):
+        received = []
+        a = FakeSubscription('a', [], sleep=self.sleep)
+        self.manager.add(a, received.append)
+        self.manager.start()
+        assert wait_for(lambda: a.requested, sleep=self.sleep)
+        self.manager.remove(a)
+        a.pages.append(page(1))
+        self.sleep(0.05)
+        self.assertEqual(received, [])
+
+        self.manager.add(a, received.append)
+        self.assertRaises(ValueError, self.manager.add, a, received.append)
+
+    def test_restart_while_polling(self):
+        received = []
+        a = HeldSubscription('a', sleep=self.sleep)
+        self.manager.add(a, lambda events: received.extend(events['messages']))
+        self.manager.start()
+        assert wait_for(lambda: a.requested, sleep=self.sleep)
+        self.manager.stop()
+        self.manager.start()
+        self.sleep(0.05)
+        # no second loop polls alongside the one waiting for its poll
+        self.assertEqual(a.requested, [0])
+        a.released = True
+        assert wait_for(lambda: received, sleep=self.sleep)
+        self.sleep(0.05)
+        # the manager was running again when the poll returned, so its page
+        # is dispatched, once
+        self.assertEqual([m['content'] for m in received], ['event 1'])
+        self.assertEqual(a.discarded, 0)
+        self.assertEqual(a.requested[1:2], [1])
+
+    def test_page_returned_after_stop_is_dropped(self):
+        received = []
+        a = HeldSubscription('a', sleep=self.sleep)
+        self.manager.add(a, lambda events: received.extend(events['messages']))
+        self.manager.start()
+        assert wait_for(lambda: a.requested, sleep=self.sleep)
+        self.manager.stop()
+        a.released = True
+        assert wait_for(lambda: a.discarded, sleep=self.sleep)
+        self.assertEqual(received, [])
+
+        # polling again asks for the dropped page
+        self.manager.start()
+        assert wait_for(lambda: received, sleep=self.sleep)
+        self.assertEqual(a.requested[:2], [0, 0])
+        self.assertEqual([m['content'] for m in received], ['event 1'])
+
+if gevent is not None:
+    class TestEventedSubscriptionManager(TestSubscriptionManager):
+        manager_class = spire.EventedSubscriptionManager
+        sleep = staticmethod(gevent.sleep)
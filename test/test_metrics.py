@@ -0,0 +1,90 @@
+"""
+Tests for client hooks and the metrics collector.
+"""
+import unittest
+
+import spire
+from spire.fakeserver import FakeSpireServer
+from spire.metrics import Histogram
+from spire.transport import Response
+
+class FlakyTransport(spire.Transport):
+    """Fails the first `failures` requests with a 503"""
+    def __init__(self, failures):
+        self.failures = failures
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        if self.failures:
+            self.failures -= 1
+            return Response(503, {}, '', url)
+        return Response(200, {}, '{"ok": true}', url)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(max_timeout=0.1).start()
+        self.client = spire.Client(self.server.url, secret=self.server.create_account())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_hooks_see_every_call(self):
+        calls = []
+        self.client.add_hook(lambda call: calls.append((call['phase'], call['operation'])))
+        channel = self.client.session().channel('foo')
+        channel.publish('hello')
+        channel.subscription().subscribe()
+
+        self.assertEqual([operation for phase, operation in calls if phase == 'after'], [
+                'discover',
+                'create_session',
+                'get_channels',
+                'create_channel',
+                'publish',
+                'create_subscription',
+                'subscribe',
+                ])
+        self.assertEqual(calls[0], ('before', 'discover'))
+
+    def test_collector(self):
+        metrics = self.client.enable_metrics()
+        assert self.client.enable_metrics() is metrics
+        channel = self.client.session().channel('foo')
+        channel.publish('hello')
+        channel.publish_many(['a', 'b'])
+        self.assertRaises(spire.SpireClientException, self.client._request_json,
+            "nope", 'GET', self.server.url + '/missing', operation='missing')
+
+        snapshot = metrics.snapshot()
+        publish = snapshot['publish']
+        self.assertEqual(publish['calls'], 1)
+        self.assertEqual(publish['statuses'], {201: 1})
+        self.assertEqual(publish['in_flight'], 0)
+        self.assertEqual(publish['bytes_sent'], len(self.client.codec.encode(dict(content='hello'))))
+        assert publish['bytes_received'] > 0
+        self.assertEqual(publish['latency']['count'], 1)
+        self.assertEqual(snapshot['publish_many']['statuses'], {201: 2})
+        self.assertEqual(snapshot['missing']['errors'], 1)
+
+        text = metrics.prometheus()
+        assert '# TYPE spire_client_latency_seconds histogram' in text
+        assert 'spire_client_calls_total{operation="publish",status="201"} 1\n' in text
+        assert 'spire_client_latency_seconds_bucket{operation="publish",le="+Inf"} 1\n' in text
+        assert 'spire_client_latency_seconds_count{operation="publish"} 1\n' in text
+
+    def test_retries_are_counted(self):
+        client = spire.Client(
+            'http://spire.test',
+            transport=FlakyTransport(2),
+            retry_policy=spire.RetryPolicy(backoff=0),
+            )
+        metrics = client.enable_metrics()
+        client._request_json("failed", 'GET', 'http://spire.test/thing', operation='thing')
+        self.assertEqual(metrics.snapshot()['thing']['retries'], 2)
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1.0, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.count, 4)
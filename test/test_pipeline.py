@@ -0,0 +1,109 @@
+"""
+Tests for the request pipeline's retries, circuit breaker and hooks, using a
+transport that plays back scripted outcomes.
+"""
+import unittest
+
+import spire
+from spire.transport import Response
+
+URL = 'http://spire.test/thing'
+
+class ScriptedTransport(spire.Transport):
+    """Each request gets the next status code in `script`, or raises a
+    TransportError where the script says None"""
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        self.requests.append(method)
+        status = self.script.pop(0)
+        if status is None:
+            raise spire.TransportError("connection refused")
+        return Response(status, {}, '{}', url)
+
+class TestRequestPipeline(unittest.TestCase):
+    def pipeline(self, script, **kwargs):
+        self.transport = ScriptedTransport(script)
+        self.sleeps = []
+        self.attempts = []
+        pipeline = spire.RequestPipeline(self.transport, sleep=self.sleeps.append, **kwargs)
+        pipeline.add_hook(self.attempts.append)
+        return pipeline
+
+    def test_idempotent_requests_are_retried_with_backoff(self):
+        pipeline = self.pipeline(
+            [503, None, 200],
+            retry_policy=spire.RetryPolicy(backoff=1.0, jitter=False),
+            )
+        response = pipeline.request('GET', URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+        self.assertEqual([a['will_retry'] for a in self.attempts], [True, True, False])
+        self.assertEqual([a['status_code'] for a in self.attempts], [503, None, 200])
+        assert all(a['elapsed'] >= 0 for a in self.attempts)
+
+    def test_gives_up_after_max_attempts(self):
+        pipeline = self.pipeline([None, None, None])
+        self.assertRaises(spire.TransportError, pipeline.request, 'GET', URL)
+        self.assertEqual(len(self.transport.requests), 3)
+
+        pipeline = self.pipeline([502, 502, 502])
+        self.assertEqual(pipeline.request('GET', URL).status_code, 502)
+
+    def test_non_idempotent_requests_are_retried_only_when_rejected(self):
+        pipeline = self.pipeline([500])
+        self.assertEqual(pipeline.request('POST', URL).status_code, 500)
+        self.assertEqual(len(self.transport.requests), 1)
+
+        pipeline = self.pipeline([None])
+        self.assertRaises(spire.TransportError, pipeline.request, 'POST', URL)
+
+        pipeline = self.pipeline([429, 503, 201])
+        self.assertEqual(pipeline.request('POST', URL).status_code, 201)
+
+        pipeline = self.pipeline([500, 201])
+        self.assertEqual(pipeline.request('POST', URL, idempotent=True).status_code, 201)
+
+    def test_client_errors_are_not_retried(self):
+        pipeline = self.pipeline([404])
+        self.assertEqual(pipeline.request('GET', URL).status_code, 404)
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_circuit_opens_and_recovers(self):
+        pipeline = self.pipeline(
+            [500, 500, 200],
+            retry_policy=spire.pipeline.NO_RETRIES,
+            failure_threshold=2,
+            reset_timeout=0,
+            )
+        pipeline.request('GET', URL)
+        pipeline.request('GET', URL)
+        breaker = pipeline.breaker(URL)
+        self.assertEqual(breaker.state, spire.CircuitBreaker.OPEN)
+
+        # reset_timeout has passed, so a trial request goes through
+        self.assertEqual(pipeline.request('GET', URL).status_code, 200)
+        self.assertEqual(breaker.state, spire.CircuitBreaker.CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        pipeline = self.pipeline(
+            [None],
+            retry_policy=spire.pipeline.NO_RETRIES,
+            failure_threshold=1,
+            reset_timeout=60,
+            )
+        self.assertRaises(spire.TransportError, pipeline.request, 'GET', URL)
+        self.assertRaises(spire.CircuitOpenError, pipeline.request, 'GET', URL)
+        self.assertEqual(len(self.transport.requests), 1)
+        # other hosts are unaffected
+        assert pipeline.breaker('http://elsewhere.test/').allow()
+
+    def test_client_errors_raise_spire_client_exception(self):
+        client = spire.Client('http://spire.test', transport=ScriptedTransport([403]))
+        self.assertRaises(
+            spire.SpireClientException,
+            client._request_json, "Could not do the thing", 'GET', URL,
+            )
@@ -0,0 +1,88 @@
+"""
+Tests for the strategies choosing how subscriptions long-poll.
+"""
+import unittest
+
+import spire
+from spire.polling import SUBSCRIBE_MAX_TIMEOUT
+
+from test_subscription import CannedTransport, page, subscription
+
+class TestFixedPolling(unittest.TestCase):
+    def test_default_params(self):
+        transport = CannedTransport([page(1, 2)])
+        sub = subscription(transport)
+        sub.poll()
+        params = transport.requests[0][3]
+        self.assertEqual(params['timeout'], SUBSCRIBE_MAX_TIMEOUT)
+        assert 'limit' not in params
+        stats = sub.polling.stats()
+        self.assertEqual(stats['polls'], 1)
+        self.assertEqual(stats['events_per_poll'], 2.0)
+
+    def test_limit_and_wait(self):
+        transport = CannedTransport([page(1, 2), page(3, 4)])
+        sub = subscription(transport)
+        slept = []
+        sub.client.pipeline.sleep = slept.append
+        sub.poll_with(spire.FixedPolling(timeout=5, limit=2, wait=0.25))
+        sub.poll()
+        sub.poll()
+        self.assertEqual([r[3]['limit'] for r in transport.requests], [2, 2])
+        self.assertEqual([r[3]['timeout'] for r in transport.requests], [5, 5])
+        self.assertEqual([r[3]['last'] for r in transport.requests], [0, 2])
+        self.assertEqual(slept, [0.25, 0.25])
+        self.assertEqual(sub.polling.stats()['full_pages'], 2)
+
+class TestAdaptivePolling(unittest.TestCase):
+    def test_idle_polls_are_held_open(self):
+        polling = spire.AdaptivePolling()
+        polling.observe(0, SUBSCRIBE_MAX_TIMEOUT)
+        self.assertEqual(polling.timeout, SUBSCRIBE_MAX_TIMEOUT)
+        self.assertEqual(polling.delay(), 0)
+        self.assertEqual(polling.limit, polling.min_limit)
+
+    def test_busy_polls_are_coalesced(self):
+        polling = spire.AdaptivePolling(max_wait=1.0, target_events=50)
+        for i in range(10):
+            polling.observe(10, 0.1) # 100 events a second
+        self.assertAlmostEqual(polling.rate, 100)
+        self.assertEqual(polling.timeout, polling.min_timeout)
+        self.assertAlmostEqual(polling.delay(), 0.5) # time for 50 events
+        self.assertEqual(polling.limit, 300)
+
+        # a full page means a backlog: poll again straight away
+        polling.observe(polling.limit, 0.5)
+        self.assertEqual(polling.delay(), 0)
+
+    def test_quietening_down(self):
+        polling = spire.AdaptivePolling()
+        polling.observe(100, 1.0)
+        busy_timeout = polling.timeout
+        for i in range(20):
+            polling.observe(0, polling.timeout + polling.delay())
+        assert polling.timeout > busy_timeout
+        self.assertEqual(polling.timeout, SUBSCRIBE_MAX_TIMEOUT)
+        self.assertEqual(polling.delay(), 0)
+
+    def test_with_server(self):
+        from spire.fakeserver import FakeSpireServer
+        server = FakeSpireServer(max_timeout=0.2).start()
+        try:
+            client = spire.Client(server.url, secret=server.create_account())
+            channel = client.session().channel('foo')
+            subscription = channel.subscription()
+            polling = subscription.poll_with(spire.AdaptivePolling(
+                    min_limit=5, max_limit=20, max_wait=0.05))
+            channel.publish_many(range(50))
+            received = []
+            while len(received) < 50:
+                received.extend(e['content'] for e in subscription.poll()['messages'])
+            self.assertEqual(received, range(50))
+            stats = polling.stats()
+            self.assertEqual(stats['events'], 50)
+            assert stats['polls'] >= 3 # pages were capped at max_limit
+            assert stats['polls_per_second'] > 0
+            client.close()
+        finally:
+            server.stop()
@@ -0,0 +1,100 @@
+"""
+Tests for SessionPool, with a stand-in client that counts the sessions it
+creates.
+"""
+import threading
+import time
+import unittest
+
+import spire
+
+class FakeSession(object):
+    def __init__(self, number):
+        self.number = number
+        self.refreshes = 0
+        self.healthy = True
+
+    def _refresh(self):
+        self.refreshes += 1
+        if not self.healthy:
+            raise spire.SpireClientException("Could not refresh session: 404")
+        return True
+
+class FakeClient(object):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def session(self):
+        time.sleep(self.delay)
+        with self.lock:
+            self.created += 1
+            return FakeSession(self.created)
+
+class TestSessionPool(unittest.TestCase):
+    def test_sessions_are_reused(self):
+        client = FakeClient()
+        pool = spire.SessionPool(client, prewarm=False)
+        with pool.session() as first:
+            pass
+        with pool.session() as second:
+            pass
+        assert first is second
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['created']), (1, 1, 1))
+
+    def test_prewarm(self):
+        client = FakeClient()
+        pool = spire.SessionPool(client, min_size=3, max_size=5)
+        deadline = time.time() + 2
+        while pool.stats()['idle'] < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()['idle'], 3)
+        pool.lease()
+        self.assertEqual(pool.stats()['hits'], 1)
+        self.assertEqual(client.created, 3)
+
+    def test_max_size_blocks_and_times_out(self):
+        pool = spire.SessionPool(FakeClient(), max_size=1, prewarm=False)
+        session = pool.lease()
+        self.assertRaises(spire.SpireClientException, pool.lease, timeout=0.05)
+
+        threading.Timer(0.05, pool.release, [session]).start()
+        assert pool.lease(timeout=2) is session
+        assert pool.stats()['waits'] >= 1
+
+    def test_unhealthy_sessions_are_discarded(self):
+        pool = spire.SessionPool(FakeClient(), prewarm=False, health_check_interval=0)
+        session = pool.lease()
+        session.healthy = False
+        pool.release(session)
+
+        replacement = pool.lease()
+        assert replacement is not session
+        self.assertEqual(session.refreshes, 1)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_concurrent_leases_stay_within_max_size(self):
+        client = FakeClient(delay=0.01)
+        pool = spire.SessionPool(client, max_size=4, prewarm=False)
+        leased = []
+        def worker():
+            for i in range(10):
+                with pool.session() as session:
+                    leased.append(session)
+                    time.sleep(0.001)
+        threads = [threading.Thread(target=worker) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(leased), 160)
+        assert client.created <= 4
+        self.assertEqual(pool.stats()['size'], client.created)
+
+    def test_client_creates_pool(self):
+        client = spire.Client('http://spire.test')
+        pool = client.create_session_pool(min_size=0, prewarm=False)
+        assert client.session_pool is pool
+        assert pool.client is client
@@ -0,0 +1,129 @@
+"""
+Tests for publishing from background workers.
+"""
+import threading
+import unittest
+
+import spire
+from spire.fakeserver import FakeSpireServer
+
+class SlowChannel(object):
+    """Publishes to `channel` once `release` is set"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.resource = channel.resource
+        self.publishing = threading.Event()
+        self.release = threading.Event()
+
+    def publish(self, message):
+        self.publishing.set()
+        self.release.wait()
+        return self.channel.publish(message)
+
+class DeferredSpawn(object):
+    """Holds on to the workers a publisher spawns until `run` is called, so
+    messages can be buffered into one batch first"""
+    def __init__(self):
+        self.spawned = []
+
+    def __call__(self, target, *args):
+        self.spawned.append((target, args))
+
+    def run(self):
+        for target, args in self.spawned:
+            spire.manager.spawn_thread(target, *args)
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(max_timeout=0.1).start()
+        self.client = spire.Client(self.server.url, secret=self.server.create_account())
+        self.session = self.client.session()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_publishes_in_order_per_channel(self):
+        channels = self.session.channels(['a', 'b', 'c'])
+        publisher = self.client.create_publisher(workers=2)
+        futures = []
+        for i in range(60):
+            futures.append(publisher.publish(channels[i % 3], i))
+        assert publisher.flush(timeout=10)
+        self.assertEqual([f.result()['content'] for f in futures], range(60))
+
+        for n, channel in enumerate(channels):
+            events = channel.subscription().subscribe()
+            self.assertEqual(
+                [e['content'] for e in events['messages']],
+                range(n, 60, 3),
+                )
+        metrics = publisher.metrics()
+        self.assertEqual(metrics['published'], 60)
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual(metrics['latency']['count'], 60)
+        assert publisher.close()
+
+    def test_full_buffer_drops_the_oldest(self):
+        channel = SlowChannel(self.session.channel('foo'))
+        publisher = spire.Publisher(self.client, workers=1, capacity=2, batch_size=1).start()
+        first = publisher.publish(channel, 'first')
+        # the worker is stuck on the first message while three more arrive
+        channel.publishing.wait(5)
+        futures = [publisher.publish(channel, m) for m in ('a', 'b', 'c')]
+        self.assertRaises(spire.PublishDropped, futures[0].result, 1)
+        channel.release.set()
+        assert publisher.flush(timeout=5)
+        self.assertEqual(first.result()['content'], 'first')
+        self.assertEqual([f.result()['content'] for f in futures[1:]], ['b', 'c'])
+        self.assertEqual(publisher.metrics()['dropped'], 1)
+        publisher.close()
+
+    def test_failures_reach_futures(self):
+        channel = self.session.channel('foo')
+        errors = []
+        publisher = spire.Publisher(self.client, on_error=errors.append).start()
+        channel.delete()
+        future = publisher.publish(channel, 'lost')
+        done = []
+        future.add_done_callback(done.append)
+        self.assertRaises(spire.SpireClientException, future.result, 5)
+        self.assertEqual(done, [future])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(publisher.metrics()['failed'], 1)
+        publisher.close()
+
+    def test_batch_failing_part_way(self):
+        channel = self.session.channel('foo')
+        self.server.max_body = 1000
+        spawn = DeferredSpawn()
+        errors = []
+        publisher = spire.Publisher(self.client, workers=1, on_error=errors.append, spawn=spawn).start()
+        futures = [publisher.publish(channel, m) for m in ('a', 'b', 'x' * 2000)]
+        spawn.run()
+        assert publisher.flush(timeout=5)
+        # the server turned the third away, but the first two were published
+        self.assertEqual([f.result()['content'] for f in futures[:2]], ['a', 'b'])
+        self.assertRaises(spire.PayloadTooLarge, futures[2].result)
+        metrics = publisher.metrics()
+        self.assertEqual((metrics['published'], metrics['failed']), (2, 1))
+        self.assertEqual(len(errors), 1)
+        publisher.close()
+
+    def test_futures_after_a_failure_get_their_own_outcome(self):
+        client = spire.Client(self.server.url, secret=self.server.create_account(), pipelining=True)
+        channel = client.session().channel('foo')
+        self.server.max_body = 1000
+        spawn = DeferredSpawn()
+        publisher = spire.Publisher(client, workers=1, on_error=lambda exc_info: None, spawn=spawn).start()
+        futures = [publisher.publish(channel, m) for m in ('a', 'x' * 2000, 'c')]
+        spawn.run()
+        assert publisher.flush(timeout=5)
+        # the whole window was sent, and the server took the third
+        self.assertEqual(futures[0].result()['content'], 'a')
+        self.assertRaises(spire.PayloadTooLarge, futures[1].result)
+        self.assertEqual(futures[2].result()['content'], 'c')
+        metrics = publisher.metrics()
+        self.assertEqual((metrics['published'], metrics['failed']), (2, 1))
+        publisher.close()
+        client.close()
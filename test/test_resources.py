@@ -0,0 +1,169 @@
+"""
+Tests for the typed resource objects and their headers.
+"""
+import unittest
+
+import spire
+from spire.resources import ChannelResource, ResourceCollection, SessionResource, SubscriptionResource
+
+SCHEMA = dict(
+    message='message',
+    channel='channel',
+    channels='channels',
+    session='session',
+    subscription='subscription',
+    subscriptions='subscriptions',
+    events='events',
+    )
+
+SESSION = dict(
+    url='http://spire.test/session/1',
+    capabilities=dict(get='session-get'),
+    resources=dict(
+        channels=dict(
+            url='http://spire.test/session/1/channels',
+            capabilities=dict(all='channels-all', create='channels-create'),
+            ),
+        subscriptions=dict(
+            url='http://spire.test/session/1/subscriptions',
+            capabilities=dict(all='subscriptions-all', create='subscriptions-create'),
+            ),
+        ),
+    )
+
+CHANNEL = dict(
+    url='http://spire.test/channel/1',
+    name='foo',
+    capabilities=dict(publish='publish', delete='delete'),
+    resources=dict(subscriptions=dict(
+            url='http://spire.test/channel/1/subscriptions',
+            capabilities=dict(get_subscriptions='get-subscriptions'),
+            )),
+    )
+
+class TestResources(unittest.TestCase):
+    def test_session_resource(self):
+        resource = SessionResource(SESSION)
+        self.assertEqual(resource.url, SESSION['url'])
+        self.assertEqual(resource.channels_url, 'http://spire.test/session/1/channels')
+        self.assertEqual(resource.capability('session', 'get'), 'session-get')
+        self.assertEqual(resource.capability('channels', 'create'), 'channels-create')
+        self.assertEqual(resource.capability('accounts', 'get'), None)
+        self.assertEqual(resource.headers('create_channel', SCHEMA), {
+                'Accept': 'channel',
+                'Content-type': 'channel',
+                'Authorization': 'Capability channels-create',
+                })
+        self.assertRaises(KeyError, resource.headers, 'publish', SCHEMA)
+
+    def test_headers_are_built_on_demand(self):
+        resource = ChannelResource(CHANNEL)
+        headers = resource.headers('publish', SCHEMA)
+        self.assertEqual(headers['Authorization'], 'Capability publish')
+        # a fresh dict each time, which the caller may modify
+        assert resource.headers('publish', SCHEMA) is not headers
+        self.assertEqual(resource.headers('publish', SCHEMA), headers)
+        self.assertEqual(
+            resource.headers('subscriptions', SCHEMA)['Authorization'],
+            'Capability get-subscriptions',
+            )
+        self.assertEqual(
+            SubscriptionResource(dict(url='u', capabilities=dict(events='e'))).headers('events', SCHEMA),
+            {'Accept': 'events', 'Authorization': 'Capability e'},
+            )
+
+    def test_channel_keeps_raw_resource(self):
+        channel = spire.Channel(None, None, CHANNEL)
+        assert channel.channel_resource is CHANNEL
+        self.assertEqual(channel.resource.name, 'foo')
+        self.assertEqual(channel.resource.subscriptions_url, 'http://spire.test/channel/1/subscriptions')
+        # the dict is the only copy of the resource
+        self.assertRaises(AttributeError, setattr, channel.resource, 'name', 'bar')
+        self.assertRaises(AttributeError, setattr, channel, 'extra', 1)
+
+        # replacing the resource replaces the extracted values and headers
+        changed = dict(CHANNEL, capabilities=dict(publish='new-publish'))
+        channel.channel_resource = changed
+        self.assertEqual(
+            channel.resource.headers('publish', SCHEMA)['Authorization'],
+            'Capability new-publish',
+            )
+
+    def test_session_refresh_replaces_resource(self):
+        session = spire.Session(None, SESSION)
+        self.assertEqual(session.get_capability('subscriptions', 'all'), 'subscriptions-all')
+        session.session_resource = dict(SESSION, capabilities=dict(get='other'))
+        self.assertEqual(session.get_capability('session', 'get'), 'other')
+
+class TestResourceCollection(unittest.TestCase):
+    def test_objects_are_built_on_demand_and_bounded(self):
+        built = []
+
+        def _build(resource):
+            built.append(resource['name'])
+            return spire.Subscription(None, resource)
+
+        raw = dict(('sub-%i' % i, dict(name='sub-%i' % i, url='/sub/%i' % i)) for i in range(10))
+        collection = ResourceCollection(_build, raw, cache_size=2)
+        self.assertEqual(len(collection), 10)
+        assert 'sub-3' in collection
+        self.assertEqual(built, [])
+
+        first = collection['sub-1']
+        assert collection.get('sub-1') is first
+        collection['sub-2'], collection['sub-3']
+        self.assertEqual(built, ['sub-1', 'sub-2', 'sub-3'])
+        # sub-1 was dropped from the cache, so it is built again
+        assert collection['sub-1'] is not first
+        self.assertRaises(KeyError, collection.__getitem__, 'missing')
+
+        collection.update(dict((name, raw[name]) for name in ('sub-1', 'sub-9')))
+        self.assertEqual(sorted(collection.keys()), ['sub-1', 'sub-9'])
+        assert collection.loaded
+
+    def test_subscriptions_with_state_are_kept(self):
+        from spire.fakeserver import FakeSpireServer
+        server = FakeSpireServer(max_timeout=0.1).start()
+        try:
+            client = spire.Client(server.url, secret=server.create_account())
+            session = client.session()
+            session.subscription_collection.cache_size = 2
+            channel = session.channel('foo')
+            channel.publish('one')
+            channel.publish('two')
+            first = channel.subscribe()
+            self.assertEqual([m['content'] for m in first['messages']], ['one', 'two'])
+            # using two others would have dropped it from the cache
+            channel.subscription('a')
+            channel.subscription('b')
+            channel.publish('three')
+            second = channel.subscribe()
+            self.assertEqual([m['content'] for m in second['messages']], ['three'])
+
+            # ones that haven't polled can still be dropped
+            untouched = channel.subscription('a')
+            channel.subscription('c')
+            channel.subscription('d')
+            assert channel.subscription('a') is not untouched
+            client.close()
+        finally:
+            server.stop()
+
+    def test_subscriptions_are_created_without_fetching_the_collection(self):
+        from spire.fakeserver import FakeSpireServer
+        server = FakeSpireServer(max_timeout=0.1).start()
+        try:
+            client = spire.Client(server.url, secret=server.create_account())
+            channel = client.session().channel('foo')
+            subscription = channel.subscription('bar')
+            assert channel.subscription('bar') is subscription
+            self.assertEqual(server.request_counts.get(('GET', 'get_subscriptions'), 0), 0)
+
+            # another session has to fetch the collection to find it
+            other = client.session().channel('foo').subscription('bar')
+            self.assertEqual(other.resource.url, subscription.resource.url)
+            self.assertEqual(server.request_counts[('GET', 'get_subscriptions')], 1)
+            self.assertEqual(server.request_counts[('POST', 'create_subscription')], 2)
+            client.close()
+        finally:
+            server.stop()
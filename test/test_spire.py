@@ -1,84 +1,44 @@
 """
 Integration tests for the Spire client library. If the environment variable
 SPIRE_SECRET (and optionally SPIRE_HOST) is set, they will run against the
-remote API, otherwise a (currently broken) stub API will be used.
+remote API, otherwise against the in-process fake in spire.fakeserver.
 """
 
 import os
 import re
 import unittest
-try:
-    import json
-except ImportError:
-    import simplejson as json
 
 from nose import SkipTest
 from nose.tools import eq_ as eq
 
-import stubserver
-
 import spire
-
-"""
-These constants are meant to be used in the stub server when the tests are run
-without a connection to the actual Spire service. The stub server isn't
-currently set up to work, though.
-"""
-
-DISCOVERY = {}
-
-NEW_SESSION = {}
+from spire.fakeserver import FakeSpireServer
 
 class TestSpireClient(unittest.TestCase):
     def setUp(self):
-        self.client, self.server = self.get_client()
-        if self.server is not None:
-            self.server.run()
+        self.server = None
+        self.secret = os.environ.get('SPIRE_SECRET', None)
+        self.base_url = os.environ.get('SPIRE_HOST', 'https://api.spire.io')
+        if self.secret is None:
+            # empty long-polls return after a second rather than thirty
+            self.server = FakeSpireServer(max_timeout=1, newest_first=True).start()
+            self.secret = self.server.create_account()
+            self.base_url = self.server.url
+        self.client = self.get_client()[0]
 
     def get_client(self, async=False):
-        spire_secret =  os.environ.get('SPIRE_SECRET', None)
-        if spire_secret is not None:
-            server = None
-            client = spire.Client(
-                os.environ.get('SPIRE_HOST', 'https://api.spire.io'),
-                secret = spire_secret,
-                async=async,
-                )
-        else:
-            stub_port = 3133
-            server = stubserver.StubServer(stub_port)
-            client = spire.Client(
-                "http://localhost/%i" % stub_port,
-                async=async,
-                )
-        return (client, server)
+        client = spire.Client(
+            self.base_url,
+            secret=self.secret,
+            async=async,
+            )
+        return (client, self.server)
 
     def tearDown(self):
         if self.server:
-            self.server.stop() # stop also verifies calls
+            self.server.stop()
 
     def test_session_creation_and_implicit_discovery(self):
-        if self.server:
-            # I am not in love with the API of stubserver, but it sure beats
-            # writing my own right now.
-            #
-            # Furthermore, these expectations aren't working the way I expect
-            # them to. Leaving them here as documentation for the pattern I
-            # want to follow in future tests
-            self.server.expect(
-                method='GET',
-                url="/$").and_return(
-                mime_type='application/json',
-                content=json.dumps(DISCOVERY),
-                )
-            self.server.expect(
-                method='POST',
-                url=DISCOVERY['resources']['sessions']['url'],
-                ).and_return(
-                mime_type=DISCOVERY['schema']['1.0']['mimeTypes'],
-                content=json.dumps(NEW_SESSION),
-                )
-
         # Discovery hasn't happened
         assert self.client.resources is None
         assert self.client.schema is None
@@ -126,6 +86,14 @@ class TestSpireClient(unittest.TestCase):
             "sub-a-dub-dub"
         )
 
+    def test_get_subscriptions_for_channel_without_session(self):
+        channel = self.client.session().channel('no-session')
+        channel.subscribe(name='sub-no-session')
+
+        detached = spire.Channel(self.client, None, channel.channel_resource)
+
+        eq(detached.subscriptions()['sub-no-session'].resource.name, 'sub-no-session')
+
 
     def test_create_and_publish_to_default_channel_evented(self):
         self.client, self.server = self.get_client(async=True)
@@ -180,13 +148,42 @@ class TestSpireClient(unittest.TestCase):
             "BECAUSE THAT'S HOW YOU GET ANTS",
             )
 
+    def test_subscribe_many(self):
+        session = self.client.session()
+        alerts = session.channel('test-alerts')
+        subscription = session.subscribe_many([alerts, 'test-deploys'])
+        eq(session.subscribe_many(['test-deploys', alerts]), subscription)
+        eq(len(subscription.subscription_resource['channels']), 2)
+
+        alerts.publish('disk full')
+        session.channel('test-deploys').publish('v2 is out')
+        dispatcher = spire.Dispatcher(key=spire.dispatch.channel_name)
+        handled = []
+        dispatcher.on('test-alerts', lambda e: handled.append(('alert', e['content'])))
+        dispatcher.on('test-deploys', lambda e: handled.append(('deploy', e['content'])))
+
+        while len(handled) < 2:
+            subscription.subscribe(callback=dispatcher)
+        # the dispatcher puts the live service's newest-first pages in order
+        eq(handled, [('alert', 'disk full'), ('deploy', 'v2 is out')])
+
+    def test_publish_many_preserves_order(self):
+        channel = self.client.session().channel('test-publish-many')
+        contents = ['message %i' % i for i in range(25)]
+
+        published = channel.publish_many(iter(contents), window=10)
+
+        eq([x['content'] for x in published], contents)
+        timestamps = [x['timestamp'] for x in published]
+        eq(timestamps, sorted(timestamps))
+
     def test_channel_with_url_and_capability_only(self):
         # awkwardness = refactor opportunity
         session = self.client.session()
         channel = session.channel(name='keep-it-safe')
 
         unprivileged_client = spire.Client(
-            os.environ.get('SPIRE_HOST', 'https://api.spire.io'),
+            self.base_url,
             # Note lack of key
             )
 
@@ -217,7 +214,7 @@ class TestSpireClient(unittest.TestCase):
             subscription = channel._create_subscription(name='keep-it-safe')
 
         unprivileged_client = spire.Client(
-            os.environ.get('SPIRE_HOST', 'https://api.spire.io'),
+            self.base_url,
             # Note lack of key
             )
 
@@ -241,3 +238,46 @@ class TestSpireClient(unittest.TestCase):
 
     def test_delete_channel(self):
         raise SkipTest
+
+class TestPublishMany(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(max_timeout=0.1).start()
+        self.secret = self.server.create_account()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def publish_many(self, messages, **kwargs):
+        client = spire.Client(self.server.url, secret=self.secret, **kwargs)
+        channel = client.session().channel('many')
+        subscription = channel.subscription()
+        self.server.max_body = 100
+        try:
+            channel.publish_many(messages)
+        except spire.PayloadTooLarge, e:
+            self.server.max_body = None
+            stored = subscription.subscribe()['messages']
+            return e.results, sorted(x['content'] for x in stored)
+        finally:
+            client.close()
+        raise AssertionError("publish_many should have failed")
+
+    def test_pipelined_window_reports_every_outcome(self):
+        results, stored = self.publish_many(['a', 'b' * 200, 'c', 'd'], pipelining=True)
+        eq([resource and resource['content'] for resource, error in results], ['a', None, 'c', 'd'])
+        eq([type(error) for resource, error in results], [type(None), spire.PayloadTooLarge, type(None), type(None)])
+        eq(stored, ['a', 'c', 'd'])
+
+    def test_stops_at_first_failure(self):
+        results, stored = self.publish_many(['a', 'b' * 200, 'c', 'd'])
+        eq(len(results), 2)
+        eq(results[0][0]['content'], 'a')
+        assert isinstance(results[1][1], spire.PayloadTooLarge)
+        eq(stored, ['a'])
+
+    def test_pipelined_preserves_order(self):
+        client = spire.Client(self.server.url, secret=self.secret, pipelining=True)
+        contents = ['message %i' % i for i in range(25)]
+        published = client.session().channel('many').publish_many(iter(contents), window=10)
+        eq([x['content'] for x in published], contents)
+        client.close()
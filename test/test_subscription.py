@@ -0,0 +1,134 @@
+"""
+Tests for Subscription's polling, using a transport that replays canned
+responses instead of talking to Spire.
+"""
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import spire
+from spire.transport import Response
+
+EVENTS_TYPE = 'application/vnd.spire-io.events+json;version=1.0'
+
+class CannedTransport(spire.Transport):
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def request(self, method, url, headers=None, data=None, params=None, timeout=None):
+        self.requests.append((method, url, dict(headers or {}), dict(params or {})))
+        page = self.pages.pop(0)
+        return Response(200, {}, json.dumps(page), url)
+
+def page(*timestamps):
+    messages = [dict(content='event %i' % t, timestamp=t) for t in timestamps]
+    return dict(messages=messages, last=timestamps[-1] if timestamps else 0)
+
+def subscription(transport):
+    client = spire.Client('http://spire.test', transport=transport)
+    client.resources = {}
+    client.schema = dict(events=EVENTS_TYPE)
+    return spire.Subscription(client, dict(
+            url='http://spire.test/subscription/1',
+            capabilities=dict(events='events-capability'),
+            ))
+
+class TestSubscriptionEvents(unittest.TestCase):
+    def test_events_yields_each_event_and_resumes(self):
+        transport = CannedTransport([page(1, 2), page(), page(3)])
+        events = subscription(transport).events()
+
+        self.assertEqual([events.next()['timestamp'] for i in range(3)], [1, 2, 3])
+        self.assertEqual([r[3]['last'] for r in transport.requests], [0, 2, 2])
+
+        method, url, headers, params = transport.requests[0]
+        self.assertEqual(url, 'http://spire.test/subscription/1')
+        self.assertEqual(headers['Authorization'], 'Capability events-capability')
+        self.assertEqual(params['order-by'], 'asc')
+
+    def test_events_polls_lazily(self):
+        transport = CannedTransport([page(1, 2), page(3)])
+        sub = subscription(transport)
+        events = sub.events(last_timestamp=0)
+        events.next()
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual(sub.last_timestamp, 1)
+
+        # stopping part way through a page resumes after the last event seen
+        events.close()
+        events = sub.events()
+        self.assertEqual(events.next()['timestamp'], 3)
+        self.assertEqual(transport.requests[-1][3]['last'], 1)
+
+    def test_subscribe_tracks_last_timestamp(self):
+        transport = CannedTransport([page(4, 5)])
+        sub = subscription(transport)
+        events = sub.subscribe(last_timestamp=3)
+        self.assertEqual(len(events['messages']), 2)
+        self.assertEqual(transport.requests[0][3]['last'], 3)
+        self.assertEqual(sub.last_timestamp, 5)
+
+    def test_newest_first_pages_are_put_in_order(self):
+        # the live service has returned pages newest first, with `last`
+        # taken from the end of the page
+        transport = CannedTransport([page(3, 2, 1), page(4)])
+        sub = subscription(transport)
+        events = sub.events(last_timestamp=0)
+
+        self.assertEqual([events.next()['timestamp'] for i in range(4)], [1, 2, 3, 4])
+        self.assertEqual([r[3]['last'] for r in transport.requests], [0, 3])
+
+class TestSubscriptionCheckpoints(unittest.TestCase):
+    def test_resumes_from_stored_position(self):
+        store = spire.MemoryCheckpointStore()
+        store.save('http://spire.test/subscription/1', 7)
+        transport = CannedTransport([page(8)])
+        sub = subscription(transport)
+        sub.checkpoint_to(store)
+        sub.subscribe()
+        self.assertEqual(transport.requests[0][3]['last'], 7)
+
+    def test_events_checkpoint_every_n(self):
+        store = spire.MemoryCheckpointStore()
+        transport = CannedTransport([page(1, 2, 3), page(4, 5)])
+        sub = subscription(transport)
+        sub.checkpoint_to(store, key='sub', every=2, interval=None)
+        events = sub.events()
+
+        for i in range(3):
+            events.next()
+        # events 1 and 2 are processed, 3 is still being handled
+        self.assertEqual(store.load('sub'), 2)
+        events.next()
+        self.assertEqual(store.load('sub'), 2)
+
+        # closing saves what was processed, but not the event in hand
+        events.close()
+        self.assertEqual(store.load('sub'), 3)
+
+    def test_subscribe_checkpoints_once_page_is_processed(self):
+        store = spire.MemoryCheckpointStore()
+        transport = CannedTransport([page(1, 2), page(3)])
+        sub = subscription(transport)
+        sub.checkpoint_to(store, key='sub', every=1)
+
+        sub.subscribe()
+        self.assertEqual(store.load('sub'), None)
+        sub.subscribe(callback=lambda events: None)
+        self.assertEqual(store.load('sub'), 3)
+
+    def test_discarded_page_is_not_processed(self):
+        store = spire.MemoryCheckpointStore()
+        transport = CannedTransport([page(1, 2), page(1, 2)])
+        sub = subscription(transport)
+        sub.checkpoint_to(store, key='sub', every=1)
+
+        # e.g. a manager stopped while the poll was in flight
+        sub.subscribe(last_timestamp=0)
+        sub._discard_page()
+        sub.subscribe(last_timestamp=0)
+        self.assertEqual(store.load('sub'), None)
@@ -0,0 +1,97 @@
+"""
+Tests for sharing clients and sessions between threads.
+"""
+import threading
+import unittest
+
+import spire
+from spire.fakeserver import FakeSpireServer
+
+THREADS = 32
+
+def together(func, threads=THREADS):
+    """Call `func()` from `threads` threads released at the same moment,
+    returning the results and raising the first exception"""
+    start = threading.Event()
+    results = [None] * threads
+    errors = []
+    def run(i):
+        start.wait()
+        try:
+            results[i] = func()
+        except Exception, e:
+            errors.append(e)
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(10)
+    if errors:
+        raise errors[0]
+    return results
+
+class TestSingleFlight(unittest.TestCase):
+    def test_shares_result(self):
+        flight = spire.SingleFlight()
+        calls = []
+        release = threading.Event()
+        def fetch():
+            calls.append(1)
+            release.wait()
+            return 'document'
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        self.assertEqual(together(lambda: flight.do('key', fetch)), ['document'] * THREADS)
+        self.assertEqual(len(calls), 1)
+        stats = flight.stats()
+        self.assertEqual((stats['calls'], stats['shared'], stats['in_flight']), (1, THREADS - 1, 0))
+
+    def test_shares_exception(self):
+        flight = spire.SingleFlight()
+        def fail():
+            raise ValueError('no')
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        # nothing is left in flight, so the next call tries again
+        self.assertEqual(flight.do('key', lambda: 'yes'), 'yes')
+
+class TestContention(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSpireServer(latency=0.05).start()
+        self.secret = self.server.create_account()
+        self.client = spire.Client(
+            self.server.url, secret=self.secret, discovery_cache=spire.DiscoveryCache())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def count(self, method, name):
+        return self.server.request_counts.get((method, name), 0)
+
+    def test_one_discovery(self):
+        sessions = together(self.client.session)
+        self.assertEqual(self.count('GET', 'get_discovery'), 1)
+        self.assertEqual(len(set(map(id, sessions))), THREADS)
+
+    def test_one_channel_creation(self):
+        session = self.client.session()
+        channels = together(lambda: session.channel('foo'))
+        self.assertEqual(self.count('GET', 'get_channels'), 1)
+        self.assertEqual(self.count('POST', 'create_channel'), 1)
+        urls = set(channel.channel_resource['url'] for channel in channels)
+        self.assertEqual(len(urls), 1)
+
+    def test_one_subscription_creation(self):
+        session = self.client.session()
+        url = session.channel('foo').channel_resource['url']
+        subscriptions = together(lambda: session.subscription('s', [url]))
+        self.assertEqual(self.count('POST', 'create_subscription'), 1)
+        self.assertEqual(len(set(s.resource.url for s in subscriptions)), 1)
+
+        # another session finds it exists and fetches the collection once
+        other = self.client.session()
+        subscriptions = together(lambda: other.subscription('s', [url]))
+        self.assertEqual(self.count('POST', 'create_subscription'), 2)
+        self.assertEqual(self.count('GET', 'get_subscriptions'), 1)
+        self.assertEqual(len(set(s.resource.url for s in subscriptions)), 1)
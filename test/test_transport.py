@@ -0,0 +1,258 @@
+"""
+Tests for the pooled HTTP transport, run against a throwaway local HTTP/1.1
+server so no network access is needed.
+"""
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import unittest
+
+import spire
+from spire.transport import ConnectionPool
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def _reply(self, status=200):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length) if length else ''
+        content = '%s %s %s' % (self.command, self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.startswith('/missing'):
+            return self._reply(404)
+        self._reply()
+
+    do_POST = do_DELETE = do_GET
+
+    def log_message(self, *args):
+        pass
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class DroppingServer(object):
+    """A bare HTTP/1.1 server that answers the first `answer` requests on
+    each connection, then drops the connection instead of answering the next
+    one, after sending part of a status line if `partial` is set. With
+    `linger=False` it closes the connection straight after the last answer
+    instead. The paths and bodies of the requests it read are kept in
+    `received`."""
+    def __init__(self, answer, partial=False, linger=True):
+        self.answer = answer
+        self.partial = partial
+        self.linger = linger
+        self.received = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://127.0.0.1:%i' % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        fp = conn.makefile('rb')
+        answered = 0
+        while True:
+            line = fp.readline()
+            if not line:
+                break
+            headers = {}
+            header = fp.readline()
+            while header.strip():
+                key, value = header.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+                header = fp.readline()
+            body = fp.read(int(headers.get('content-length', 0)))
+            self.received.append(body or line.split()[1])
+            if answered == self.answer:
+                if self.partial:
+                    conn.sendall('HTTP/1.1 20')
+                # close our side, then wait for the client to give up
+                conn.shutdown(socket.SHUT_WR)
+                while conn.recv(4096):
+                    pass
+                break
+            answered += 1
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n%s' % (len(body), body))
+            if answered == self.answer and not self.linger:
+                break
+        fp.close()
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+
+class TestPooledTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadedServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        transport = spire.PooledTransport()
+        for i in range(5):
+            response = transport.post(self.url + '/publish', data='message %i' % i)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, 'POST /publish message %i' % i)
+
+        stats = transport.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['connections_reused'], 4)
+        transport.close()
+
+    def test_pipelined_requests_come_back_in_order(self):
+        transport = spire.PooledTransport()
+        bodies = ['message %i' % i for i in range(20)]
+        responses = transport.pipeline('POST', self.url + '/publish', bodies)
+        self.assertEqual(
+            [r.content for r in responses],
+            ['POST /publish %s' % body for body in bodies],
+            )
+        self.assertEqual(transport.stats()['connections_opened'], 1)
+
+        # the connection goes back to the pool afterwards
+        transport.get(self.url)
+        self.assertEqual(transport.stats()['connections_reused'], 1)
+        transport.close()
+
+    def test_params_and_falsy_error_responses(self):
+        transport = spire.PooledTransport()
+        response = transport.get(self.url + '/events', params={'last': 5})
+        self.assertEqual(response.content, 'GET /events?last=5 ')
+        assert response
+
+        response = transport.get(self.url + '/missing')
+        self.assertEqual(response.status_code, 404)
+        assert not response
+        transport.close()
+
+    def test_keep_alive_disabled(self):
+        transport = spire.PooledTransport(keep_alive=False)
+        for i in range(3):
+            transport.get(self.url)
+        stats = transport.stats()
+        self.assertEqual(stats['connections_opened'], 3)
+        self.assertEqual(stats['connections_reused'], 0)
+
+    def test_idle_connections_are_evicted(self):
+        transport = spire.PooledTransport(idle_timeout=0.05)
+        transport.get(self.url)
+        time.sleep(0.1)
+        transport.get(self.url)
+        stats = transport.stats()
+        self.assertEqual(stats['connections_opened'], 2)
+        self.assertEqual(stats['connections_evicted'], 1)
+        transport.close()
+
+    def test_stale_connection_is_replaced(self):
+        transport = spire.PooledTransport()
+        transport.get(self.url)
+        # simulate the server dropping the idle keep-alive connection
+        pool = transport._pools.values()[0]
+        pool._idle[0][0].sock.close()
+        response = transport.get(self.url + '/again')
+        self.assertEqual(response.content, 'GET /again ')
+        self.assertEqual(transport.stats()['connections_opened'], 2)
+        transport.close()
+
+    def test_requests_answered_in_part_are_not_resent(self):
+        server = DroppingServer(answer=1, partial=True)
+        transport = spire.PooledTransport()
+        transport.post(server.url, data='first')
+        # the server may have acted on it, so it's up to the RetryPolicy
+        self.assertRaises(spire.TransportError, transport.post, server.url, data='second')
+        self.assertEqual(server.received, ['first', 'second'])
+
+        # idempotent requests are safe to send again
+        transport.get(server.url + '/a')
+        self.assertEqual(transport.get(server.url + '/b').status_code, 200)
+        self.assertEqual(server.received[2:], ['/a', '/b', '/b'])
+        transport.close()
+        server.close()
+
+    def test_unanswered_post_is_not_resent(self):
+        server = DroppingServer(answer=1)
+        transport = spire.PooledTransport()
+        transport.post(server.url, data='first')
+        # no response, but the server had all of it and may have acted on it
+        self.assertRaises(spire.TransportError, transport.post, server.url, data='second')
+        time.sleep(0.05)
+        self.assertEqual(server.received, ['first', 'second'])
+        transport.close()
+        server.close()
+
+    def test_connection_closed_while_idle_is_not_reused(self):
+        server = DroppingServer(answer=1, linger=False)
+        transport = spire.PooledTransport()
+        transport.post(server.url, data='first')
+        time.sleep(0.05)
+        self.assertEqual(transport.post(server.url, data='second').content, 'second')
+        self.assertEqual(server.received, ['first', 'second'])
+        stats = transport.stats()
+        self.assertEqual((stats['connections_opened'], stats['connections_evicted']), (2, 1))
+        transport.close()
+        server.close()
+
+    def test_pipelined_batch_is_not_resent_after_a_partial_answer(self):
+        server = DroppingServer(answer=3)
+        transport = spire.PooledTransport()
+        transport.get(server.url)
+        bodies = ['m%i' % i for i in range(5)]
+        try:
+            transport.pipeline('POST', server.url, bodies)
+        except spire.TransportError, e:
+            self.assertEqual([r.content for r in e.responses], ['m0', 'm1'])
+        else:
+            self.fail("the dropped connection wasn't noticed")
+        time.sleep(0.05)
+        self.assertEqual(server.received, ['/', 'm0', 'm1', 'm2'])
+        transport.close()
+        server.close()
+
+    def test_pool_size_limits_idle_connections(self):
+        pool = ConnectionPool('http', '127.0.0.1', self.server.server_address[1], maxsize=1)
+        first, reused = pool.get()
+        second, reused = pool.get()
+        pool.put(first)
+        pool.put(second)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertEqual(pool.stats()['connections_discarded'], 1)
+        pool.close()
+
+class TestClientTransport(unittest.TestCase):
+    def test_client_owns_a_pooled_transport(self):
+        client = spire.Client('http://127.0.0.1:1')
+        assert isinstance(client.transport, spire.PooledTransport)
+        self.assertEqual(client.connection_stats()['requests'], 0)
+
+    def test_client_accepts_a_transport(self):
+        transport = spire.PooledTransport(pool_size=2)
+        client = spire.Client('http://127.0.0.1:1', transport=transport)
+        assert client.transport is transport